@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+from manifest import RunManifest
+from instrument import stage
+
+# Предел объема кэша выровненных сцен по умолчанию (байт)
+ALIGNED_CACHE_BYTES = 20 * 1024**3
+
+
+def homography_digest(H):
+    """SHA-256 матрицы гомографии (значения float64), не зависящий от пути и времени файла."""
+    return hashlib.sha256(np.ascontiguousarray(H, dtype=np.float64).tobytes()).hexdigest()
+
+
+class AlignedCache:
+    """
+    Дисковый кэш выровненных чистых сцен: куб после выбора каналов и варпа по гомографии
+    хранится в {ключ}.npy и открывается через memmap, так что новые кропы той же сцены -
+    это чтение окон, без загрузки и варпа.
+
+    Ключ записи - источник (путь к сцене), содержимое гомографии, выбранные каналы и геометрия
+    выхода. Записи ведет RunManifest: при изменении файлов сцены или гомографии (размер и mtime,
+    при hash_contents - SHA-256) запись пересчитывается, при превышении max_bytes удаляются
+    давно не использованные кубы (LRU), кроме использованных в текущем запуске.
+    """
+    def __init__(self, root, max_bytes=ALIGNED_CACHE_BYTES, hash_contents=False, force=False):
+        """
+        :param root: Каталог кэша.
+        :param max_bytes: Предел суммарного объема кубов (None - без ограничения).
+        :param hash_contents: Сравнивать файлы сцены по SHA-256 содержимого.
+        :param force: Пересчитать все используемые записи.
+        """
+        self.root = Path(root)
+        self.manifest = RunManifest(self.root / "manifest.json", hash_contents=hash_contents,
+                                    force=force, max_bytes=max_bytes)
+
+    @staticmethod
+    def identity(img_path, H, bands, height, width):
+        """Параметры, однозначно определяющие выровненный куб."""
+        return {"source": os.path.abspath(img_path), "homography": homography_digest(H),
+                "bands": list(bands.indices), "height": height, "width": width}
+
+    def get(self, img_path, hdr_path, homography_path, bands, height, width, build):
+        """
+        Выровненный куб сцены (height, width, len(bands)) float32, memmap только для чтения.
+
+        :param bands: bands.BandSelection.
+        :param build: build(H, out) - читает сцену и варпит ее в out (memmap новой записи);
+            вызывается только при промахе.
+        :return: (куб, True если взят из кэша).
+        """
+        H = np.load(homography_path)
+        params = self.identity(img_path, H, bands, height, width)
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        inputs = [img_path, hdr_path, homography_path]
+        outputs = self.manifest.lookup(key, inputs, params)
+        if outputs:
+            with stage("load", file=os.path.basename(img_path), kind="aligned_cache"):
+                return np.load(outputs[0], mmap_mode='r'), True
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / f"{key}.npy"
+        tmp_path = self.root / f"{key}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(height, width, len(bands)))
+        try:
+            build(H, out)
+            out.flush()
+        except BaseException:
+            del out
+            tmp_path.unlink(missing_ok=True)
+            raise
+        del out
+        os.replace(tmp_path, path)
+        self.manifest.record(key, inputs, params, [path])
+        self.manifest.evict(keep=self.manifest.used)
+        self.manifest.save()
+        return np.load(path, mmap_mode='r'), False
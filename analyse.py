@@ -1,16 +1,42 @@
+import argparse
+import io
 import numpy as np
 import json
 import os
-from itertools import combinations
+from contextlib import redirect_stdout
+from functools import partial
+from itertools import combinations, chain
 from pathlib import Path
 import matplotlib.pyplot as plt
-from metrics import PSNR, SSIM, UQI, SAM, RMSE
+from metrics import (PSNR, SSIM, UQI, SAM, RMSE, PairEvaluator, Workspace, batched_evaluators, metric_parameters,
+                     DEFAULT_MEMORY_BUDGET, IMAGE_WORKSPACE_CUBES)
+from parallel import process_pool, default_workers
+from loader import load_float32, normalize_, prefetch
+from render import MapRenderer, save_map
+from map_store import MapStore
+from manifest import RunManifest
+from instrument import tracer, stage, add_trace_arguments
+from bands import HSI_BANDS, image_type
+from crop_store import crop_source, crop_files
 
-wls = {"wavelength": [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568]}
 
 class HSIMetricCalculator:
-    def __init__(self, metrics=None):
+    def __init__(self, metrics=None, memory_budget=DEFAULT_MEMORY_BUDGET, band_maps="fast",
+                 save_maps=False, reuse_maps=False, compact_maps=True, hash_contents=False):
         self.metrics = metrics or [PSNR, SSIM, UQI, SAM, RMSE]
+        # Поканальные карты: "fast" - PNG через таблицу inferno (render.py), "figure" - фигуры matplotlib, "none" - не сохранять
+        self.band_maps = band_maps
+        # Полные карты метрик в results/maps (map_store.MapStore): запись и повторное использование вместо расчета
+        self.save_maps = save_maps
+        self.reuse_maps = reuse_maps
+        # Записанные карты кропа упаковываются в сжатый crop_{N}.npz (False - остаются .npy для чтения через memmap)
+        self.compact_maps = compact_maps
+        # Сравнение входов сохраненных карт по SHA-256 содержимого (как у манифеста с --hash)
+        self.hash_contents = hash_contents
+        # Бюджет памяти (байт) на батч кропов, считаемых одним векторизованным вызовом
+        self.memory_budget = memory_budget
+        # Буферы временных массивов метрик, общие для всех кропов одной формы
+        self.workspace = Workspace()
         self.metric_ranges = {
             "PSNR": (10, 30),  # Типичный диапазон значений
             "SSIM": (0, 1),
@@ -21,8 +47,12 @@ class HSIMetricCalculator:
 
     @staticmethod
     def load_image(file_path, class_name, crop_num):
-        data = np.load(file_path).astype(np.float32)
-        data = np.clip(data / 4096.0, 0., 1.)
+        with stage("load", dataset=Path(file_path).parent.name, crop=crop_num, file=Path(file_path).name) as record:
+            data = load_float32(file_path)
+            if image_type(data) != 'HSI':
+                raise ValueError(f"{file_path}: expected {len(HSI_BANDS)} HSI channels, got {data.shape[2]}")
+            normalize_(data, 4096.0)
+            record["bytes"] = data.nbytes
         return {
             "data": data,
             "class_name": class_name,
@@ -31,15 +61,36 @@ class HSIMetricCalculator:
         }
     
     def compute_metric(self, metric, img1, img2):
-        metric_map = metric(img1["data"], img2["data"])
+        metric_map = PairEvaluator(img1["data"], img2["data"], self.workspace).map(metric)
         return np.mean(metric_map), metric_map
 
+    def compute_batched_maps(self, pairs):
+        """
+        Карты метрик для пар (img1, img2) нескольких кропов, посчитанные батчами
+        (N, H, W, C) с общими величинами изображений.
+        
+        :return: генератор (номер пары, имя метрики, среднее, карта).
+        """
+        images, index = [], {}
+        for img in (img for pair in pairs for img in pair):
+            if id(img) not in index:
+                index[id(img)] = len(images)
+                images.append(img["data"])
+        pair_indices = [(index[id(img1)], index[id(img2)]) for img1, img2 in pairs]
+        
+        for chunk, evaluator in batched_evaluators(images, pair_indices, self.memory_budget, self.workspace):
+            for metric in self.metrics:
+                with stage("metric", metric=metric.__name__, pairs=len(chunk), bytes=evaluator.input.nbytes):
+                    metric_maps = evaluator.map(metric)
+                for n, position in enumerate(chunk):
+                    yield position, metric.__name__, np.mean(metric_maps[n]), metric_maps[n]
+
 class HSIResultsHandler:
     @staticmethod
     def save_results(results, output_dir, crop_num):
         Path(output_dir).mkdir(parents=True, exist_ok=True)
         save_path = Path(output_dir) / f"crop_{crop_num}_metrics.json"
-        with open(save_path, 'w') as f:
+        with stage("save", dataset=Path(output_dir).parent.name, crop=crop_num, file=save_path.name), open(save_path, 'w') as f:
             json.dump(results, f, indent=4)
     
     @staticmethod
@@ -53,10 +104,215 @@ class HSIResultsHandler:
             for pair, value in comparisons.items():
                 print(f"  {pair}: {value:.4f}")
 
-def main():
-    calculator = HSIMetricCalculator()
-    results_handler = HSIResultsHandler()
+def load_crop(calculator, data_dir, labels_config, crop_num):
+    """
+    Загружает изображения всех файлов датасета для кропа crop_num (отсутствующие пропускаются).
+    Кропы читаются из упакованного хранилища каталога (crop_store), если оно есть, иначе из .npy.
+    """
+    images = []
+    for basename, class_name in zip(labels_config["files"], labels_config["class"]):
+        file_path = crop_source(data_dir, f"{basename}_crop{crop_num}")
+        try:
+            img = calculator.load_image(file_path, class_name, crop_num)
+            images.append(img)
+        except FileNotFoundError:
+            print(f"Warning: File not found {file_path}")
+            continue
+    return images
+
+def save_band_maps(calculator, metric_map, metric_name, pair_name, crop_num, metric_maps_dir, renderer=None):
+    """Сохраняет карты каждого 5-го канала способом calculator.band_maps (renderer - фоновая запись для "fast")."""
+    vmin, vmax = calculator.metric_ranges.get(metric_name, (0, 1))
+    for channel in range(0, metric_map.shape[2], 5):
+        channel_map = metric_map[:, :, channel]
+        path = metric_maps_dir / f"crop_{crop_num}_{pair_name}_ch{channel}.png"
+        if calculator.band_maps == "fast":
+            if renderer is not None:
+                renderer.submit(path, channel_map, vmin, vmax)
+            else:
+                save_map(path, channel_map, vmin, vmax)
+        elif calculator.band_maps == "figure":
+            plt.figure(figsize=(10, 5))
+            plt.imshow(channel_map, cmap='inferno', vmin=vmin, vmax=vmax)
+            plt.colorbar()
+            plt.title(f"{metric_name} | {pair_name} | Wavelength/nm {HSI_BANDS.wavelength(channel)}")
+            plt.axis('off')
+            plt.savefig(path)
+            plt.close()
+
+def process_crops(calculator, results_handler, crops, output_dir, renderer=None, inputs=None):
+    """
+    Считает метрики для всех пар нескольких кропов батчами, затем рисует и сохраняет результаты по кропам.
+    Поканальные карты при renderer пишутся в фоне, расчет их не ждет.
+    
+    :param inputs: {номер кропа: входные файлы (crop_inputs)} - сохраняются с картами, и карты
+        кропа берутся из хранилища, только если эти файлы не изменились.
+    
+    :return: список (номер кропа, результаты метрик) в порядке crops.
+    """
+    pairs, pair_crops, pair_names, pair_slots = [], [], [], []
+    metrics_results, combined_maps, crop_pair_names = {}, {}, {}
+    for crop_num, images in crops:
+        metrics_results[crop_num] = {metric.__name__: {} for metric in calculator.metrics}
+        combined_maps[crop_num] = {metric.__name__: [] for metric in calculator.metrics}
+        crop_pair_names[crop_num] = []
+        for img1, img2 in combinations(images, 2):
+            pair_name = f"{img1['class_name']}_{img1['file_name'][:7]} vs {img2['class_name']}_{img2['file_name'][:7]}"
+            pairs.append((img1, img2))
+            pair_crops.append(crop_num)
+            pair_names.append(pair_name)
+            pair_slots.append(len(crop_pair_names[crop_num]))
+            crop_pair_names[crop_num].append(pair_name)
+
+    # Кропы, карты которых уже есть в хранилище и посчитаны по тем же входам, не пересчитываются
+    store = MapStore(Path(output_dir) / "maps", hash_contents=calculator.hash_contents)
+    metric_names = [metric.__name__ for metric in calculator.metrics]
+    inputs = inputs or {}
+    stored = {crop_num for crop_num, _ in crops
+              if calculator.reuse_maps and store.has(crop_num, metric_names, crop_pair_names[crop_num],
+                                                     inputs.get(crop_num))}
+    computed = [position for position, crop_num in enumerate(pair_crops) if crop_num not in stored]
+
+    def stored_maps():
+        for crop_num in [crop_num for crop_num, _ in crops if crop_num in stored]:
+            positions = [position for position, pair_crop in enumerate(pair_crops) if pair_crop == crop_num]
+            for metric_name in metric_names:
+                maps = store.load(crop_num, metric_name)
+                for slot, position in enumerate(positions):
+                    metric_map = np.asarray(maps[slot])
+                    yield position, metric_name, np.mean(metric_map), metric_map
+
+    computed_maps = ((computed[n], metric_name, value, metric_map) for n, metric_name, value, metric_map
+                     in calculator.compute_batched_maps([pairs[position] for position in computed]))
+
+    dataset = Path(output_dir).parent.name
+    writers = {}
+    with tracer.context(dataset=dataset, crops=[crop_num for crop_num, _ in crops]):
+        for position, metric_name, value, metric_map in chain(stored_maps(), computed_maps):
+            crop_num, pair_name = pair_crops[position], pair_names[position]
+            metrics_results[crop_num][metric_name][pair_name] = float(value)
+            if calculator.save_maps and crop_num not in stored:
+                key = (crop_num, metric_name)
+                if key not in writers:
+                    shape = (len(crop_pair_names[crop_num]),) + metric_map.shape
+                    writers[key] = store.create(crop_num, metric_name, shape, metric_map.dtype)
+                with stage("save", dataset=dataset, crop=crop_num, metric=metric_name, kind="maps", bytes=metric_map.nbytes):
+                    writers[key][pair_slots[position]] = metric_map
+            if metric_map.ndim == 3:
+                if calculator.band_maps != "none":
+                    metric_maps_dir = Path(output_dir) / "metric_maps_by_channels" / metric_name
+                    metric_maps_dir.mkdir(parents=True, exist_ok=True)
+                    # При фоновой отрисовке здесь учитывается только передача карт в пул
+                    with stage("render", dataset=dataset, crop=crop_num, metric=metric_name, kind="band_maps"):
+                        save_band_maps(calculator, metric_map, metric_name, pair_name, crop_num, metric_maps_dir, renderer)
+                metric_map = np.mean(metric_map, axis=2)
+            combined_maps[crop_num][metric_name].append((pair_name, metric_map))
+
+    for (crop_num, metric_name), maps in writers.items():
+        with stage("save", dataset=dataset, crop=crop_num, metric=metric_name, kind="maps", bytes=maps.nbytes):
+            store.finish(crop_num, metric_name, maps, crop_pair_names[crop_num],
+                         calculator.metric_ranges.get(metric_name, (0, 1)), inputs.get(crop_num))
+    if calculator.compact_maps:
+        for crop_num in sorted({crop_num for crop_num, _ in writers}):
+            with stage("save", dataset=dataset, crop=crop_num, kind="compact_maps"):
+                store.compact(crop_num)
+
+    for crop_num, images in crops:
+        num_pairs = len(images) * (len(images) - 1) // 2
+        for metric in calculator.metrics:
+            with stage("render", dataset=dataset, crop=crop_num, metric=metric.__name__, kind="combined"):
+                fig, axes = plt.subplots(1, num_pairs, figsize=(5*num_pairs, 5))
+                fig.suptitle(f"Metric: {metric.__name__} for Crop {crop_num}")
+                # Обработка случая, если axes - не массив, а одна ось
+                if num_pairs == 1:
+                    axes = [axes]  
+
+                for ax, (pair_name, metric_map) in zip(axes, combined_maps[crop_num][metric.__name__]):
+                    ax.imshow(metric_map, cmap='inferno')
+                    ax.set_title(pair_name, fontsize=8)
+                    ax.axis('off')
+                # Сохранение карты метрик на холсте
+                metric_maps_dir = Path(output_dir) / "metric_maps"
+                metric_maps_dir.mkdir(parents=True, exist_ok=True)
+                plt.colorbar(axes[0].imshow(metric_map, cmap='inferno'), ax=axes, shrink=0.8)
+                plt.savefig(metric_maps_dir / f"crop_{crop_num}_{metric.__name__}_combined.png")
+                plt.close()
+
+        results_handler.save_results(metrics_results[crop_num], output_dir, crop_num)
+    return [(crop_num, metrics_results[crop_num]) for crop_num, _ in crops]
+
+def crop_inputs(data_dir, labels_config, crop_num):
+    """Входные файлы кропа (существующие .npy всех файлов датасета или файлы хранилища кропов) для манифеста."""
+    paths = []
+    for basename in labels_config["files"]:
+        paths.extend(path for path in crop_files(data_dir, f"{basename}_crop{crop_num}") if path not in paths)
+    return paths + [Path(data_dir) / "labels.json"]
+
+def crop_outputs(output_dir, crop_num):
+    """Все файлы, записанные для кропа: JSON метрик, PNG карт и полные карты."""
+    output_dir = Path(output_dir)
+    outputs = [output_dir / f"crop_{crop_num}_metrics.json"]
+    for pattern in (f"metric_maps/crop_{crop_num}_*", f"metric_maps_by_channels/*/crop_{crop_num}_*", f"maps/crop_{crop_num}_*",
+                    f"maps/crop_{crop_num}.npz"):
+        outputs.extend(sorted(output_dir.glob(pattern)))
+    return outputs
+
+def crop_parameters(calculator):
+    """Параметры, от которых зависят результаты кропа (метрики с размерами окон, режимы карт)."""
+    return {"metrics": metric_parameters(calculator.metrics), "metric_ranges": calculator.metric_ranges,
+            "band_maps": calculator.band_maps, "save_maps": calculator.save_maps, "compact_maps": calculator.compact_maps}
+
+def cached_results(manifest, calculator, data_dir, labels_config, crop_num, output_dir):
+    """Результаты кропа из crop_{N}_metrics.json, если его входы и параметры не изменились, иначе None."""
+    if manifest is None:
+        return None
+    key = f"{data_dir}crop_{crop_num}"
+    if not manifest.lookup(key, crop_inputs(data_dir, labels_config, crop_num), crop_parameters(calculator)):
+        return None
+    with open(Path(output_dir) / f"crop_{crop_num}_metrics.json") as f:
+        return json.load(f)
+
+def record_crop(manifest, calculator, data_dir, labels_config, crop_num, output_dir):
+    if manifest is not None:
+        manifest.record(f"{data_dir}crop_{crop_num}", crop_inputs(data_dir, labels_config, crop_num),
+                        crop_parameters(calculator), crop_outputs(output_dir, crop_num))
+
+def analyse_crop(calculator, results_handler, data_dir, labels_config, crop_num, output_dir):
+    """
+    Обрабатывает один кроп в процессе пула.
     
+    :return: (вывод в stdout, результаты process_crops) - печатаются в основном процессе по порядку.
+    """
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        images = load_crop(calculator, data_dir, labels_config, crop_num)
+        inputs = {crop_num: crop_inputs(data_dir, labels_config, crop_num)}
+        results = process_crops(calculator, results_handler, [(crop_num, images)], output_dir,
+                                inputs=inputs) if images else []
+    return buffer.getvalue(), results
+
+def main(workers=1, band_maps="fast", render_workers=2, save_maps=False, reuse_maps=False, compact_maps=True,
+         force=False, hash_contents=False, cache_limit=None, trace=None, trace_memory=False, trace_top=10):
+    if trace:
+        tracer.enable(trace, memory=trace_memory)
+    calculator = HSIMetricCalculator(band_maps=band_maps, save_maps=save_maps, reuse_maps=reuse_maps,
+                                     compact_maps=compact_maps, hash_contents=hash_contents)
+    results_handler = HSIResultsHandler()
+    # Кропы с неизменными входами и параметрами берутся из результатов предыдущих запусков
+    manifest = RunManifest(Path(".analyse_cache") / "manifest.json", hash_contents=hash_contents,
+                           force=force, max_bytes=cache_limit)
+    try:
+        if workers > 1:
+            main_parallel(calculator, results_handler, workers, manifest)
+        else:
+            with MapRenderer(render_workers if band_maps == "fast" else 0) as renderer:
+                main_serial(calculator, results_handler, renderer, manifest)
+    finally:
+        manifest.evict(keep=manifest.used)
+        manifest.save()
+    tracer.summary(trace_top)
+
+def main_serial(calculator, results_handler, renderer=None, manifest=None):
     for i in range(1, 8):
         config = {
             "data_dir": f"{i}/",
@@ -70,65 +326,98 @@ def main():
         config["num_crops"] = len(labels_config['coordinates'])
         print(f'Folder: {config["data_dir"]} in progress')
         
-        for crop_num in range(1, config["num_crops"] + 1):
-            images = []
-            
-            for basename, class_name in zip(labels_config["files"], labels_config["class"]):
-                file_path = Path(config["data_dir"]) / f"{basename}_crop{crop_num}.npy"
-                try:
-                    img = calculator.load_image(str(file_path), class_name, crop_num)
-                    images.append(img)
-                except FileNotFoundError:
-                    print(f"Warning: File not found {file_path}")
-                    continue
-            
+        crop_nums = range(1, config["num_crops"] + 1)
+        cached = {crop_num: cached_results(manifest, calculator, config["data_dir"], labels_config, crop_num, config["output_dir"])
+                  for crop_num in crop_nums}
+        processed = []
+
+        def flush(crops):
+            inputs = {crop_num: crop_inputs(config["data_dir"], labels_config, crop_num) for crop_num, _ in crops}
+            for crop_num, metrics_results in process_crops(calculator, results_handler, crops, config["output_dir"],
+                                                           renderer, inputs):
+                results_handler.print_summary(metrics_results, crop_num)
+                processed.append(crop_num)
+
+        # Кропы накапливаются, пока укладываются в бюджет памяти, и считаются одним батчем
+        # Следующий кроп загружается в фоновом потоке, пока считается текущий батч
+        loaders = ((lambda: None) if cached[crop_num] is not None
+                   else partial(load_crop, calculator, config["data_dir"], labels_config, crop_num) for crop_num in crop_nums)
+        crops, loaded_bytes = [], 0
+        for crop_num, (images, error) in zip(crop_nums, prefetch(loaders)):
+            if error is not None:
+                raise error
+            if cached[crop_num] is not None:
+                flush(crops)
+                crops, loaded_bytes = [], 0
+                results_handler.print_summary(cached[crop_num], crop_num)
+                continue
             if not images:
                 continue
 
-            metrics_results = {metric.__name__: {} for metric in calculator.metrics}
+            crops.append((crop_num, images))
+            loaded_bytes += sum(img["data"].nbytes for img in images)
+            if loaded_bytes * IMAGE_WORKSPACE_CUBES >= calculator.memory_budget:
+                flush(crops)
+                crops, loaded_bytes = [], 0
 
-            pairs = list(combinations(images, 2))
-            for metric in calculator.metrics:
-                metric_name = metric.__name__
-                vmin, vmax = calculator.metric_ranges.get(metric_name, (0, 1))
-                metric_maps_dir = Path(config["output_dir"]) / "metric_maps_by_channels" / metric_name
-                metric_maps_dir.mkdir(parents=True, exist_ok=True)
-                
-                fig, axes = plt.subplots(1, len(pairs), figsize=(5*len(pairs), 5))
-                fig.suptitle(f"Metric: {metric.__name__} for Crop {crop_num}")
-                # Обработка случая, если axes - не массив, а одна ось
-                if len(pairs) == 1:
-                    axes = [axes]  
-
-                
-                for ax, (img1, img2) in zip(axes, pairs):
-                    pair_name = f"{img1['class_name']}_{img1['file_name'][:7]} vs {img2['class_name']}_{img2['file_name'][:7]}"
-                    value, metric_map = calculator.compute_metric(metric, img1, img2)
-                    metrics_results[metric_name][pair_name] = float(value)
-                    if metric_map.ndim == 3:
-                        for channel in range(0, metric_map.shape[2], 5):
-                            channel_map = metric_map[:, :, channel]
-                            plt.figure(figsize=(10, 5))
-                            plt.imshow(channel_map, cmap='inferno', vmin=vmin, vmax=vmax)
-                            plt.colorbar()
-                            plt.title(f"{metric_name} | {pair_name} | Wavelength/nm {wls['wavelength'][channel]}")
-                            plt.axis('off')
-                            plt.savefig(metric_maps_dir / f"crop_{crop_num}_{pair_name}_ch{channel}.png")
-                            plt.close()
-                        metric_map = np.mean(metric_map, axis=2)
-                    ax.imshow(metric_map, cmap='inferno')
-                    ax.set_title(pair_name, fontsize=8)
-                    ax.axis('off')
-                # Сохранение карты метрик на холсте
-                metric_maps_dir = Path(config["output_dir"]) / "metric_maps"
-                metric_maps_dir.mkdir(parents=True, exist_ok=True)
-                plt.colorbar(axes[0].imshow(metric_map, cmap='inferno'), ax=axes, shrink=0.8)
-                plt.savefig(metric_maps_dir / f"crop_{crop_num}_{metric.__name__}_combined.png")
-                plt.close()
-                    
+        flush(crops)
+        # Выходы записываются в манифест, когда фоновая отрисовка карт папки завершена
+        if renderer is not None:
+            renderer.wait()
+        for crop_num in processed:
+            record_crop(manifest, calculator, config["data_dir"], labels_config, crop_num, config["output_dir"])
 
-            results_handler.save_results(metrics_results, config["output_dir"], crop_num)
-            results_handler.print_summary(metrics_results, crop_num)
+def main_parallel(calculator, results_handler, workers, manifest=None):
+    """Распределяет задания (датасет, кроп) по процессам; вывод печатается в том же порядке, что и в main."""
+    with process_pool(workers) as executor:
+        folders = []
+        for i in range(1, 8):
+            data_dir, output_dir = f"{i}/", f"{i}/results"
+            with open(f"{i}/labels.json") as f:
+                labels_config = json.load(f)
+            
+            crops = []
+            for crop_num in range(1, len(labels_config['coordinates']) + 1):
+                cached = cached_results(manifest, calculator, data_dir, labels_config, crop_num, output_dir)
+                if cached is None:
+                    cached = executor.submit(analyse_crop, calculator, results_handler, data_dir, labels_config, crop_num, output_dir)
+                crops.append((crop_num, cached))
+            folders.append((data_dir, output_dir, labels_config, crops))
+        
+        for data_dir, output_dir, labels_config, crops in folders:
+            print(f'Folder: {data_dir} in progress')
+            for crop_num, cached in crops:
+                if isinstance(cached, dict):
+                    results_handler.print_summary(cached, crop_num)
+                    continue
+                output, results = cached.result()
+                print(output, end='')
+                for crop_num, metrics_results in results:
+                    results_handler.print_summary(metrics_results, crop_num)
+                    record_crop(manifest, calculator, data_dir, labels_config, crop_num, output_dir)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Метрики и карты метрик для кропов HSI")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Число процессов (1 - последовательно, 0 - по числу ядер)")
+    parser.add_argument("--band-maps", choices=["fast", "figure", "none"], default="fast",
+                        help="Поканальные карты: fast - PNG через таблицу цветов, figure - фигуры matplotlib, none - не сохранять")
+    parser.add_argument("--render-workers", type=int, default=2,
+                        help="Процессы для фоновой записи карт (0 - писать сразу)")
+    parser.add_argument("--save-maps", action="store_true",
+                        help="Сохранять полные карты метрик в <папка>/results/maps (рисуются потом через render.py)")
+    parser.add_argument("--reuse-maps", action="store_true",
+                        help="Брать карты из <папка>/results/maps вместо расчета, если они там есть")
+    parser.add_argument("--no-compact-maps", action="store_true",
+                        help="Не упаковывать сохраненные карты в crop_{N}.npz, оставить .npy (чтение через memmap)")
+    parser.add_argument("--force", action="store_true", help="Пересчитать все кропы, не используя прошлые результаты")
+    parser.add_argument("--hash", action="store_true",
+                        help="Сравнивать входные файлы по SHA-256 содержимого, а не по размеру и mtime")
+    parser.add_argument("--cache-limit", type=float, default=None,
+                        help="Предел объема результатов кропов на диске, МБ (LRU)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    cache_limit = int(args.cache_limit * 1024**2) if args.cache_limit is not None else None
+    main(workers=args.workers or default_workers(), band_maps=args.band_maps, render_workers=args.render_workers,
+         save_maps=args.save_maps, reuse_maps=args.reuse_maps, compact_maps=not args.no_compact_maps,
+         force=args.force, hash_contents=args.hash, cache_limit=cache_limit, trace=args.trace, trace_memory=args.trace_memory, trace_top=args.trace_top)
@@ -0,0 +1,196 @@
+import functools
+import numpy as np
+
+# Длины волн всех каналов сенсора, нм (порядок каналов в файлах ENVI).
+# Диапазоны спектрометров перекрываются (около 655-668, 1253-1263 и 1866-1872 нм),
+# поэтому близкие длины волн встречаются в таблице дважды с немного разными значениями.
+SENSOR_WAVELENGTHS = (
+    365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713,
+    443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535,
+    521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168,
+    599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561,
+    654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325,
+    733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516,
+    811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372,
+    888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895,
+    966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408,
+    1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094,
+    1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446,
+    1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464,
+    1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1322.577,
+    1332.548, 1342.519, 1352.49, 1362.46, 1372.43, 1382.4, 1392.369, 1402.339,
+    1412.308, 1422.277, 1432.245, 1442.214, 1452.182, 1462.15, 1472.118, 1482.085,
+    1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816,
+    1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568, 1641.531,
+    1651.494, 1661.458, 1671.42, 1681.383, 1691.345, 1701.307, 1711.269, 1721.231,
+    1731.192, 1741.153, 1751.114, 1761.075, 1771.036, 1780.996, 1790.956, 1800.915,
+    1810.875, 1820.834, 1830.793, 1840.752, 1850.71, 1860.669, 1870.627, 1871.784,
+    1865.964, 1876.025, 1886.085, 1896.141, 1906.196, 1916.248, 1926.298, 1936.346,
+    1946.391, 1956.435, 1966.475, 1976.514, 1986.55, 1996.584, 2006.615, 2016.645,
+    2026.672, 2036.696, 2046.719, 2056.739, 2066.756, 2076.772, 2086.785, 2096.796,
+    2106.804, 2116.81, 2126.814, 2136.816, 2146.815, 2156.812, 2166.807, 2176.799,
+    2186.789, 2196.777, 2206.762, 2216.745, 2226.726, 2236.705, 2246.681, 2256.655,
+    2266.626, 2276.595, 2286.562, 2296.527, 2306.49, 2316.449, 2326.407, 2336.363,
+    2346.316, 2356.267, 2366.215, 2376.161, 2386.105, 2396.047, 2405.986, 2415.923,
+    2425.858, 2435.79, 2445.72, 2455.648, 2465.573, 2475.496, 2485.417, 2495.336,
+)
+
+# Каналы, используемые в анализе (кропы HSI): два непрерывных отрезка каналов сенсора.
+ANALYSIS_WAVELENGTHS = (
+    365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713,
+    443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535,
+    521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168,
+    599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561,
+    654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325,
+    733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516,
+    811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372,
+    888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895,
+    966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408,
+    1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094,
+    1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446,
+    1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464,
+    1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1452.182,
+    1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918,
+    1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64,
+    1621.604, 1631.568,
+)
+
+RGB_CHANNELS = 3
+# Допуск сопоставления длин волн заголовка сцены с таблицей, нм: меньше половины
+# наименьшего расстояния между каналами в зонах перекрытия спектрометров (около 0.2 нм)
+WAVELENGTH_TOLERANCE = 0.08
+
+
+class BandSelection:
+    """
+    Выбор каналов куба (..., C) по индексам, хранимый как набор непрерывных отрезков.
+    Если отрезок один, take() возвращает представление без копии, иначе каналы
+    собираются одной записью по отрезкам в заранее выделенный (или переданный) буфер.
+    Итерация и len() - как у списка индексов.
+    """
+    def __init__(self, indices, wavelengths=None):
+        """
+        :param indices: Индексы каналов в исходном кубе, в порядке выбора.
+        :param wavelengths: Длины волн выбранных каналов (подписи карт), если известны.
+        """
+        self.indices = [int(index) for index in indices]
+        self.wavelengths = tuple(wavelengths) if wavelengths is not None else None
+        self.slices = []
+        for index in self.indices:
+            if self.slices and self.slices[-1].stop == index:
+                self.slices[-1] = slice(self.slices[-1].start, index + 1)
+            else:
+                self.slices.append(slice(index, index + 1))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    @property
+    def contiguous(self):
+        return len(self.slices) <= 1
+
+    def take(self, cube, out=None):
+        """
+        Выбранные каналы куба (..., C).
+
+        :param out: Буфер (..., len(self)) для результата (тип приводится при записи).
+        :return: Представление cube при одном отрезке и out=None, иначе out.
+        """
+        if out is None:
+            if self.contiguous and self.slices:
+                return cube[..., self.slices[0]]
+            out = np.empty(cube.shape[:-1] + (len(self),), dtype=cube.dtype)
+        position = 0
+        for band_slice in self.slices:
+            count = band_slice.stop - band_slice.start
+            out[..., position:position + count] = cube[..., band_slice]
+            position += count
+        return out
+
+    def wavelength(self, channel):
+        """Длина волны канала channel выбранного куба (для подписей), None если неизвестна."""
+        return self.wavelengths[channel] if self.wavelengths is not None else None
+
+
+@functools.lru_cache(maxsize=None)
+def _select(source, wanted):
+    first = {}
+    for index, wavelength in enumerate(source):
+        first.setdefault(wavelength, index)
+    missing = [wavelength for wavelength in wanted if wavelength not in first]
+    if missing:
+        raise ValueError(f"Wavelength(s) {missing[:5]} not found among {len(source)} sensor bands")
+    return BandSelection([first[wavelength] for wavelength in wanted], wanted)
+
+
+def select_wavelengths(source=SENSOR_WAVELENGTHS, wanted=ANALYSIS_WAVELENGTHS):
+    """
+    Каналы source с длинами волн wanted (при повторах - первое вхождение, как list.index).
+    Выбор считается за один проход и кэшируется для пары таблиц.
+
+    :param source: Длины волн каналов сцены (например, из labels.json).
+    :param wanted: Длины волн нужных каналов.
+    :return: BandSelection.
+    """
+    return _select(tuple(source), tuple(wanted))
+
+
+@functools.lru_cache(maxsize=None)
+def _select_nearest(source, wanted, tolerance):
+    source = np.asarray(source, dtype=np.float64)
+    indices = []
+    for wavelength in wanted:
+        index = int(np.argmin(np.abs(source - wavelength)))
+        if abs(source[index] - wavelength) > tolerance:
+            return None
+        indices.append(index)
+    if len(set(indices)) != len(set(wanted)):
+        return None
+    return BandSelection(indices, wanted)
+
+
+def scene_bands(wavelengths=None, wanted=ANALYSIS_WAVELENGTHS, tolerance=WAVELENGTH_TOLERANCE):
+    """
+    Каналы wanted в сцене с длинами волн из заголовка (labels.json, utils.scan_dataset_metadata).
+    Длины волн ищутся точно, затем - ближайший канал в пределах tolerance нм (разные нужные
+    каналы должны попасть в разные каналы сцены). Если и так найдены не все, выбор берется
+    по таблице сенсора SENSOR_WAVELENGTHS с предупреждением.
+
+    :param wavelengths: Длины волн каналов сцены; None - таблица сенсора.
+    :return: BandSelection.
+    """
+    if wavelengths is None:
+        return select_wavelengths(SENSOR_WAVELENGTHS, wanted)
+    try:
+        return select_wavelengths(wavelengths, wanted)
+    except ValueError:
+        pass
+    selection = _select_nearest(tuple(wavelengths), tuple(wanted), tolerance)
+    if selection is None:
+        print(f"Warning: scene wavelengths don't match the analysis bands within {tolerance} nm, "
+              f"using the sensor table")
+        selection = select_wavelengths(SENSOR_WAVELENGTHS, wanted)
+    return selection
+
+
+# Каналы анализа в сцене сенсора: каналы 0-102 и 116-134
+HSI_BANDS = select_wavelengths()
+
+
+def image_type(image):
+    """
+    Тип изображения (H, W, C) по числу каналов: 'RGB' или 'HSI' (каналы анализа).
+
+    :raises ValueError: Если изображение не 3D или число каналов не подходит.
+    """
+    if len(image.shape) != 3:
+        raise ValueError(f"Invalid image dimensions: {image.shape}. Expected 3D array (H,W,C)")
+    num_channels = image.shape[2]
+    if num_channels == RGB_CHANNELS:
+        return 'RGB'
+    if num_channels == len(HSI_BANDS):
+        return 'HSI'
+    raise ValueError(f"Unknown image type with {num_channels} channel(s). Expected 3 (RGB) or {len(HSI_BANDS)} (HSI)")
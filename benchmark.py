@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import cv2
+from scipy.ndimage import convolve
+import spectral.io.envi as envi
+from metrics import (gaussian, create_window, local_moments, box_moments,
+                     PSNR, SSIM, UQI, SAM, RMSE, stress_metric, metric_mean)
+from warp import WarpEngine, warp_crops
+from utils import open_envi_memmap, read_envi_bands
+
+# Формы из анализа: RGB-кроп, HSI-кроп и сцена целиком (сцена задается --scene)
+CROP_SHAPES = ((256, 256, 3), (256, 256, 120))
+SCENE_SHAPE = (1024, 1024, 122)
+SUITE_METRICS = (PSNR, SSIM, UQI, SAM, RMSE, stress_metric)
+# Допустимое замедление относительно базового замера (0.2 - на 20%)
+DEFAULT_THRESHOLD = 0.2
+
+
+def legacy_moments(img1, img2, window_size):
+    """Поканальные 2D-свертки, как в исходных _ssim/UQI (эталон для сравнения)."""
+    window = create_window(window_size)
+    channel = img1.shape[2]
+    mu1 = np.array([convolve(img1[:, :, c], window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0)
+    mu2 = np.array([convolve(img2[:, :, c], window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0)
+    sigma1_sq = np.array([convolve(img1[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu1 ** 2
+    sigma2_sq = np.array([convolve(img2[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu2 ** 2
+    sigma12 = np.array([convolve(img1[:, :, c] * img2[:, :, c], window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu1 * mu2
+    return mu1, mu2, sigma1_sq, sigma2_sq, sigma12
+
+
+def synthetic_pair(shape, seed=0):
+    """Пара синтетических изображений в [0, 1]: чистое и зашумленное."""
+    rng = np.random.default_rng(seed)
+    clean = rng.random(shape, dtype=np.float32)
+    noisy = np.clip(clean + 0.05 * rng.standard_normal(shape, dtype=np.float32), 0., 1.)
+    return clean, noisy
+
+
+def timeit(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_moments(size=256, channels=(3, 120), window_sizes=(8, 11), tol=1e-6):
+    for C in channels:
+        img1, img2 = synthetic_pair((size, size, C))
+        for window_size in window_sizes:
+            t_old, ref = timeit(legacy_moments, img1, img2, window_size)
+            t_new, res = timeit(local_moments, img1, img2, gaussian(window_size, 1.5))
+            err = max(float(np.max(np.abs(a - b))) for a, b in zip(ref, res))
+            status = "OK" if err < tol else "FAIL"
+            print(f"({size}, {size}, {C:3d}) window={window_size:2d}: "
+                  f"legacy {t_old:.3f}s, fused {t_new:.3f}s, "
+                  f"speedup x{t_old / t_new:.1f}, max |Δ| {err:.1e} [{status}]")
+
+
+def bench_window_types(size=512, channels=8, window_sizes=(8, 16, 32, 64)):
+    img1, img2 = synthetic_pair((size, size, channels))
+    for window_size in window_sizes:
+        t_gauss, _ = timeit(local_moments, img1, img2, gaussian(window_size, 1.5))
+        t_box, _ = timeit(box_moments, img1, img2, window_size)
+        print(f"({size}, {size}, {channels}) window={window_size:2d}: "
+              f"gaussian {t_gauss:.3f}s, box {t_box:.3f}s")
+
+
+def legacy_warp(hsi_image, H, dsize):
+    """Поканальный cv2.warpPerspective, как в исходных crop.transform/check.apply_homography_to_hsi."""
+    return np.stack([cv2.warpPerspective(hsi_image[:, :, band], H, dsize) for band in range(hsi_image.shape[2])], axis=-1)
+
+
+def bench_warp(size=1024, channels=122, workers=(1, 4)):
+    hsi_image, _ = synthetic_pair((size, size, channels))
+    H = np.array([[1.02, 0.01, 12.], [-0.015, 0.99, -7.], [1e-5, 2e-5, 1.]])
+    dsize = (size, size)
+    t_old, ref = timeit(legacy_warp, hsi_image, H, dsize)
+    for n in workers:
+        engine = WarpEngine(workers=n)
+        t_cold, _ = timeit(engine.warp, hsi_image, H, dsize, repeat=1)
+        t_warm, res = timeit(engine.warp, hsi_image, H, dsize)
+        err = float(np.max(np.abs(ref - res)))
+        print(f"({size}, {size}, {channels}) workers={n}: "
+              f"legacy {t_old:.3f}s, engine cold {t_cold:.3f}s, cached {t_warm:.3f}s, "
+              f"speedup x{t_old / t_warm:.1f}, max |Δ| {err:.1e}")
+
+
+def measure(name, shape, func, *args, repeat=3):
+    """
+    Замер одного случая: лучшее время из repeat запусков, пропускная способность
+    (мегапикселей x каналов в секунду) и пик памяти. Память считается tracemalloc в отдельном
+    запуске, чтобы не искажать время; учитываются выделения Python/numpy, буферы OpenCV - нет.
+
+    :return: Словарь результата для JSON.
+    """
+    elapsed, _ = timeit(func, *args, repeat=repeat)
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"name": name, "shape": list(shape), "time_s": elapsed,
+            "mpix_bands_per_s": np.prod(shape) / 1e6 / elapsed, "peak_mb": peak / 1024**2}
+
+
+def write_envi_scene(directory, cube):
+    """Записывает синтетическую сцену ENVI (int16, bil, scale 1000) как у исходных снимков, возвращает пути."""
+    hdr_path = os.path.join(directory, "scene_sc01_ort_img.hdr")
+    data = np.round(cube * 1000).astype(np.int16)
+    envi.save_image(hdr_path, data, dtype=np.int16, interleave='bil', ext='', force=True,
+                    metadata={'reflectance scale factor': 1000})
+    return hdr_path, hdr_path[:-len(".hdr")]
+
+
+def render_band_maps(metric_map, output_dir):
+    """Отрисовка поканальных карт как в analyse.save_band_maps (режим fast, каждый 5-й канал)."""
+    from render import save_map
+    for channel in range(0, metric_map.shape[2], 5):
+        save_map(Path(output_dir) / f"crop_1_bench_ch{channel}.png", metric_map[:, :, channel], 0, 1)
+
+
+def run_suite(scene_shape=SCENE_SHAPE, repeat=3, only=None):
+    """
+    Набор замеров на синтетических данных: метрики на кропах RGB/HSI и средние метрик на сцене,
+    чтение и вырезание кропов из ENVI, варп сцены и окон кропов (путь crop.py), отрисовка карт (analyse.py).
+
+    :param only: Подстрока имени случая (None - все случаи).
+    :return: Список результатов measure.
+    """
+    cases = []
+    for shape in CROP_SHAPES:
+        img1, img2 = synthetic_pair(shape)
+        cases += [(f"metric/{metric.__name__}", shape, metric, img1, img2) for metric in SUITE_METRICS]
+
+    scene, target = synthetic_pair(scene_shape)
+    # Полные карты сцены не помещаются в память, на сцене метрики считаются средними по блокам каналов
+    cases += [(f"metric_mean/{metric.__name__}", scene_shape, metric_mean, metric, scene, target)
+              for metric in SUITE_METRICS]
+    del target
+
+    height, width, bands = scene_shape
+    H = np.array([[1.02, 0.01, 12.], [-0.015, 0.99, -7.], [1e-5, 2e-5, 1.]])
+    coordinates = [{'x': x, 'y': y} for y in range(0, height - 255, 256) for x in range(0, width - 255, 256)][:8]
+    crop_shape = (256, 256 * len(coordinates), bands)
+    cases += [("warp/scene", scene_shape, WarpEngine().warp, scene, H, (width, height)),
+              ("warp/crops", crop_shape, warp_crops, scene, H, coordinates, height, width)]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdr_path, img_path = write_envi_scene(tmp_dir, scene)
+        del scene
+        cube, interleave, scale = open_envi_memmap(hdr_path, img_path)
+
+        def crop_envi():
+            for coords in coordinates:
+                read_envi_bands(cube, interleave, None, (coords['x'], coords['y'], 256, 256), scale)
+
+        cases += [("envi/read_scene", scene_shape, read_envi_bands, cube, interleave, None, None, scale),
+                  ("envi/crops", crop_shape, crop_envi)]
+        metric_map, _ = synthetic_pair(CROP_SHAPES[-1])
+        cases.append(("render/band_maps", CROP_SHAPES[-1][:2] + (len(range(0, CROP_SHAPES[-1][2], 5)),),
+                      render_band_maps, metric_map, tmp_dir))
+
+        for name, shape, func, *args in cases:
+            if only and only not in name:
+                continue
+            result = measure(name, shape, func, *args, repeat=repeat)
+            results.append(result)
+            print(f"{name:26s} {str(tuple(shape)):18s} {result['time_s']:8.4f}s "
+                  f"{result['mpix_bands_per_s']:9.1f} Mpix*bands/s {result['peak_mb']:8.1f} MB")
+    return results
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, min_time=1e-3):
+    """
+    Сравнивает время с базовым замером по (имя, форма).
+    Случаи быстрее min_time в базовом замере не сравниваются: их время - в пределах шума таймера.
+
+    :return: Список регрессий (имя, форма, отношение времени к базовому).
+    """
+    reference = {(item["name"], tuple(item["shape"])): item["time_s"] for item in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["name"], tuple(result["shape"]))
+        if key not in reference or reference[key] < min_time:
+            continue
+        ratio = result["time_s"] / reference[key]
+        if ratio > 1 + threshold:
+            regressions.append((result["name"], tuple(result["shape"]), ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры производительности метрик и этапов обработки")
+    parser.add_argument("--compare-legacy", action="store_true",
+                        help="Сравнить быстрые реализации с исходными (моменты, окна, варп) вместо набора замеров")
+    parser.add_argument("--scene", type=int, nargs=3, default=SCENE_SHAPE, metavar=("H", "W", "C"),
+                        help="Форма синтетической сцены")
+    parser.add_argument("--repeat", type=int, default=3, help="Число повторов, берется лучшее время")
+    parser.add_argument("--only", default=None, help="Только случаи, имя которых содержит подстроку")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON с результатами")
+    parser.add_argument("--baseline", default=None, help="JSON базового замера для сравнения")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Допустимое относительное замедление (0.2 - на 20%%)")
+    args = parser.parse_args()
+
+    if args.compare_legacy:
+        bench_moments()
+        bench_window_types()
+        bench_warp()
+        sys.exit()
+
+    results = run_suite(tuple(args.scene), args.repeat, args.only)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, shape, ratio in regressions:
+            print(f"REGRESSION {name} {shape}: x{ratio:.2f} of baseline time")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}")
@@ -2,8 +2,13 @@ import os
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-import spectral.io.envi as envi
 from PIL import Image
+from warp import WarpEngine
+from bands import HSI_BANDS
+from utils import open_envi_memmap, read_envi_bands
+from storage import save_array
+
+warp_engine = WarpEngine(workers=os.cpu_count() or 1)
 
 def load_npy_file(file_path):
     """Загружает .npy файл (гиперспектральное изображение или матрицу гомографии)."""
@@ -12,20 +17,10 @@ def load_npy_file(file_path):
 def apply_homography_to_hsi(hsi_image, H):
     """
     Применяет матрицу гомографии к гиперспектральному изображению.
-    Каждый канал трансформируется отдельно.
+    Таблицы remap считаются один раз, каналы варпятся группами по 4 (warp.WarpEngine).
     """
-    height, width, num_bands = hsi_image.shape  # Размеры HSI (H, W, C)
-    transformed_hsi = np.zeros((height, width, num_bands), dtype=hsi_image.dtype)  # Создаем пустой массив
-
-    for band in range(num_bands):
-        warped_band = cv2.warpPerspective(hsi_image[:, :, band], H, (width, height))[:,:,None]
-
-        if warped_band.shape != (height, width):  # Проверяем, что размеры совпадают
-            raise ValueError(f"Размер выходного изображения {warped_band.shape} не соответствует ожидаемому ({height}, {width})")
-
-        transformed_hsi[:, :, band] = warped_band  # Корректное присваивание
-
-    return transformed_hsi
+    height, width = hsi_image.shape[:2]  # Размеры HSI (H, W, C)
+    return warp_engine.warp(hsi_image, H, (width, height))
 
 
 def save_rgb_visualization(hsi_image, output_path, channels=(30, 20, 10)):
@@ -48,7 +43,7 @@ def save_rgb_visualization(hsi_image, output_path, channels=(30, 20, 10)):
     # Отображение изображения
     plt.imshow(rgb_image)
     plt.axis("off")
-    plt.title("RGB Визуализация")
+    plt.title("RGB Визуализация: " + ", ".join(f"{HSI_BANDS.wavelength(c):.1f} нм" for c in channels))
     plt.show()
 
 # 🔹 Параметры эксперимента
@@ -56,6 +51,8 @@ def save_rgb_visualization(hsi_image, output_path, channels=(30, 20, 10)):
 homography_path = "raw_radiance_data/Transform/3/f210402t01p00r09_sc01_RGB_transformation.npy"  # Матрица гомографии
 output_hsi_path = "raw_radiance_data/sample_hsi_aligned.npy"  # Преобразованное HSI
 output_rgb_path = "raw_radiance_data/sample_hsi_rgb.png"  # RGB-визуализация
+# Формат сохранения HSI: "float32", "uint16" (масштаб и смещение в .quant.json, вдвое меньше места) или "float16"
+output_storage = "float32"
 
 
 
@@ -67,16 +64,10 @@ img_path = "raw_radiance_data/f210402t01p00r09/f210402t01p00r09rdn_g/f210402t01p
 hdr_path = img_path + ".hdr"
 
 
-wls1 = {"wavelength": [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1322.577, 1332.548, 1342.519, 1352.49, 1362.46, 1372.43, 1382.4, 1392.369, 1402.339, 1412.308, 1422.277, 1432.245, 1442.214, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568, 1641.531, 1651.494, 1661.458, 1671.42, 1681.383, 1691.345, 1701.307, 1711.269, 1721.231, 1731.192, 1741.153, 1751.114, 1761.075, 1771.036, 1780.996, 1790.956, 1800.915, 1810.875, 1820.834, 1830.793, 1840.752, 1850.71, 1860.669, 1870.627, 1871.784, 1865.964, 1876.025, 1886.085, 1896.141, 1906.196, 1916.248, 1926.298, 1936.346, 1946.391, 1956.435, 1966.475, 1976.514, 1986.55, 1996.584, 2006.615, 2016.645, 2026.672, 2036.696, 2046.719, 2056.739, 2066.756, 2076.772, 2086.785, 2096.796, 2106.804, 2116.81, 2126.814, 2136.816, 2146.815, 2156.812, 2166.807, 2176.799, 2186.789, 2196.777, 2206.762, 2216.745, 2226.726, 2236.705, 2246.681, 2256.655, 2266.626, 2276.595, 2286.562, 2296.527, 2306.49, 2316.449, 2326.407, 2336.363, 2346.316, 2356.267, 2366.215, 2376.161, 2386.105, 2396.047, 2405.986, 2415.923, 2425.858, 2435.79, 2445.72, 2455.648, 2465.573, 2475.496, 2485.417, 2495.336]}
-
-wls2 = {"wavelength": [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568]}
-
-lst_idx = [wls1['wavelength'].index(i) for i in wls2['wavelength']]
-
-# Читаем гиперспектральное изображение
-hsi_image = envi.open(hdr_path, img_path).load()
 
-hsi_image = hsi_image[..., lst_idx]
+# Читаем только каналы анализа (отрезки каналов сенсора, без копии всего куба)
+cube, interleave, scale = open_envi_memmap(hdr_path, img_path)
+hsi_image = read_envi_bands(cube, interleave, HSI_BANDS, scale=scale)
 
 H = load_npy_file(homography_path)
 
@@ -84,8 +75,11 @@ H = load_npy_file(homography_path)
 aligned_hsi = apply_homography_to_hsi(hsi_image, H)
 
 # 🔹 Сохраняем преобразованное HSI
-np.save(output_hsi_path, aligned_hsi)
+quantization = save_array(output_hsi_path, aligned_hsi, output_storage)
 print(f"✅ Преобразованное HSI сохранено: {output_hsi_path}")
+if quantization is not None:
+    print(f"   {output_storage}: scale={quantization['scale']:.6g}, offset={quantization['offset']:.6g}, "
+          f"макс. ошибка {quantization['max_error']:.4g}")
 
 # 🔹 Создаем и сохраняем RGB-визуализацию
 save_rgb_visualization(aligned_hsi, output_rgb_path, channels=(37, 19, 7))
@@ -1,51 +1,106 @@
+import argparse
 import os
 import numpy as np
 import cv2
 import spectral.io.envi as envi
 from utils import * 
-
-def load(hdr_path, img_path):
-    hsi_image = envi.open(hdr_path, img_path).load()
+from bands import scene_bands
+from warp import WarpEngine
+from manifest import RunManifest
+from crop_store import CropStore, NpyCropWriter
+from storage import STORAGE_FORMATS, quantize
+from aligned_cache import AlignedCache, ALIGNED_CACHE_BYTES
+from instrument import tracer, stage, add_trace_arguments
+
+warp_engine = WarpEngine(workers=os.cpu_count() or 1)
+
+def load(hdr_path, img_path, bands=None):
+    """Читает через memmap только каналы bands, не загружая куб целиком."""
+    with stage("load", file=os.path.basename(img_path)):
+        cube, interleave, scale = open_envi_memmap(hdr_path, img_path)
+    with stage("band_select", bands=len(bands) if bands is not None else None) as record:
+        hsi_image = read_envi_bands(cube, interleave, bands, scale=scale)
+        record["bytes"] = hsi_image.nbytes
     return hsi_image
 
 def load_transform_matrix(path_npy):
     H = np.load(path_npy)
     return H
 
-def transform(hsi_image, transform_matrix, height, width):
+def transform(hsi_image, transform_matrix, height, width, out=None):
     """
     Применяет матрицу гомографии к гиперспектральному изображению.
-    Каждый канал трансформируется отдельно.
-    """
-    _, _, num_bands = hsi_image.shape  # Размеры HSI (H, W, C)
-    transformed_hsi = np.zeros((height, width, num_bands), dtype=hsi_image.dtype)  # Создаем пустой массив
-
-    for band in range(num_bands):
-        warped_band = cv2.warpPerspective(hsi_image[:, :, band], transform_matrix, (width, height))
-
-        if warped_band.shape != (height, width):  # Проверяем, что размеры совпадают
-            raise ValueError(f"Размер выходного изображения {warped_band.shape} не соответствует ожидаемому ({height}, {width})")
+    Таблицы remap считаются один раз, каналы варпятся группами по 4 (warp.WarpEngine).
 
-        transformed_hsi[:, :, band] = warped_band  # Корректное присваивание
-
-    return transformed_hsi
-
-def save_crop(hsi_image_crop, fname):
-    np.save(fname, hsi_image_crop)
+    :param out: Массив (height, width, C) для результата, например memmap записи кэша выровненных сцен.
+    """
+    with stage("warp", bytes=hsi_image.nbytes):
+        return warp_engine.warp(hsi_image, transform_matrix, (width, height), out=out)
 
-def crop(hsi_image, coordinates, fname):
+def save_crop(writer, hsi_image_crop, file, classe, idx, coords):
+    """
+    Дописывает кроп в хранилище датасета (или в {file}_crop{N}.npy при раскладке npy)
+    в формате args.storage (storage.quantize).
+    """
+    name = file + f'_crop{idx+1}'
+    with stage("save", file=name) as record:
+        data, quantization = quantize(hsi_image_crop, args.storage)
+        writer.add(data, name, scene=file, classe=classe, crop=idx+1, x=coords['x'], y=coords['y'],
+                   quantization=quantization)
+        record["bytes"] = data.nbytes
+
+def crop(hsi_image, coordinates, writer, file, classe):
     for idx, coords in enumerate(coordinates):
         x, y = coords['x'], coords['y']
-        save_crop(hsi_image[y:y+256, x:x+256, :], fname + f'_crop{idx+1}')  
-
-
-
-wls1 = {"wavelength": [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1322.577, 1332.548, 1342.519, 1352.49, 1362.46, 1372.43, 1382.4, 1392.369, 1402.339, 1412.308, 1422.277, 1432.245, 1442.214, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568, 1641.531, 1651.494, 1661.458, 1671.42, 1681.383, 1691.345, 1701.307, 1711.269, 1721.231, 1731.192, 1741.153, 1751.114, 1761.075, 1771.036, 1780.996, 1790.956, 1800.915, 1810.875, 1820.834, 1830.793, 1840.752, 1850.71, 1860.669, 1870.627, 1871.784, 1865.964, 1876.025, 1886.085, 1896.141, 1906.196, 1916.248, 1926.298, 1936.346, 1946.391, 1956.435, 1966.475, 1976.514, 1986.55, 1996.584, 2006.615, 2016.645, 2026.672, 2036.696, 2046.719, 2056.739, 2066.756, 2076.772, 2086.785, 2096.796, 2106.804, 2116.81, 2126.814, 2136.816, 2146.815, 2156.812, 2166.807, 2176.799, 2186.789, 2196.777, 2206.762, 2216.745, 2226.726, 2236.705, 2246.681, 2256.655, 2266.626, 2276.595, 2286.562, 2296.527, 2306.49, 2316.449, 2326.407, 2336.363, 2346.316, 2356.267, 2366.215, 2376.161, 2386.105, 2396.047, 2405.986, 2415.923, 2425.858, 2435.79, 2445.72, 2455.648, 2465.573, 2475.496, 2485.417, 2495.336]}
-
-wls2 = {"wavelength": [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 1312.606, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 1621.604, 1631.568]}
+        with stage("crop", crop=idx+1):
+            hsi_image_crop = np.ascontiguousarray(hsi_image[y:y+256, x:x+256, :])
+        save_crop(writer, hsi_image_crop, file, classe, idx, coords)
+
+def crop_envi(hdr_path, img_path, coordinates, writer, file, classe, bands=None):
+    """Вырезает кропы прямо из файла ENVI: читаются только окна 256x256 и каналы bands."""
+    with stage("load", file=os.path.basename(img_path)):
+        cube, interleave, scale = open_envi_memmap(hdr_path, img_path)
+    for idx, coords in enumerate(coordinates):
+        window = (coords['x'], coords['y'], 256, 256)
+        # Окно и каналы читаются из файла одним проходом: это и кроп, и выбор каналов
+        with stage("crop", crop=idx+1) as record:
+            hsi_image_crop = read_envi_bands(cube, interleave, bands, window, scale)
+            record["bytes"] = hsi_image_crop.nbytes
+        save_crop(writer, hsi_image_crop, file, classe, idx, coords)
+
+
+
+parser = argparse.ArgumentParser(description="Вырезание кропов из сцен ENVI")
+parser.add_argument("--force", action="store_true", help="Пересоздать все кропы")
+parser.add_argument("--hash", action="store_true",
+                    help="Сравнивать входные файлы по SHA-256 содержимого, а не по размеру и mtime")
+parser.add_argument("--layout", choices=["packed", "npy"], default="packed",
+                    help="packed - все кропы датасета в crops.bin/crops.json (crop_store.py), npy - файл на кроп")
+parser.add_argument("--storage", choices=STORAGE_FORMATS, default="float32",
+                    help="Формат кропов: uint16 (масштаб и смещение; целая радиометрия - без потерь) или float16 "
+                         "занимают вдвое меньше места")
+parser.add_argument("--aligned-cache", action="store_true",
+                    help="Хранить выровненные чистые сцены на диске (Transform/.aligned_cache, float32 всей сцены "
+                         "на каждую чистую сцену), чтобы кропы с новыми координатами вырезались без варпа")
+parser.add_argument("--aligned-cache-limit", type=float, default=ALIGNED_CACHE_BYTES / 1024**2,
+                    help="Предел объема кэша выровненных сцен, МБ (LRU)")
+add_trace_arguments(parser)
+args, _ = parser.parse_known_args()
+if args.trace:
+    tracer.enable(args.trace, memory=args.trace_memory)
 
-lst_idx = [wls1['wavelength'].index(i) for i in wls2['wavelength']]
 work_dir = "Transform/"
+# True - варпятся только окна кропов (WarpEngine.warp_crops), False - вся сцена, затем кроп;
+# оба режима и кэш выровненных сцен дают побитно одинаковые кропы (общие карты remap warp.remap_tables)
+CROP_ONLY_WARP = True
+# С --aligned-cache выровненные чистые сцены (выбор каналов и варп всей сцены) хранятся на диске:
+# при новых координатах кропы вырезаются из memmap без загрузки и варпа. Без кэша - режим CROP_ONLY_WARP
+aligned_cache = None
+if args.aligned_cache:
+    aligned_cache = AlignedCache(work_dir + ".aligned_cache", max_bytes=int(args.aligned_cache_limit * 1024**2),
+                                 hash_contents=args.hash, force=args.force)
+# Кропы файла пересоздаются, только если изменились сцена, гомография или параметры вырезания
+manifest = RunManifest(work_dir + "crop_manifest.json", hash_contents=args.hash, force=args.force)
 for i in range(7):
     json_path = work_dir + f"{i+1}/labels.json"
     labels = load_labels(json_path)
@@ -55,7 +110,13 @@ for i in range(7):
     coordinates = [row[0] for row in labels['coordinates']]
     print(coordinates)
     height, width = labels['height'], labels['width']
+    # Длины волн сцены из labels.json (utils.scan_dataset_metadata), иначе - таблица сенсора;
+    # выбор каналов анализа - отрезки каналов (bands.BandSelection), без копии всего куба
+    bands = scene_bands(labels.get('wavelength'))
     
+    dataset_dir = work_dir + f"{i+1}/"
+    store = CropStore(dataset_dir)
+    jobs = []
     for file, classe in zip(files, classes):
         find_way  = find_deepest_directory(file)
         files_lst = os.listdir(find_way)
@@ -64,16 +125,69 @@ for i in range(7):
         img_path = os.path.join(find_way, finded_files[0])
         hdr_path = os.path.join(find_way, finded_files[1])
 
-        
+        inputs = [img_path, hdr_path]
         if classe == 'clean':
-            print(file)
-            hsi_image = load(hdr_path, img_path)[...,lst_idx]
-            print(hsi_image.shape)
-
-            transform_lst = find_matching_files(os.listdir(work_dir + f"{i+1}/"), file, 'sc01_transformation')
-            H = load_transform_matrix(work_dir + f"{i+1}/" + transform_lst[0])
-            transformed_hsi = transform(hsi_image, H, height, width)
-            crop(transformed_hsi, coordinates, work_dir + f"{i+1}/"+ file)
+            transform_lst = find_matching_files(os.listdir(dataset_dir), file, 'sc01_transformation')
+            inputs.append(dataset_dir + transform_lst[0])
+        params = {"coordinates": coordinates, "bands": bands.indices, "height": height, "width": width,
+                  "class": classe, "crop_only_warp": CROP_ONLY_WARP, "layout": args.layout, "storage": args.storage}
+        if args.layout == "packed":
+            outputs = store.files()
         else:
-            hsi_image = load(hdr_path, img_path)[...,lst_idx]
-            crop(hsi_image, coordinates, work_dir + f"{i+1}/"+ file)
\ No newline at end of file
+            outputs = [dataset_dir + file + f'_crop{idx+1}.npy' for idx in range(len(coordinates))]
+        key = f"{i+1}/{file}"
+        fresh = manifest.lookup(key, inputs, params) is not None
+        if fresh and args.layout == "packed":
+            # Кропы файла должны быть в хранилище (его могли пересобрать через crop_store.py)
+            fresh = all(store.get(file + f'_crop{idx+1}') is not None for idx in range(len(coordinates)))
+        if fresh:
+            print(f"{file}: crops are up to date")
+        jobs.append((file, classe, img_path, hdr_path, inputs, params, outputs, key, fresh))
+
+    if all(job[-1] for job in jobs):
+        continue
+
+    # Хранилище датасета пишется заново одним проходом: кропы неизмененных файлов переносятся из прежнего
+    writer = store.writer() if args.layout == "packed" else NpyCropWriter(dataset_dir)
+    with writer, tracer.context(dataset=str(i+1)):
+        for file, classe, img_path, hdr_path, inputs, params, outputs, key, fresh in jobs:
+            if fresh:
+                if args.layout == "packed":
+                    for idx in range(len(coordinates)):
+                        writer.copy(store.get(file + f'_crop{idx+1}'))
+                continue
+
+            if classe == 'clean' and aligned_cache is not None:
+                print(file)
+                def build(H, out):
+                    hsi_image = load(hdr_path, img_path, bands)
+                    print(hsi_image.shape)
+                    transform(hsi_image, H, height, width, out=out)
+
+                transformed_hsi, cached = aligned_cache.get(img_path, hdr_path, inputs[2], bands, height, width, build)
+                if cached:
+                    print(f"{file}: aligned scene from cache")
+                crop(transformed_hsi, coordinates, writer, file, classe)
+            elif classe == 'clean':
+                print(file)
+                hsi_image = load(hdr_path, img_path, bands)
+                print(hsi_image.shape)
+
+                H = load_transform_matrix(inputs[2])
+                if CROP_ONLY_WARP:
+                    with stage("warp", bytes=hsi_image.nbytes, crops=len(coordinates)):
+                        hsi_image_crops = warp_engine.warp_crops(hsi_image, H, coordinates, height, width)
+                    for idx, hsi_image_crop in enumerate(hsi_image_crops):
+                        save_crop(writer, hsi_image_crop, file, classe, idx, coordinates[idx])
+                else:
+                    transformed_hsi = transform(hsi_image, H, height, width)
+                    crop(transformed_hsi, coordinates, writer, file, classe)
+            else:
+                crop_envi(hdr_path, img_path, coordinates, writer, file, classe, bands)
+
+    for file, classe, img_path, hdr_path, inputs, params, outputs, key, fresh in jobs:
+        if not fresh:
+            manifest.record(key, inputs, params, outputs)
+    manifest.save()
+
+tracer.summary(args.trace_top)
@@ -0,0 +1,335 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import numpy as np
+from storage import quant_path, read_quantization, save_npy
+
+# Файлы упакованного хранилища кропов в каталоге датасета
+STORE_DATA = "crops.bin"
+STORE_INDEX = "crops.json"
+# Выравнивание начала каждого кропа в файле данных, байт
+ALIGNMENT = 64
+
+
+def parse_crop_name(stem):
+    """
+    Имя файла кропа старой раскладки: '{сцена}_crop{N}' (crop.py, analyse.py) или
+    '{сцена}_crop{N}_{класс}' (metrics_run.py).
+
+    :return: (сцена, номер кропа, класс или None); None, если имя не похоже на кроп.
+    """
+    if "_crop" not in stem:
+        return None
+    scene, rest = stem.rsplit("_crop", 1)
+    number, _, classe = rest.partition("_")
+    if not number.isdigit():
+        return None
+    return scene, int(number), classe or None
+
+
+class StoredCrop:
+    """
+    Кроп из CropStore. Ведет себя как путь к файлу кропа старой раскладки
+    ({каталог}/{имя}.npy): имя, stem, parent, str() и os.fspath() дают этот путь, поэтому
+    его можно использовать в отчетах и как ключ кэшей; сами данные - array().
+    """
+    def __init__(self, store, entry):
+        self.store = store
+        self.entry = entry
+        self.path = store.root / f"{entry['name']}.npy"
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def stem(self):
+        return self.path.stem
+
+    @property
+    def parent(self):
+        return self.path.parent
+
+    @property
+    def quantization(self):
+        """Описание квантования (storage.quantize) или None, если кроп хранится как есть."""
+        return self.entry.get("quantization")
+
+    def array(self):
+        """
+        Представление кропа в файле хранилища (memmap только для чтения, без копии);
+        квантованный кроп - в формате хранения, значения дает storage.dequantize.
+        """
+        return self.store.view(self.entry)
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return f"StoredCrop({str(self.path)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, StoredCrop) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __lt__(self, other):
+        return self.path < other.path
+
+
+class CropStore:
+    """
+    Кропы датасета в одном файле: данные всех кропов подряд в crops.bin (каждый с
+    выравниванием ALIGNMENT байт) и индекс crops.json - имя кропа в старой раскладке,
+    сцена, класс, номер кропа, координаты, тип, форма и смещение в файле данных.
+    Файл данных открывается одним memmap на процесс, кропы читаются как представления
+    без копии. Индекс пишется после данных: его наличие означает, что хранилище записано
+    целиком. Раскладка с отдельными .npy на кроп остается форматом импорта (pack) и
+    экспорта (export).
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = self.root / STORE_INDEX
+        self.data_path = self.root / STORE_DATA
+        self._entries = None
+        self._names = None
+        self._raw = None
+
+    def __getstate__(self):
+        # memmap не передается в процессы пула, там файл открывается заново
+        return {"root": self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state["root"])
+
+    def exists(self):
+        return self.index_path.exists()
+
+    def files(self):
+        """Файлы хранилища (для манифестов)."""
+        return [self.index_path, self.data_path]
+
+    def entries(self):
+        """Описания кропов в порядке записи."""
+        if self._entries is None:
+            with open(self.index_path, encoding='utf-8') as f:
+                self._entries = json.load(f)["crops"]
+        return self._entries
+
+    def crops(self):
+        return [StoredCrop(self, entry) for entry in self.entries()]
+
+    def get(self, name):
+        """Кроп с именем name старой раскладки (без .npy) или None."""
+        if self._names is None:
+            self._names = {entry["name"]: entry for entry in self.entries()}
+        entry = self._names.get(name)
+        return StoredCrop(self, entry) if entry is not None else None
+
+    def view(self, entry):
+        if self._raw is None:
+            self._raw = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        raw = self._raw[entry["offset"]:entry["offset"] + nbytes]
+        return raw.view(dtype).reshape(entry["shape"])
+
+    def close(self):
+        self._raw = None
+        self._entries = None
+        self._names = None
+
+    def writer(self):
+        """CropStoreWriter для записи нового содержимого хранилища (старое доступно до close())."""
+        return CropStoreWriter(self)
+
+    def export(self, output_dir=None):
+        """
+        Записывает кропы отдельными .npy старой раскладки ({имя}.npy), квантованные - с описанием
+        квантования рядом (storage.save_npy). :return: Список путей.
+        """
+        output_dir = Path(output_dir) if output_dir is not None else self.root
+        output_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for crop in self.crops():
+            paths.append(output_dir / crop.name)
+            save_npy(paths[-1], crop.array(), crop.quantization)
+        return paths
+
+    def pack(self, paths=None, labels=None):
+        """
+        Упаковывает .npy старой раскладки в хранилище за один проход.
+
+        :param paths: Файлы кропов (None - все *_crop*.npy каталога хранилища).
+        :param labels: labels.json датасета (dict): классы файлов и координаты кропов, если в имени их нет.
+        :return: Число упакованных кропов.
+        """
+        if paths is None:
+            paths = sorted(self.root.glob("*_crop*.npy"))
+        classes = dict(zip(labels["files"], labels["class"])) if labels else {}
+        coordinates = [row[0] for row in labels["coordinates"]] if labels else []
+        count = 0
+        with self.writer() as writer:
+            for path in paths:
+                parsed = parse_crop_name(Path(path).stem)
+                if parsed is None:
+                    continue
+                scene, crop_num, classe = parsed
+                coords = coordinates[crop_num - 1] if 0 < crop_num <= len(coordinates) else {}
+                writer.add(np.load(path, mmap_mode='r'), Path(path).stem, scene=scene,
+                           classe=classe or classes.get(scene), crop=crop_num, x=coords.get('x'), y=coords.get('y'),
+                           quantization=read_quantization(path))
+                count += 1
+        return count
+
+
+class CropStoreWriter:
+    """
+    Потоковая запись хранилища: кропы дописываются во временный файл данных по мере
+    вырезания, при закрытии файл данных заменяет прежний, затем записывается индекс.
+    При ошибке внутри with прежнее хранилище не меняется.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.store.root.mkdir(parents=True, exist_ok=True)
+        self._tmp_path = store.data_path.with_suffix(".bin.tmp")
+        self._file = open(self._tmp_path, 'wb')
+        self.entries = []
+        self.offset = 0
+
+    def add(self, array, name, scene=None, classe=None, crop=None, x=None, y=None, quantization=None):
+        """
+        Дописывает кроп.
+
+        :param name: Имя кропа в старой раскладке (без .npy), например '{сцена}_crop{N}'.
+        :param classe: Класс сцены ('clean', 'hazed', ...).
+        :param x: Координаты кропа в сцене (левый верхний угол).
+        :param quantization: Описание квантования array (storage.quantize), если он в компактном формате.
+        """
+        array = np.ascontiguousarray(array)
+        padding = -self.offset % ALIGNMENT
+        self._file.write(b"\0" * padding)
+        self.offset += padding
+        self._file.write(array.reshape(-1).view(np.uint8).data)
+        self.entries.append({"name": name, "scene": scene, "class": classe, "crop": crop, "x": x, "y": y,
+                             "dtype": array.dtype.str, "shape": list(array.shape), "offset": self.offset})
+        if quantization is not None:
+            self.entries[-1]["quantization"] = quantization
+        self.offset += array.nbytes
+
+    def copy(self, crop):
+        """Переносит кроп прежнего хранилища (StoredCrop) без изменений."""
+        entry = crop.entry
+        self.add(crop.array(), entry["name"], entry["scene"], entry["class"], entry["crop"], entry["x"], entry["y"],
+                 crop.quantization)
+
+    def close(self):
+        self._file.close()
+        self.store.close()
+        os.replace(self._tmp_path, self.store.data_path)
+        tmp_path = self.store.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"data": STORE_DATA, "bytes": self.offset, "crops": self.entries}, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.store.index_path)
+
+    def abort(self):
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class NpyCropWriter:
+    """Запись кропов старой раскладкой ({каталог}/{имя}.npy) с тем же интерфейсом, что у CropStoreWriter."""
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def add(self, array, name, quantization=None, **meta):
+        save_npy(self.root / f"{name}.npy", array, quantization)
+
+    def copy(self, crop):
+        self.add(crop.array(), crop.entry["name"], crop.quantization)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+# Открытые хранилища: каталог -> (mtime индекса, CropStore); файл данных открывается один раз на процесс
+_stores = {}
+
+
+def open_store(root):
+    """CropStore каталога root или None, если в нем нет упакованных кропов."""
+    store = CropStore(root)
+    if not store.exists():
+        _stores.pop(str(store.root), None)
+        return None
+    # Перезаписанное хранилище (другой mtime индекса) открывается заново и заменяет прежнее
+    mtime = store.index_path.stat().st_mtime_ns
+    cached = _stores.get(str(store.root))
+    if cached is None or cached[0] != mtime:
+        _stores[str(store.root)] = cached = (mtime, store)
+    return cached[1]
+
+
+def crop_source(root, name):
+    """Кроп name (без .npy) каталога root: StoredCrop из хранилища, если оно есть, иначе путь к .npy."""
+    store = open_store(root)
+    crop = store.get(name) if store is not None else None
+    return crop if crop is not None else Path(root) / f"{name}.npy"
+
+
+def crop_files(root, name):
+    """Файлы на диске, от которых зависит кроп name (для манифестов): файлы хранилища или .npy, если он есть."""
+    store = open_store(root)
+    if store is not None and store.get(name) is not None:
+        return store.files()
+    path = Path(root) / f"{name}.npy"
+    return [file for file in (path, quant_path(path)) if file.exists()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Упаковка кропов датасета в одно хранилище и обратно в .npy")
+    parser.add_argument("command", choices=["pack", "export", "list"],
+                        help="pack - *_crop*.npy каталога в crops.bin/crops.json, export - обратно в .npy, list - индекс")
+    parser.add_argument("root", help="Каталог датасета")
+    parser.add_argument("--labels", default=None, help="labels.json с классами и координатами (по умолчанию из каталога)")
+    parser.add_argument("--out", default=None, help="Каталог для export (по умолчанию - каталог датасета)")
+    parser.add_argument("--remove", action="store_true",
+                        help="Удалить исходные .npy (и их *.quant.json) после pack")
+    args = parser.parse_args()
+    store = CropStore(args.root)
+
+    if args.command == "pack":
+        labels_path = Path(args.labels) if args.labels else store.root / "labels.json"
+        labels = None
+        if labels_path.exists():
+            with open(labels_path, encoding='utf-8') as f:
+                labels = json.load(f)
+        paths = [path for path in sorted(store.root.glob("*_crop*.npy")) if parse_crop_name(path.stem)]
+        count = store.pack(paths, labels)
+        if args.remove:
+            for path in paths:
+                path.unlink()
+                quant_path(path).unlink(missing_ok=True)
+        print(f"{count} crop(s) packed into {store.data_path}")
+    elif args.command == "export":
+        print(f"{len(store.export(args.out))} crop(s) exported")
+    else:
+        for entry in store.entries():
+            print(f"{entry['name']:40s} {entry['class'] or '-':8s} {str(tuple(entry['shape'])):18s} {entry['dtype']}")
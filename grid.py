@@ -0,0 +1,216 @@
+import argparse
+import csv
+import os
+from pathlib import Path
+import numpy as np
+from utils import EnviScene, find_deepest_directory, find_matching_files, load_labels, open_envi_memmap, read_envi_bands
+from bands import scene_bands
+from metrics import ACCUM_DTYPE, BAND_SEPARABLE, DEFAULT_MEMORY_BUDGET, stress_metric, _stress
+from tiled import TILED_METRICS, TiledEvaluator
+from warp import WarpEngine
+from render import save_map
+from instrument import tracer, stage, add_trace_arguments
+from aligned_cache import AlignedCache, ALIGNED_CACHE_BYTES
+
+# Размер клетки тепловой карты в PNG, пикселей
+HEATMAP_CELL = 16
+
+
+def summed_area_table(values):
+    """Таблица интегральных сумм (H + 1, W + 1) карты (H, W) в float64 с нулевой первой строкой и столбцом."""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=ACCUM_DTYPE)
+    np.cumsum(values, axis=0, dtype=ACCUM_DTYPE, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def window_origins(height, width, size, stride):
+    """Левые верхние углы (y, x) окон size×size, целиком лежащих в изображении, с шагом stride."""
+    return np.arange(0, height - size + 1, stride), np.arange(0, width - size + 1, stride)
+
+
+def window_sums(table, ys, xs, size):
+    """Суммы карты по окнам size×size с углами ys × xs по ее таблице интегральных сумм: (len(ys), len(xs))."""
+    y0, x0 = np.ix_(ys, xs)
+    return table[y0 + size, x0 + size] - table[y0, x0 + size] - table[y0 + size, x0] + table[y0, x0]
+
+
+class DenseGrid:
+    """
+    Метрики всех окон size×size сцены с шагом stride за один проход по сцене: карты метрик
+    считаются фрагментами (tiled.TiledEvaluator), от каждой остается только среднее по каналам
+    (H, W) в float64, а среднее по окну берется из таблицы интегральных сумм этой карты за O(1).
+    Для stress_metric так же накапливаются квадраты норм и скалярные произведения спектров.
+
+    Значение окна - среднее карты сцены по окну, а не метрика вырезанного кропа: SSIM/UQI
+    у края окна считаются по соседним пикселям сцены (у кропа - по нулевому дополнению),
+    PSNR - с максимумами каналов всей сцены.
+    """
+    def __init__(self, size=256, stride=128, metrics=TILED_METRICS, memory_budget=DEFAULT_MEMORY_BUDGET, scale=None):
+        """
+        :param size: Сторона окна (как у кропов).
+        :param stride: Шаг окон.
+        :param scale: Нормализация сцен (/ scale с обрезкой в [0, 1]).
+        """
+        self.size = size
+        self.stride = stride
+        self.metrics = list(metrics)
+        self.evaluator = TiledEvaluator(self.metrics, memory_budget, scale=scale)
+
+    def evaluate(self, input, target):
+        """
+        :param input: Сцена (H, W, C): массив, memmap или utils.EnviScene (читается фрагментами).
+        :param target: Сцена той же формы.
+        :return: (ys, xs, {имя метрики: сетка (len(ys), len(xs))}).
+        """
+        H, W = input.shape[:2]
+        ys, xs = window_origins(H, W, self.size, self.stride)
+        if not len(ys) or not len(xs):
+            raise ValueError(f"Scene {H}x{W} is smaller than the window {self.size}")
+        map_metrics = [metric for metric in self.metrics if metric is not stress_metric]
+        band_means = {metric.__name__: np.empty((H, W), dtype=ACCUM_DTYPE) for metric in map_metrics}
+        if stress_metric in self.metrics:
+            spectral = [np.empty((H, W), dtype=ACCUM_DTYPE) for _ in range(3)]
+
+        for index, core, inner, evaluator in self.evaluator.tiles(input, target):
+            for metric in map_metrics:
+                with stage("metric", metric=metric.__name__, tile=index, bytes=evaluator.input.nbytes):
+                    metric_map = evaluator.map(metric)[inner]
+                    if metric in BAND_SEPARABLE:
+                        np.mean(metric_map, axis=-1, dtype=ACCUM_DTYPE, out=band_means[metric.__name__][core])
+                    else:
+                        band_means[metric.__name__][core] = metric_map
+            if stress_metric in self.metrics:
+                with stage("metric", metric="stress_metric", tile=index, bytes=evaluator.input.nbytes):
+                    norm_x, norm_y = evaluator.spectral_norms()
+                    for values, out in zip((norm_x, norm_y, evaluator.dot_product()), spectral):
+                        out[core] = values[inner]
+
+        grids = {}
+        area = self.size * self.size
+        for metric in self.metrics:
+            with stage("grid", metric=metric.__name__):
+                if metric is stress_metric:
+                    sums = [window_sums(summed_area_table(values), ys, xs, self.size) for values in spectral]
+                    grids[metric.__name__] = _stress(*sums)
+                else:
+                    grids[metric.__name__] = window_sums(summed_area_table(band_means.pop(metric.__name__)),
+                                                         ys, xs, self.size) / area
+        return ys, xs, grids
+
+
+def save_grid(path, ys, xs, grids):
+    """CSV сетки: строка на окно - координаты левого верхнего угла (x, y) и значения метрик."""
+    names = list(grids)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["x", "y"] + names)
+        for row, y in enumerate(ys):
+            for col, x in enumerate(xs):
+                writer.writerow([int(x), int(y)] + [f"{grids[name][row, col]:.6f}" for name in names])
+
+
+def save_heatmaps(output_dir, prefix, grids, cell=HEATMAP_CELL):
+    """Тепловые карты сеток в PNG: {prefix}_{метрика}.png, клетка окна - cell×cell пикселей."""
+    for name, grid in grids.items():
+        vmin, vmax = float(np.nanmin(grid)), float(np.nanmax(grid))
+        image = np.repeat(np.repeat(grid, cell, axis=0), cell, axis=1)
+        save_map(Path(output_dir) / f"{prefix}_{name}.png", image, vmin, vmax if vmax > vmin else vmin + 1)
+
+
+def load(hdr_path, img_path, bands):
+    """Каналы bands сцены ENVI (float32, с учетом reflectance scale factor)."""
+    with stage("load", file=os.path.basename(img_path)) as record:
+        cube, interleave, scale = open_envi_memmap(hdr_path, img_path)
+        hsi_image = read_envi_bands(cube, interleave, bands, scale=scale)
+        record["bytes"] = hsi_image.nbytes
+    return hsi_image
+
+
+def reference_scene(labels, references=None):
+    """
+    Чистая сцена датасета, с которой сравниваются сцены с дымкой.
+
+    :param references: Имена сцен, допустимых как опорные (--reference); None - любая чистая.
+    :return: Имя сцены или None, если подходящей чистой сцены нет.
+    """
+    candidates = [file for file, classe in zip(labels["files"], labels["class"])
+                  if classe == 'clean' and (references is None or file in references)]
+    if len(candidates) > 1:
+        raise ValueError(f"Several clean scenes {candidates} can be the reference: choose one with --reference")
+    return candidates[0] if candidates else None
+
+
+def find_scene(file):
+    """Пути (hdr, img) сцены file, как в crop.py."""
+    find_way = find_deepest_directory(file)
+    finded_files = sorted(find_matching_files(os.listdir(find_way), file))
+    return os.path.join(find_way, finded_files[1]), os.path.join(find_way, finded_files[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сетка метрик всех окон сцены (hazed против выровненной clean)")
+    parser.add_argument("--work-dir", default="Transform/", help="Каталог датасетов с labels.json (как в crop.py)")
+    parser.add_argument("--datasets", type=int, nargs="*", default=list(range(1, 8)), help="Номера датасетов")
+    parser.add_argument("--reference", nargs="*", default=None,
+                        help="Имена опорных чистых сцен (нужны, если в датасете их несколько)")
+    parser.add_argument("--size", type=int, default=256, help="Сторона окна")
+    parser.add_argument("--stride", type=int, default=128, help="Шаг окон")
+    parser.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_BUDGET // 1024**2,
+                        help="Предел памяти на фрагмент, МБ")
+    parser.add_argument("--aligned-cache", action="store_true",
+                        help="Брать выровненную чистую сцену из кэша crop.py (при промахе она туда записывается)")
+    parser.add_argument("--aligned-cache-limit", type=float, default=ALIGNED_CACHE_BYTES / 1024**2,
+                        help="Предел объема кэша выровненных сцен, МБ (LRU)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable(args.trace, memory=args.trace_memory)
+
+    warp_engine = WarpEngine(workers=os.cpu_count() or 1)
+    dense_grid = DenseGrid(args.size, args.stride, memory_budget=args.memory_mb * 1024**2, scale=4096.0)
+    # С --aligned-cache - тот же кэш, что у crop.py: выровненная чистая сцена читается фрагментами из memmap
+    aligned_cache = None
+    if args.aligned_cache:
+        aligned_cache = AlignedCache(Path(args.work_dir) / ".aligned_cache",
+                                     max_bytes=int(args.aligned_cache_limit * 1024**2))
+    for i in args.datasets:
+        dataset_dir = Path(args.work_dir) / str(i)
+        labels = load_labels(dataset_dir / "labels.json")
+        bands = scene_bands(labels.get('wavelength'))
+        height, width = labels['height'], labels['width']
+        clean_file = reference_scene(labels, args.reference)
+        hazed_files = [file for file, classe in zip(labels["files"], labels["class"]) if classe != 'clean']
+        if clean_file is None or not hazed_files:
+            print(f"Dataset {i}: no clean/hazed pair, skipped")
+            continue
+
+        with tracer.context(dataset=str(i)):
+            hdr_path, img_path = find_scene(clean_file)
+            transform_lst = find_matching_files(os.listdir(dataset_dir), clean_file, 'sc01_transformation')
+            if aligned_cache is not None:
+                def build(H, out):
+                    clean = load(hdr_path, img_path, bands)
+                    with stage("warp", bytes=clean.nbytes):
+                        warp_engine.warp(clean, H, (width, height), out=out)
+
+                clean, _ = aligned_cache.get(img_path, hdr_path, dataset_dir / transform_lst[0], bands,
+                                             height, width, build)
+            else:
+                clean = load(hdr_path, img_path, bands)
+                H = np.load(dataset_dir / transform_lst[0])
+                with stage("warp", bytes=clean.nbytes):
+                    clean = warp_engine.warp(clean, H, (width, height))
+
+            output_dir = dataset_dir / "grid"
+            output_dir.mkdir(exist_ok=True)
+            for file in hazed_files:
+                # Сцена с дымкой читается фрагментами прямо из файла ENVI, как выровненная чистая из memmap кэша
+                hazed = EnviScene(*find_scene(file), bands)
+                ys, xs, grids = dense_grid.evaluate(hazed, clean)
+                with stage("save", file=file):
+                    save_grid(output_dir / f"{file}_grid.csv", ys, xs, grids)
+                    save_heatmaps(output_dir, file, grids)
+                print(f"Dataset {i}, {file}: {len(ys)}x{len(xs)} windows -> {output_dir}")
+
+    tracer.summary(args.trace_top)
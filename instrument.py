@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+def rss_bytes():
+    """Текущий резидентный объем памяти процесса (Linux - /proc/self/statm, иначе - пиковый из getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTracer:
+    """
+    Трассировка этапов обработки (загрузка, выбор каналов, варп, кроп, сохранение, метрики, отрисовка).
+    Каждый этап - строка JSON в файле трассы: этап, длительность, объем данных (bytes), RSS процесса
+    и поля контекста (датасет, кроп, метрика). С memory=True дополнительно пишется пик выделений
+    Python/numpy внутри этапа (tracemalloc, заметно замедляет расчет).
+    Выключенный трассировщик ничего не измеряет: stage() возвращает пустой контекст.
+
+    Поля контекста у каждого потока свои (фоновая загрузка loader.prefetch не смешивает
+    вложенные этапы с основным потоком). Счетчик пика tracemalloc общий для процесса, поэтому
+    в пик этапа входят и выделения других потоков за время этапа.
+    """
+    def __init__(self):
+        self.path = None
+        self.memory = False
+        # Открытые этапы всех потоков: id записи -> пик выделений, учтенный до последнего reset_peak
+        self._peaks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _context(self):
+        return getattr(self._local, "context", {})
+
+    @_context.setter
+    def _context(self, fields):
+        self._local.context = fields
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path, memory=False, append=False):
+        """
+        Включает трассировку в файл path (JSON lines) в текущем процессе. Процессы пула
+        (parallel.process_pool) получают настройки трассы (config()) через инициализатор.
+
+        :param append: Дописывать в существующую трассу (процессы пула); иначе файл очищается.
+        """
+        self.path = str(path)
+        self.memory = memory
+        if not append:
+            open(self.path, 'w').close()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def config(self):
+        """Настройки включенной трассировки (путь, memory) для процессов пула или None."""
+        return (self.path, self.memory) if self.enabled else None
+
+    def stage(self, name, **fields):
+        """
+        Контекст этапа. Объем обработанных данных можно указать полем bytes или записать
+        в словарь, возвращаемый контекстом: `with tracer.stage("load", crop=1) as record: record["bytes"] = ...`.
+        """
+        if self.path is None:
+            return nullcontext({})
+        return self._stage(name, fields)
+
+    def context_fields(self):
+        """Поля контекста текущего потока (например, чтобы продолжить контекст в фоновом потоке)."""
+        return dict(self._context)
+
+    @contextmanager
+    def context(self, **fields):
+        """Поля контекста (датасет, кропы), добавляемые ко всем этапам внутри блока в текущем потоке."""
+        previous = self._context
+        self._context = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self._context = previous
+
+    @contextmanager
+    def _stage(self, name, fields):
+        record = {"stage": name, **self._context, **fields}
+        if self.memory:
+            with self._lock:
+                # reset_peak сбрасывает общий счетчик: достигнутый пик сначала учитывается
+                # во всех открытых этапах (внешних и других потоков)
+                peak = tracemalloc.get_traced_memory()[1]
+                for key in self._peaks:
+                    self._peaks[key] = max(self._peaks[key], peak)
+                tracemalloc.reset_peak()
+                self._peaks[id(record)] = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["duration_s"] = time.perf_counter() - start
+            if self.memory:
+                with self._lock:
+                    peak = max(tracemalloc.get_traced_memory()[1], self._peaks.pop(id(record)))
+                record["py_peak_mb"] = peak / 1024**2
+            record["rss_mb"] = rss_bytes() / 1024**2
+            record["pid"] = os.getpid()
+            self._write(record)
+
+    def _write(self, record):
+        # Короткая строка одним write в режиме append не перемешивается со строками других процессов
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def summary(self, top=10):
+        """
+        Печатает самые затратные этапы трассы (всех процессов): суммарное время, число вызовов,
+        объем данных и максимальный RSS. Для метрик этапы разделены по имени метрики.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return
+        totals = defaultdict(lambda: {"time": 0.0, "calls": 0, "bytes": 0, "rss_mb": 0.0})
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                key = record["stage"] + (f"/{record['metric']}" if "metric" in record else "")
+                total = totals[key]
+                total["time"] += record["duration_s"]
+                total["calls"] += 1
+                total["bytes"] += record.get("bytes", 0)
+                total["rss_mb"] = max(total["rss_mb"], record["rss_mb"])
+
+        print(f"\nTop {top} stages by total time (trace: {self.path}):")
+        for key, total in sorted(totals.items(), key=lambda item: -item[1]["time"])[:top]:
+            print(f"  {key:24s} {total['time']:9.3f}s {total['calls']:7d} calls "
+                  f"{total['bytes'] / 1024**2:10.1f} MB  max RSS {total['rss_mb']:.0f} MB")
+
+
+def add_trace_arguments(parser):
+    """Общие флаги трассировки для скриптов: --trace, --trace-memory, --trace-top."""
+    parser.add_argument("--trace", default=None, metavar="PATH",
+                        help="Писать трассу этапов (JSON lines) в файл и вывести самые затратные этапы")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Учитывать в трассе пик выделений памяти этапа (tracemalloc, медленнее)")
+    parser.add_argument("--trace-top", type=int, default=10, help="Число этапов в итоговой сводке")
+
+
+tracer = StageTracer()
+stage = tracer.stage
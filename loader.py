@@ -0,0 +1,85 @@
+import queue
+import threading
+import numpy as np
+from crop_store import StoredCrop
+from storage import dequantize, read_quantization
+from instrument import tracer
+
+_DONE = object()
+
+
+def load_float32(file_path):
+    """
+    Читает .npy в новый массив float32 одной аллокацией: файл открывается через memmap
+    (если это возможно), значения копируются сразу в результат без промежуточной копии в исходном типе.
+    Квантованные данные (storage.py: uint16 с масштабом и смещением, float16) переводятся
+    в float32 там же. Результат можно нормализовать на месте.
+
+    :param file_path: Путь к .npy файлу или кроп упакованного хранилища (crop_store.StoredCrop).
+    :return: Массив float32.
+    """
+    if isinstance(file_path, StoredCrop):
+        data = file_path.array()
+        quantization = file_path.quantization
+    else:
+        quantization = read_quantization(file_path)
+        try:
+            data = np.load(file_path, mmap_mode='r')
+        except ValueError:
+            # Массивы объектов и т.п. нельзя открыть через memmap
+            data = np.load(file_path, allow_pickle=False)
+    return dequantize(data, quantization, out=np.empty(data.shape, dtype=np.float32))
+
+
+def normalize_(data, scale):
+    """Нормализация на месте: data / scale с обрезкой в [0, 1], без временных массивов."""
+    data /= scale
+    return np.clip(data, 0., 1., out=data)
+
+
+def prefetch(loaders, depth=1):
+    """
+    Выполняет загрузчики в фоновом потоке с опережением: пока потребитель обрабатывает элемент N,
+    поток уже загружает N+1. Очередь ограничена, поэтому в памяти одновременно не больше
+    depth готовых элементов плюс загружаемый (depth=1 - двойная буферизация).
+
+    :param loaders: Итерируемое вызываемых объектов без аргументов.
+    :param depth: Размер очереди готовых элементов.
+    :return: Генератор (результат, исключение) в исходном порядке; исключение - None при успехе.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    # Этапы загрузки в фоновом потоке получают поля контекста трассы, заданные при запуске
+    fields = tracer.context_fields()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        with tracer.context(**fields):
+            for load in loaders:
+                try:
+                    outcome = (load(), None)
+                except Exception as e:
+                    outcome = (None, e)
+                if not put(outcome):
+                    return
+        put(_DONE)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            outcome = items.get()
+            if outcome is _DONE:
+                return
+            yield outcome
+    finally:
+        # Потребитель мог прервать итерацию: останавливаем поток, не дожидаясь остальных загрузок
+        stop.set()
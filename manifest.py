@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+# Версия формата записей манифеста: записи другой версии считаются устаревшими
+MANIFEST_VERSION = 2
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 содержимого файла (читается блоками)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_signature(path, hash_contents=False):
+    """Подпись файла для сравнения между запусками: размер и mtime, при hash_contents - еще SHA-256."""
+    stat = os.stat(path)
+    signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if hash_contents:
+        signature["sha256"] = file_hash(path)
+    return signature
+
+
+def same_file(path, stored, hash_contents=False):
+    """True, если файл соответствует подписи stored (file_signature)."""
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != stored.get("size"):
+        return False
+    if hash_contents:
+        return stored.get("sha256") == file_hash(path)
+    return stat.st_mtime_ns == stored.get("mtime_ns")
+
+
+class RunManifest:
+    """
+    Манифест инкрементального запуска: для каждого ключа (например, кропа) хранит подписи входных
+    файлов (размер и mtime, при hash_contents - еще SHA-256), параметры расчета и список выходов.
+    Если входы и параметры не изменились и выходы на месте, результат можно взять с диска.
+    При max_bytes выходы давно не использованных записей удаляются (LRU), пока суммарный объем
+    не уложится в предел.
+    """
+    def __init__(self, path, hash_contents=False, force=False, max_bytes=None):
+        """
+        :param path: Путь к JSON-файлу манифеста.
+        :param hash_contents: Сравнивать содержимое файлов по SHA-256, а не по размеру и mtime.
+        :param force: Считать все записи устаревшими (полный пересчет).
+        :param max_bytes: Предел суммарного объема выходов (None - без ограничения).
+        """
+        self.path = Path(path)
+        self.hash_contents = hash_contents
+        self.force = force
+        self.max_bytes = max_bytes
+        self.entries = {}
+        # Ключи, найденные или записанные в текущем запуске
+        self.used = set()
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def _signature(self, path):
+        return file_signature(path, self.hash_contents)
+
+    def _same_file(self, path, stored):
+        return same_file(path, stored, self.hash_contents)
+
+    @staticmethod
+    def _normalize(params):
+        # Кортежи и т.п. приводятся к виду, в котором параметры хранятся в JSON
+        return json.loads(json.dumps(params))
+
+    def lookup(self, key, inputs, params):
+        """
+        Выходы записи key, если входы, параметры и выходы не изменились, иначе None.
+        Найденная запись помечается как использованная.
+        """
+        entry = self.entries.get(key)
+        if self.force or entry is None or entry.get("version") != MANIFEST_VERSION:
+            return None
+        if entry["params"] != self._normalize(params):
+            return None
+        if sorted(entry["inputs"]) != sorted(str(path) for path in inputs):
+            return None
+        if not all(self._same_file(path, stored) for path, stored in entry["inputs"].items()):
+            return None
+        if not all(os.path.exists(path) for path in entry["outputs"]):
+            return None
+        entry["last_used"] = time.time()
+        self.used.add(key)
+        return entry["outputs"]
+
+    def record(self, key, inputs, params, outputs):
+        """Запоминает входы, параметры и выходы записи key."""
+        outputs = [str(path) for path in outputs]
+        self.entries[key] = {
+            "version": MANIFEST_VERSION,
+            "inputs": {str(path): self._signature(path) for path in inputs},
+            "params": self._normalize(params),
+            "outputs": outputs,
+            "bytes": sum(os.path.getsize(path) for path in outputs if os.path.exists(path)),
+            "last_used": time.time(),
+        }
+        self.used.add(key)
+
+    def evict(self, keep=()):
+        """
+        Удаляет выходы давно не использованных записей сверх max_bytes.
+
+        :param keep: Ключи, которые нельзя вытеснять (например, записи текущего запуска).
+        :return: Список вытесненных ключей.
+        """
+        if self.max_bytes is None:
+            return []
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        evicted = []
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            for path in self.entries[key]["outputs"]:
+                Path(path).unlink(missing_ok=True)
+            total -= self.entries.pop(key)["bytes"]
+            evicted.append(key)
+        return evicted
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import numpy as np
+from manifest import file_signature, same_file
+
+
+class MapStore:
+    """
+    Хранилище карт метрик датасета: на каждую пару (кроп, метрика) - файл
+    crop_{N}_{metric}.npy формы (пары, H, W[, каналы]) и описание crop_{N}_{metric}.json
+    (имена пар, диапазон значений для отрисовки, подписи входных файлов кропа). Файлы .npy
+    читаются лениво через memmap,
+    compact() упаковывает карты кропа в сжатый crop_{N}.npz.
+    Описание пишется после данных, поэтому его наличие означает, что карты записаны целиком;
+    разные кропы можно писать из разных процессов.
+    """
+    def __init__(self, root, hash_contents=False):
+        """
+        :param root: Каталог хранилища.
+        :param hash_contents: Подписывать входные файлы карт SHA-256 содержимого, а не только размером и mtime.
+        """
+        self.root = Path(root)
+        self.hash_contents = hash_contents
+
+    def _meta_path(self, crop_num, metric_name):
+        return self.root / f"crop_{crop_num}_{metric_name}.json"
+
+    def _array_path(self, crop_num, metric_name):
+        return self.root / f"crop_{crop_num}_{metric_name}.npy"
+
+    def _archive_path(self, crop_num):
+        return self.root / f"crop_{crop_num}.npz"
+
+    def create(self, crop_num, metric_name, shape, dtype=np.float32):
+        """
+        Создает файл карт и возвращает memmap для записи; после заполнения нужно вызвать finish().
+
+        :param shape: (число пар, H, W[, C]).
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._meta_path(crop_num, metric_name).unlink(missing_ok=True)
+        return np.lib.format.open_memmap(self._array_path(crop_num, metric_name), mode='w+', dtype=dtype, shape=shape)
+
+    def finish(self, crop_num, metric_name, maps, pair_names, value_range=None, inputs=None):
+        """
+        Сбрасывает memmap на диск и записывает описание карт.
+
+        :param inputs: Входные файлы кропа (как в манифесте запуска); их подписи сохраняются
+            в описании, и has() не признает карты после изменения этих файлов.
+        """
+        maps.flush()
+        meta = {"crop": crop_num, "metric": metric_name, "pairs": list(pair_names),
+                "shape": list(maps.shape), "dtype": str(maps.dtype), "range": value_range}
+        if inputs is not None:
+            meta["inputs"] = {str(path): file_signature(path, self.hash_contents) for path in inputs}
+        tmp_path = self._meta_path(crop_num, metric_name).with_suffix(".json.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self._meta_path(crop_num, metric_name))
+
+    def meta(self, crop_num, metric_name):
+        """Описание карт или None, если карты не записаны."""
+        path = self._meta_path(crop_num, metric_name)
+        if not path.exists():
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def entries(self):
+        """Описания всех записанных карт, упорядоченные по кропу и метрике."""
+        if not self.root.exists():
+            return []
+        metas = []
+        for path in self.root.glob("crop_*.json"):
+            with open(path, encoding='utf-8') as f:
+                metas.append(json.load(f))
+        return sorted(metas, key=lambda meta: (meta["crop"], meta["metric"]))
+
+    def has(self, crop_num, metric_names, pair_names, inputs=None):
+        """
+        True, если для кропа записаны карты всех метрик ровно для этих пар и, при inputs,
+        по тем же входным файлам без изменений (карты без подписей входов тогда не подходят).
+        """
+        for metric_name in metric_names:
+            meta = self.meta(crop_num, metric_name)
+            if meta is None or meta["pairs"] != list(pair_names):
+                return False
+            if inputs is not None:
+                stored = meta.get("inputs")
+                if stored is None or sorted(stored) != sorted(str(path) for path in inputs):
+                    return False
+                if not all(same_file(path, signature, self.hash_contents) for path, signature in stored.items()):
+                    return False
+        return True
+
+    def load(self, crop_num, metric_name, pair=None, bands=None, mmap=True):
+        """
+        Карты метрики кропа. Из .npy читается только запрошенное (memmap), из архива .npz - массив метрики.
+
+        :param pair: Имя или индекс пары (None - все пары).
+        :param bands: Индекс, срез или список каналов (None - все).
+        :return: Массив карт; при mmap=True и без выборки - memmap только для чтения.
+        """
+        meta = self.meta(crop_num, metric_name)
+        if meta is None:
+            raise KeyError(f"Нет карт {metric_name} для кропа {crop_num} в {self.root}")
+
+        array_path = self._array_path(crop_num, metric_name)
+        if array_path.exists():
+            maps = np.load(array_path, mmap_mode='r' if mmap else None)
+        else:
+            with np.load(self._archive_path(crop_num)) as archive:
+                maps = archive[metric_name]
+
+        if pair is not None:
+            maps = maps[meta["pairs"].index(pair) if isinstance(pair, str) else pair]
+        if bands is not None:
+            maps = maps[..., bands]
+        return maps
+
+    def compact(self, crop_num):
+        """Упаковывает все карты кропа в сжатый crop_{N}.npz и удаляет отдельные .npy (описания остаются)."""
+        metas = [meta for meta in self.entries() if meta["crop"] == crop_num]
+        arrays = {meta["metric"]: np.load(self._array_path(crop_num, meta["metric"]))
+                  for meta in metas if self._array_path(crop_num, meta["metric"]).exists()}
+        if not arrays:
+            return
+        # Метрики, уже упакованные ранее, переносятся в новый архив
+        if self._archive_path(crop_num).exists():
+            with np.load(self._archive_path(crop_num)) as archive:
+                for metric_name in archive.files:
+                    arrays.setdefault(metric_name, archive[metric_name])
+        np.savez_compressed(self._archive_path(crop_num), **arrays)
+        for meta in metas:
+            self._array_path(crop_num, meta["metric"]).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Упаковка карт метрик хранилища (results/maps) в сжатые crop_{N}.npz")
+    parser.add_argument("command", choices=["compact"], help="compact - отдельные .npy кропов в crop_{N}.npz")
+    parser.add_argument("maps_dir", help="Каталог MapStore, например 1/results/maps")
+    parser.add_argument("--crop", type=int, nargs="*", help="Номера кропов (по умолчанию все)")
+    args = parser.parse_args()
+    store = MapStore(args.maps_dir)
+    crop_nums = args.crop or sorted({meta["crop"] for meta in store.entries()})
+    for crop_num in crop_nums:
+        store.compact(crop_num)
+    print(f"{len(crop_nums)} crop(s) compacted in {store.root}")
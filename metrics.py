@@ -1,6 +1,70 @@
+import inspect
 import math
+from collections import OrderedDict
 import numpy as np
-from scipy.ndimage import convolve, uniform_filter
+from scipy.ndimage import convolve1d
+from instrument import stage
+
+# Политика типов: карты и промежуточные кубы хранятся в float32, средние
+# и спектральные суммы накапливаются в float64. Гауссово окно остается
+# float64: convolve1d считает в double и пишет результат в тип выхода.
+WORK_DTYPE = np.float32
+ACCUM_DTYPE = np.float64
+# Наибольший блок каналов, которым свободные функции SSIM/UQI считают карту:
+# временные кубы занимают объем блока, а не всего изображения. На узких
+# блоках свертка по строкам заметно медленнее, поэтому блок не мельче ~40.
+WORKSPACE_BAND_BLOCK = 40
+
+class Workspace:
+    """
+    Переиспользуемые буферы для временных массивов метрик.
+
+    Буфер определяется ролью, формой и типом; для кропов одной формы
+    (и одного размера батча) одни и те же буферы берутся повторно, без новых
+    выделений. Содержимое буфера действительно до следующего get() с той же
+    ролью, поэтому в буферах лежат только временные величины, а карты и
+    кэшируемые величины пары выделяются отдельно. При превышении max_bytes
+    вытесняются давно не использованные буферы. Буферы не передаются
+    в процессы пула (при pickle остаются только настройки).
+    """
+    def __init__(self, max_bytes=512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._buffers = OrderedDict()
+
+    def get(self, role, shape, dtype=WORK_DTYPE):
+        key = (role, tuple(shape), np.dtype(dtype).str)
+        buffer = self._buffers.get(key)
+        if buffer is not None:
+            self._buffers.move_to_end(key)
+            return buffer
+        buffer = np.empty(shape, dtype=dtype)
+        self._buffers[key] = buffer
+        self.nbytes += buffer.nbytes
+        while self.nbytes > self.max_bytes and len(self._buffers) > 1:
+            _, evicted = self._buffers.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return buffer
+
+    def clear(self):
+        self._buffers.clear()
+        self.nbytes = 0
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+def _buffer(workspace, role, shape, dtype=WORK_DTYPE):
+    """Временный массив: из workspace, если он задан, иначе новый."""
+    if workspace is None:
+        return np.empty(shape, dtype=dtype)
+    return workspace.get(role, shape, dtype)
+
+def as_work_dtype(image):
+    """Изображение в рабочем типе (float32) без копии, если тип уже подходит."""
+    return np.asarray(image, dtype=WORK_DTYPE)
 
 def gaussian(window_size, sigma):
     gauss = np.array([math.exp(-(x - window_size // 2)**2 / (2 * sigma**2)) for x in range(window_size)])
@@ -11,80 +75,670 @@ def create_window(window_size):
     _2D_window = np.dot(_1D_window, _1D_window.T)
     return _2D_window
 
-def _ssim(img1, img2, window, window_size, channel):
-    mu1 = np.array([convolve(img1[:, :, c], window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0)
-    mu2 = np.array([convolve(img2[:, :, c], window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0)
+def local_moments(img1, img2, window, workspace=None):
+    """
+    Локальные моменты пары изображений (H, W, C) или батчей (N, H, W, C)
+    в скользящем окне.
+
+    Каналы обоих изображений, их квадратов и произведения складываются в один
+    куб (..., H, W, 5C), который фильтруется сепарабельным 1D-окном `window`
+    последовательно по пространственным осям (mode='constant', cval=0). Результат
+    совпадает с поканальной 2D-сверткой convolve(..., create_window(...))
+    с точностью до промежуточного округления float32 (|Δ| < 1e-6 для данных
+    в [0, 1]). Дисперсии и ковариация получаются на месте в том же кубе.
+
+    :param workspace: Workspace для куба и временных массивов; тогда результат
+        лежит в буфере и действителен до следующего вызова с этим workspace.
+    :return: mu1, mu2, sigma1_sq, sigma2_sq, sigma12 формы входных изображений.
+    """
+    C = img1.shape[-1]
+    dtype = np.result_type(img1, img2)
+    shape = img1.shape[:-1] + (5 * C,)
+    stack = _buffer(workspace, 'moments', shape, dtype)
+    stack[..., :C] = img1
+    stack[..., C:2 * C] = img2
+    np.multiply(img1, img1, out=stack[..., 2 * C:3 * C])
+    np.multiply(img2, img2, out=stack[..., 3 * C:4 * C])
+    np.multiply(img1, img2, out=stack[..., 4 * C:])
+    tmp = _buffer(workspace, 'moments_filter', shape, dtype)
+    convolve1d(stack, window, axis=-3, output=tmp, mode='constant', cval=0.0)
+    convolve1d(tmp, window, axis=-2, output=stack, mode='constant', cval=0.0)
 
-    mu1_sq = mu1 ** 2
-    mu2_sq = mu2 ** 2
-    mu1_mu2 = mu1 * mu2
+    mu1, mu2 = stack[..., :C], stack[..., C:2 * C]
+    product = _buffer(workspace, 'moments_product', img1.shape, dtype)
+    sigma1_sq = stack[..., 2 * C:3 * C]
+    sigma1_sq -= np.square(mu1, out=product)
+    sigma2_sq = stack[..., 3 * C:4 * C]
+    sigma2_sq -= np.square(mu2, out=product)
+    sigma12 = stack[..., 4 * C:]
+    sigma12 -= np.multiply(mu1, mu2, out=product)
+    return mu1, mu2, sigma1_sq, sigma2_sq, sigma12
 
-    sigma1_sq = np.array([convolve(img1[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu1_sq
-    sigma2_sq = np.array([convolve(img2[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu2_sq
-    sigma12 = np.array([convolve((img1[:, :, c] * img2[:, :, c]), window, mode='constant', cval=0.0) for c in range(channel)]).transpose(1, 2, 0) - mu1_mu2
+def _window_sums(cube, window_size, pad=True):
+    """
+    Суммы по окнам window_size×window_size через таблицу интегральных сумм.
 
+    Таблица накапливается в float64, поэтому стоимость на пиксель не зависит
+    от размера окна. При pad=True края дополняются нулями так же, как в
+    convolve(..., mode='constant') (результат формы (..., H, W, C)), иначе
+    возвращаются только окна, целиком лежащие в изображении
+    ((..., H - window_size + 1, W - window_size + 1, C)).
+    """
+    H, W = cube.shape[-3:-1]
+    ws = window_size
+    before = (ws - 1) // 2 if pad else 0
+    pad_size = ws - 1 if pad else 0
+    sat = np.zeros(cube.shape[:-3] + (H + pad_size + 1, W + pad_size + 1) + cube.shape[-1:], dtype=np.float64)
+    sat[..., 1 + before:1 + before + H, 1 + before:1 + before + W, :] = cube
+    np.cumsum(sat, axis=-3, out=sat)
+    np.cumsum(sat, axis=-2, out=sat)
+    return (sat[..., ws:, ws:, :] - sat[..., :-ws, ws:, :]
+            - sat[..., ws:, :-ws, :] + sat[..., :-ws, :-ws, :])
+
+def box_moments(img1, img2, window_size):
+    """
+    Локальные моменты пары изображений в квадратном (box) окне.
+
+    Аналог local_moments для равномерного окна: средние, дисперсии и
+    ковариация считаются по интегральным изображениям каждого канала за O(1)
+    на пиксель при любом размере окна (удобно для окон 32–64 px).
+    Края дополняются нулями, как в convolve(..., mode='constant').
+
+    :return: mu1, mu2, sigma1_sq, sigma2_sq, sigma12 формы входных изображений.
+    """
+    n = float(window_size ** 2)
+    mu1 = _window_sums(img1, window_size) / n
+    mu2 = _window_sums(img2, window_size) / n
+    sigma1_sq = _window_sums(img1 * img1, window_size) / n - mu1 ** 2
+    sigma2_sq = _window_sums(img2 * img2, window_size) / n - mu2 ** 2
+    sigma12 = _window_sums(img1 * img2, window_size) / n - mu1 * mu2
+    dtype = np.result_type(img1, img2)
+    return tuple(m.astype(dtype, copy=False) for m in (mu1, mu2, sigma1_sq, sigma2_sq, sigma12))
+
+def window_moments(img1, img2, window_size, window='gaussian', workspace=None):
+    """Локальные моменты в окне заданного типа: 'gaussian' (sigma=1.5) или 'box'."""
+    if window == 'gaussian':
+        return local_moments(img1, img2, gaussian(window_size, 1.5), workspace)
+    if window == 'box':
+        return box_moments(img1, img2, window_size)
+    raise ValueError(f"Unknown window type: {window}. Expected 'gaussian' or 'box'")
+
+def _filter_cube(cube, window_size, window='gaussian', workspace=None, out=None):
+    """
+    Локальное среднее каждого канала куба (..., H, W, K) в окне 'gaussian' или 'box'.
+    Промежуточный куб берется из workspace, результат пишется в out (можно out=cube).
+    """
+    if window == 'gaussian':
+        kernel = gaussian(window_size, 1.5)
+        tmp = _buffer(workspace, 'filter', cube.shape, cube.dtype)
+        convolve1d(cube, kernel, axis=-3, output=tmp, mode='constant', cval=0.0)
+        if out is None:
+            out = np.empty_like(cube)
+        return convolve1d(tmp, kernel, axis=-2, output=out, mode='constant', cval=0.0)
+    if window == 'box':
+        if out is None:
+            out = np.empty_like(cube)
+        return np.divide(_window_sums(cube, window_size), window_size ** 2, out=out, casting='same_kind')
+    raise ValueError(f"Unknown window type: {window}. Expected 'gaussian' or 'box'")
+
+def _ssim_map(mu1, mu2, sigma1_sq, sigma2_sq, sigma12, workspace=None, out=None):
+    """Карта 1 - SSIM по локальным моментам; временные массивы - два буфера workspace."""
     C1 = 0.01**2
     C2 = 0.03**2
 
-    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2) + 1e-12)
+    # (2·mu1·mu2 + C1)·(2·sigma12 + C2) / ((mu1² + mu2² + C1)·(sigma1² + sigma2² + C2) + 1e-12)
+    ssim_map = np.multiply(mu1, mu2, out=out)
+    ssim_map *= 2
+    ssim_map += C1
+    tmp = _buffer(workspace, 'ssim', ssim_map.shape, ssim_map.dtype)
+    np.multiply(sigma12, 2, out=tmp)
+    tmp += C2
+    ssim_map *= tmp
+    denominator = _buffer(workspace, 'ssim_denominator', ssim_map.shape, ssim_map.dtype)
+    np.square(mu1, out=denominator)
+    denominator += np.square(mu2, out=tmp)
+    denominator += C1
+    np.add(sigma1_sq, sigma2_sq, out=tmp)
+    tmp += C2
+    denominator *= tmp
+    denominator += 1e-12
+    ssim_map /= denominator
+
+    np.clip(ssim_map, 0., 1., out=ssim_map)
+    return np.subtract(1, ssim_map, out=ssim_map)
+
+def _uqi_map(meanX, meanY, varX, varY, covXY, workspace=None, out=None):
+    """Карта UQI по локальным моментам; временные массивы - два буфера workspace."""
+    # 4·meanX·meanY·covXY / ((meanX² + meanY²)·(varX + varY) + 1e-12)
+    uqi_map = np.multiply(4, meanX, out=out)
+    uqi_map *= meanY
+    uqi_map *= covXY
+    denominator = _buffer(workspace, 'uqi_denominator', uqi_map.shape, uqi_map.dtype)
+    tmp = _buffer(workspace, 'uqi', uqi_map.shape, uqi_map.dtype)
+    np.square(meanX, out=denominator)
+    denominator += np.square(meanY, out=tmp)
+    denominator *= np.add(varX, varY, out=tmp)
+    denominator += 1e-12
+    uqi_map /= denominator
+    return uqi_map
 
-    ssim_map = np.clip(ssim_map, 0., 1.)
-    return 1 - ssim_map
+def _psnr_map(mse_map, max_pixel, out=None):
+    """Карта PSNR; при out=mse_map считается на месте."""
+    psnr_map = np.add(mse_map, 1e-8, out=out)
+    np.divide(max_pixel**2, psnr_map, out=psnr_map)
+    np.log10(psnr_map, out=psnr_map)
+    psnr_map *= 10
+    return psnr_map
+
+def _blockwise_map(map_func, x, y, window_size, window, workspace):
+    """
+    Карта SSIM/UQI по блокам WORKSPACE_BAND_BLOCK каналов: моменты и временные
+    массивы блока лежат в workspace, выделяется только результат (карта блока
+    пишется сразу в его каналы).
+    """
+    x, y = as_work_dtype(x), as_work_dtype(y)
+    if workspace is None:
+        workspace = Workspace()
+    result = np.empty(np.broadcast_shapes(x.shape, y.shape), dtype=WORK_DTYPE)
+    C = result.shape[-1]
+    # Блоки равного размера: одни и те же буферы подходят всем блокам
+    band_block = -(-C // -(-C // WORKSPACE_BAND_BLOCK))
+    for start in range(0, C, band_block):
+        stop = min(start + band_block, C)
+        moments = window_moments(x[..., start:stop], y[..., start:stop], window_size, window, workspace)
+        map_func(*moments, workspace=workspace, out=result[..., start:stop])
+    return result
 
 def MSE(input, target):
-    mse_map = (input - target) ** 2
-    return mse_map
+    input, target = as_work_dtype(input), as_work_dtype(target)
+    mse_map = np.subtract(input, target)
+    return np.square(mse_map, out=mse_map)
 
 def PSNR(input, target):
     mse_map = MSE(input, target)
-    max_pixel = np.max(input, axis=(0,1))
-    return 10 * np.log10(max_pixel**2 / (mse_map + 1e-8))
+    max_pixel = np.max(as_work_dtype(input), axis=(-3, -2), keepdims=True)
+    return _psnr_map(mse_map, max_pixel, out=mse_map)
 
 def RMSE(input, target):
     mse_map = MSE(input, target)
-    return np.sqrt(mse_map)
+    return np.sqrt(mse_map, out=mse_map)
 
-def SSIM(input, target, window_size=11):
-    H, W, C = input.shape
-    window = create_window(window_size)
-    return _ssim(input, target, window, window_size, C)
+def SSIM(input, target, window_size=11, window='gaussian', workspace=None):
+    return _blockwise_map(_ssim_map, input, target, window_size, window, workspace)
 
 
-def UQI(x, y, window_size=8):
-    window = create_window(window_size)  # Гауссово окно
-    
-    # Вычисление средних значений с помощью свертки с гауссовым окном
-    meanX = np.array([convolve(x[:, :, c], window, mode='constant', cval=0.0) for c in range(x.shape[2])]).transpose(1, 2, 0)
-    meanY = np.array([convolve(y[:, :, c], window, mode='constant', cval=0.0) for c in range(y.shape[2])]).transpose(1, 2, 0)
+def UQI(x, y, window_size=8, window='gaussian', workspace=None):
+    # Средние, дисперсии и ковариация за один проход по кубу блока каналов
+    # (гауссово окно по умолчанию или box-окно по интегральным изображениям)
+    return _blockwise_map(_uqi_map, x, y, window_size, window, workspace)
 
-    # Вычисление дисперсий
-    varX = np.array([convolve(x[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(x.shape[2])]).transpose(1, 2, 0) - meanX**2
-    varY = np.array([convolve(y[:, :, c]**2, window, mode='constant', cval=0.0) for c in range(y.shape[2])]).transpose(1, 2, 0) - meanY**2
+def UQI_box(x, y, window_size=8):
+    """
+    Классический UQI (Wang, Bovik, 2002) в скользящем квадратном окне.
 
-    # Вычисление ковариации
-    covXY = np.array([convolve(x[:, :, c] * y[:, :, c], window, mode='constant', cval=0.0) for c in range(x.shape[2])]).transpose(1, 2, 0) - meanX * meanY
+    Используются несмещенные оценки дисперсий и ковариации и только окна,
+    целиком лежащие в изображении, поэтому карта имеет форму
+    (..., H - window_size + 1, W - window_size + 1, C). Вырожденные окна
+    обрабатываются как в эталонной реализации авторов: для постоянных окон
+    с ненулевым средним Q = 2·x̄ȳ / (x̄² + ȳ²), для нулевых окон Q = 1.
+    """
+    n = window_size ** 2
+    sum_x = _window_sums(x, window_size, pad=False)
+    sum_y = _window_sums(y, window_size, pad=False)
+    sum_xx = _window_sums(x * x, window_size, pad=False)
+    sum_yy = _window_sums(y * y, window_size, pad=False)
+    sum_xy = _window_sums(x * y, window_size, pad=False)
 
-    # Вычисление UQI карты
-    UQI_map = 4 * meanX * meanY * covXY / ((meanX**2 + meanY**2) * (varX + varY) + 1e-12)
-    
-    return UQI_map  # Возвращаем среднее значение и карту
+    sum_x_sum_y = sum_x * sum_y
+    sum_sq = sum_x ** 2 + sum_y ** 2
+    numerator = 4 * (n * sum_xy - sum_x_sum_y) * sum_x_sum_y
+    denominator1 = n * (sum_xx + sum_yy) - sum_sq
+    denominator = denominator1 * sum_sq
+
+    q_map = np.ones(denominator.shape)
+    index = (denominator1 == 0) & (sum_sq != 0)
+    q_map[index] = 2 * sum_x_sum_y[index] / sum_sq[index]
+    index = denominator != 0
+    q_map[index] = numerator[index] / denominator[index]
+    return q_map.astype(np.result_type(x, y), copy=False)
 
 def SAM(gt: np.ndarray, pred: np.ndarray) -> tuple:
     if gt.shape != pred.shape:
         raise ValueError("Ground truth and predicted images must have the same shape.")
     
-    dot_product = np.sum(gt * pred, axis=2)
-    norm_gt = np.linalg.norm(gt, axis=2)
-    norm_pred = np.linalg.norm(pred, axis=2)
+    # Скалярные произведения и нормы накапливаются в float64 без временных кубов
+    dot_product = _spectral_dot(gt, pred)
+    norm_gt = np.sqrt(_spectral_dot(gt, gt))
+    norm_pred = np.sqrt(_spectral_dot(pred, pred))
     
-    cos_theta = np.clip(dot_product / (norm_gt * norm_pred + 1e-8), -1.0, 1.0)
-    sam_map = np.arccos(cos_theta)
+    return _sam_map(dot_product, norm_gt, norm_pred)
+
+def _spectral_dot(a, b):
+    # Накопление в float64: для почти параллельных спектров arccos усиливает
+    # ошибку округления float32-сумм до величины самого угла.
+    return np.einsum('...c,...c->...', a, b, dtype=ACCUM_DTYPE)
+
+def _sam_map(dot_product, norm_gt, norm_pred):
+    cos_theta = np.multiply(norm_gt, norm_pred)
+    cos_theta += 1e-8
+    np.divide(dot_product, cos_theta, out=cos_theta)
+    np.clip(cos_theta, -1.0, 1.0, out=cos_theta)
+    sam_map = np.arccos(cos_theta, out=cos_theta)
     
-    return sam_map / np.pi
+    sam_map /= np.pi
+    return sam_map
 
 def stress_metric(x:np.ndarray, y:np.ndarray):
-    x_1 = np.sum(x**2)
-    y_2 = np.sum(y**2)
-    x_y = np.sum(x * y)
+    axes = (-3, -2, -1)  # по каждому изображению батча
+    x_1 = np.sum(x**2, axis=axes)
+    y_2 = np.sum(y**2, axis=axes)
+    x_y = np.sum(x * y, axis=axes)
+    return _stress(x_1, y_2, x_y)
+
+def _stress(x_1, y_2, x_y):
     stress_map = np.sqrt(1 - (x_y**2) / (x_1 * y_2))
-    return stress_map
\ No newline at end of file
+    return stress_map
+
+# Метрики, карта которых в каждом канале зависит только от этого же канала:
+# их можно считать независимо по блокам каналов.
+BAND_SEPARABLE = (MSE, PSNR, RMSE, SSIM, UQI, UQI_box)
+
+class _LazyCache:
+    """Ленивый кэш промежуточных величин со счетчиками повторных использований."""
+    def __init__(self):
+        self.stats = {}
+        self._cache = {}
+
+    def _intermediate(self, key, compute):
+        if key in self._cache:
+            self.stats[key] += 1
+        else:
+            self._cache[key] = compute()
+            self.stats[key] = 0
+        return self._cache[key]
+
+    def reused(self):
+        """Переиспользованные промежуточные величины: {имя: число повторов}."""
+        return {key: count for key, count in self.stats.items() if count > 0}
+
+class ImageFeatures(_LazyCache):
+    """
+    Величины одного изображения (H, W, C) или батча (N, H, W, C), не
+    зависящие от пары.
+
+    Локальные средние и вторые моменты для каждого типа и размера окна,
+    попиксельный квадрат спектральной нормы и максимумы по каналам (PSNR)
+    вычисляются лениво и один раз на изображение. При сравнении всех пар из
+    N изображений они считаются N раз, а не по два раза на каждую пару:
+    PairEvaluator добавляет к ним только перекрестные члены (локальную
+    ковариацию и скалярные произведения спектров). Для батча take() выбирает
+    изображения по индексам, не пересчитывая их величины. Изображение
+    хранится в WORK_DTYPE; временные массивы берутся из workspace.
+    """
+    def __init__(self, image, workspace=None, band_max=None, share_blocks=False):
+        """
+        :param band_max: Готовые максимумы по каналам (..., 1, 1, C) для PSNR, например
+            посчитанные по всей сцене, когда image - ее фрагмент (см. tiled.py).
+        :param share_blocks: Хранить величины всех блоков каналов (block()) вместе
+            с изображением, чтобы их разделяли несколько пар (pairwise_metrics).
+            Иначе хранится только последний блок: при расчете по блокам в памяти
+            остаются величины одного блока, а не всего изображения.
+        """
+        super().__init__()
+        self.image = as_work_dtype(image)
+        self.shape = self.image.shape
+        self.workspace = workspace
+        self.share_blocks = share_blocks
+        self._blocks = {}
+        if band_max is not None:
+            self._cache['band_max'] = band_max
+            self.stats['band_max'] = 0
+
+    def band_max(self):
+        return self._intermediate('band_max', lambda: np.max(self.image, axis=(-3, -2), keepdims=True))
+
+    def local_stats(self, window_size, window='gaussian'):
+        """Локальные среднее и средний квадрат в окне, каждое формы изображения."""
+        def compute():
+            C = self.shape[-1]
+            stack = np.empty(self.shape[:-1] + (2 * C,), dtype=self.image.dtype)
+            stack[..., :C] = self.image
+            np.multiply(self.image, self.image, out=stack[..., C:])
+            filtered = _filter_cube(stack, window_size, window, self.workspace, out=stack)
+            return filtered[..., :C], filtered[..., C:]
+        return self._intermediate(f'local_stats({window}, {window_size})', compute)
+
+    def spectral_norm(self):
+        """Попиксельный квадрат спектральной нормы, (..., H, W), float64."""
+        return self._intermediate('spectral_norm', lambda: _spectral_dot(self.image, self.image))
+
+    def block(self, start, stop):
+        """
+        Величины для каналов [start, stop). Повторный запрос того же блока
+        (например, input и target батча из одного ImageFeatures) возвращает
+        тот же объект; прежние блоки хранятся только при share_blocks.
+        """
+        if start == 0 and stop >= self.shape[-1]:
+            return self
+        if (start, stop) not in self._blocks:
+            if not self.share_blocks:
+                self._blocks.clear()
+            band_max = self._cache.get('band_max')
+            self._blocks[start, stop] = ImageFeatures(self.image[..., start:stop], self.workspace,
+                                                      band_max[..., start:stop] if band_max is not None else None)
+        return self._blocks[start, stop]
+
+    def take(self, indices):
+        """Величины изображений батча с номерами indices (копии по индексам, без пересчета)."""
+        return _TakenFeatures(self, np.asarray(indices))
+
+class _TakenFeatures(ImageFeatures):
+    """Выборка изображений батча: величины берутся из кэша исходного ImageFeatures."""
+    def __init__(self, parent, indices):
+        super().__init__(parent.image[indices], parent.workspace)
+        self._parent = parent
+        self._indices = indices
+
+    def band_max(self):
+        return self._intermediate('band_max', lambda: self._parent.band_max()[self._indices])
+
+    def local_stats(self, window_size, window='gaussian'):
+        return self._intermediate(f'local_stats({window}, {window_size})',
+                                  lambda: tuple(stat[self._indices] for stat in self._parent.local_stats(window_size, window)))
+
+    def spectral_norm(self):
+        return self._intermediate('spectral_norm', lambda: self._parent.spectral_norm()[self._indices])
+
+    def block(self, start, stop):
+        if start == 0 and stop >= self.shape[-1]:
+            return self
+        return _TakenFeatures(self._parent.block(start, stop), self._indices)
+
+class PairEvaluator(_LazyCache):
+    """
+    Метрики одной пары изображений (H, W, C) или батча пар (N, H, W, C)
+    с общими промежуточными величинами.
+
+    Квадрат разности (MSE, PSNR, RMSE), локальные моменты для каждого типа и
+    размера окна (SSIM, UQI) и попиксельные скалярные произведения спектров
+    (SAM, stress_metric) вычисляются лениво и не более одного раза на пару.
+    Величины отдельных изображений (средние, вторые моменты, нормы,
+    максимумы) берутся из ImageFeatures: их можно передать вместо массивов,
+    чтобы разделить между всеми парами с этим изображением. В `stats` для
+    каждой вычисленной величины пары хранится число повторных использований.
+    Временные массивы (фильтрация, знаменатели SSIM/UQI) берутся из
+    workspace, который можно переиспользовать для кропов одной формы.
+    """
+    def __init__(self, input, target, workspace=None):
+        super().__init__()
+        self.input_features = input if isinstance(input, ImageFeatures) else ImageFeatures(input, workspace)
+        self.target_features = target if isinstance(target, ImageFeatures) else ImageFeatures(target, workspace)
+        self.workspace = workspace if workspace is not None else self.input_features.workspace
+        self.input = self.input_features.image
+        self.target = self.target_features.image
+        if self.input.shape != self.target.shape:
+            raise ValueError(f"Image shapes don't match: {self.input.shape} vs {self.target.shape}")
+
+    def reused(self):
+        """Переиспользованные величины пары и обоих изображений: {имя: число повторов}."""
+        reused = super().reused()
+        for prefix, features in (('input', self.input_features), ('target', self.target_features)):
+            reused.update({f'{prefix}.{key}': count for key, count in features.reused().items()})
+        return reused
+
+    def squared_difference(self):
+        return self._intermediate('squared_difference', lambda: MSE(self.input, self.target))
+
+    def band_max(self):
+        return self.input_features.band_max()
+
+    def moments(self, window_size, window='gaussian'):
+        """mu1, mu2, sigma1_sq, sigma2_sq, sigma12; от пары считается только локальное среднее x·y."""
+        def compute():
+            mu1, mean_sq1 = self.input_features.local_stats(window_size, window)
+            mu2, mean_sq2 = self.target_features.local_stats(window_size, window)
+            sigma12 = np.multiply(self.input, self.target)
+            _filter_cube(sigma12, window_size, window, self.workspace, out=sigma12)
+            sigma12 -= np.multiply(mu1, mu2, out=_buffer(self.workspace, 'moments_product', mu1.shape, mu1.dtype))
+            sigma1_sq = np.square(mu1)
+            np.subtract(mean_sq1, sigma1_sq, out=sigma1_sq)
+            sigma2_sq = np.square(mu2)
+            np.subtract(mean_sq2, sigma2_sq, out=sigma2_sq)
+            return mu1, mu2, sigma1_sq, sigma2_sq, sigma12
+        return self._intermediate(f'moments({window}, {window_size})', compute)
+
+    def spectral_norms(self):
+        """Попиксельные квадраты спектральных норм обоих изображений, (..., H, W), float64."""
+        return self.input_features.spectral_norm(), self.target_features.spectral_norm()
+
+    def dot_product(self):
+        """Попиксельные скалярные произведения спектров, (..., H, W), float64."""
+        return self._intermediate('dot_product', lambda: _spectral_dot(self.input, self.target))
+
+    def MSE(self):
+        return self.squared_difference()
+
+    def PSNR(self):
+        return _psnr_map(self.squared_difference(), self.band_max())
+
+    def RMSE(self):
+        return np.sqrt(self.squared_difference())
+
+    def SSIM(self, window_size=11, window='gaussian'):
+        return _ssim_map(*self.moments(window_size, window), workspace=self.workspace)
+
+    def UQI(self, window_size=8, window='gaussian'):
+        return _uqi_map(*self.moments(window_size, window), workspace=self.workspace)
+
+    def UQI_box(self, window_size=8):
+        return UQI_box(self.input, self.target, window_size)
+
+    def SAM(self):
+        norm_gt, norm_pred = self.spectral_norms()
+        return _sam_map(self.dot_product(), np.sqrt(norm_gt), np.sqrt(norm_pred))
+
+    def stress_metric(self):
+        norm_x, norm_y = self.spectral_norms()
+        axes = (-2, -1)
+        return _stress(np.sum(norm_x, axis=axes), np.sum(norm_y, axis=axes), np.sum(self.dot_product(), axis=axes))
+
+    def map(self, metric):
+        """Карта метрики: функции этого модуля берутся из общих величин, прочие вызываются напрямую."""
+        if metric in PAIR_METRICS:
+            return getattr(self, metric.__name__)()
+        return metric(self.input, self.target)
+
+    def means(self, metrics, per_band=False, band_block=None):
+        """
+        Средние значения набора метрик: {имя: среднее}; для батча пар
+        среднее — массив (N,) со значением для каждой пары.
+
+        При заданном band_block полные карты (H, W, C) не строятся: поканальные
+        метрики (BAND_SEPARABLE) считаются блоками по band_block каналов, от
+        каждого блока остаются только суммы по каналам (float64), а для SAM и
+        stress_metric по блокам накапливаются скалярные произведения и квадраты
+        норм, так что в памяти держатся лишь карты (..., H, W). Промежуточные
+        величины общие для всех метрик внутри блока и освобождаются вместе
+        с ним (если ImageFeatures не создан с share_blocks=True), так что пик
+        памяти падает вместе с band_block.
+
+        :param per_band: возвращать (среднее, средние по каналам); для метрик,
+            не разделимых по каналам, средние по каналам равны None.
+        """
+        batch_shape, (H, W, C) = self.input.shape[:-3], self.input.shape[-3:]
+        band_block = band_block or C
+        separable = [metric for metric in metrics if metric in BAND_SEPARABLE]
+        spectral = [metric for metric in metrics if metric in (SAM, stress_metric)]
+        band_means = {metric.__name__: np.empty(batch_shape + (C,), dtype=ACCUM_DTYPE) for metric in separable}
+        if spectral:
+            dot_product = np.zeros(batch_shape + (H, W), dtype=ACCUM_DTYPE)
+            norm_gt = np.zeros(batch_shape + (H, W), dtype=ACCUM_DTYPE)
+            norm_pred = np.zeros(batch_shape + (H, W), dtype=ACCUM_DTYPE)
+
+        for start in range(0, C, band_block):
+            stop = min(start + band_block, C)
+            if stop - start == C:
+                block = self
+            else:
+                block = PairEvaluator(self.input_features.block(start, stop),
+                                      self.target_features.block(start, stop), self.workspace)
+            # Время общих промежуточных величин блока приходится на первую метрику, которой они нужны
+            for metric in separable:
+                with stage("metric", metric=metric.__name__, bytes=block.input.nbytes):
+                    block_map = block.map(metric)
+                    block_means = band_means[metric.__name__][..., start:stop]
+                    np.sum(block_map, axis=(-3, -2), dtype=ACCUM_DTYPE, out=block_means)
+                    block_means /= block_map.shape[-3] * block_map.shape[-2]
+            if spectral:
+                with stage("metric", metric="+".join(metric.__name__ for metric in spectral), bytes=block.input.nbytes):
+                    dot_product += block.dot_product()
+                    block_norm_gt, block_norm_pred = block.spectral_norms()
+                    norm_gt += block_norm_gt
+                    norm_pred += block_norm_pred
+            if block is not self:
+                for key, count in block.stats.items():
+                    self.stats[key] = self.stats.get(key, 0) + count
+
+        results = {}
+        for metric in metrics:
+            name = metric.__name__
+            values = None
+            if metric in separable:
+                values = band_means[name]
+                mean = np.mean(values, axis=-1)
+            elif metric is SAM:
+                mean = np.mean(_sam_map(dot_product, np.sqrt(norm_gt), np.sqrt(norm_pred)), axis=(-2, -1))
+            elif metric is stress_metric:
+                axes = (-2, -1)
+                mean = _stress(np.sum(norm_gt, axis=axes), np.sum(norm_pred, axis=axes), np.sum(dot_product, axis=axes))
+            else:
+                metric_map = self.map(metric)
+                mean = np.mean(metric_map, axis=tuple(range(len(batch_shape), metric_map.ndim)))
+            if not batch_shape:
+                mean = float(mean)
+            results[name] = (mean, values) if per_band else mean
+        return results
+
+# Метрики, для которых PairEvaluator умеет строить карты из общих величин.
+PAIR_METRICS = (MSE, PSNR, RMSE, SSIM, UQI, UQI_box, SAM, stress_metric)
+
+def metric_mean(metric, input, target, per_band=False, band_block=16, workspace=None):
+    """
+    Среднее значение метрики без построения полной карты (H, W, C).
+
+    Поканальные метрики (BAND_SEPARABLE) считаются блоками по band_block
+    каналов, для SAM и stress_metric по блокам накапливаются скалярные
+    произведения и квадраты норм (см. PairEvaluator.means). Остальные
+    метрики считаются целиком.
+
+    :param per_band: вернуть также средние по каналам (для SAM — None).
+    :return: среднее значение или (среднее, средние по каналам).
+    """
+    evaluator = PairEvaluator(input, target, workspace)
+    return evaluator.means([metric], per_band=per_band, band_block=band_block)[metric.__name__]
+
+# Параметры функций метрик, от которых зависит результат; прочие аргументы
+# (workspace и т.п.) служебные и в параметры расчета не входят.
+RESULT_PARAMETERS = ('window_size', 'window')
+# Версия реализации метрик: увеличивается при любом изменении их численных
+# результатов, чтобы средние из кэша отчетов (manifest.py) пересчитывались.
+METRICS_VERSION = 1
+
+def metric_parameters(metrics):
+    """
+    Параметры набора метрик для манифеста: версия реализации (METRICS_VERSION) и для каждой
+    метрики значения по умолчанию ее параметров из RESULT_PARAMETERS (размеры и типы окон),
+    чтобы изменение реализации или параметров считалось изменением входа.
+    """
+    params = {"version": METRICS_VERSION}
+    for metric in metrics:
+        params[metric.__name__] = {name: p.default for name, p in inspect.signature(metric).parameters.items()
+                                   if name in RESULT_PARAMETERS and p.default is not inspect.Parameter.empty}
+    return params
+
+# Метрики, для которых значение не меняется при перестановке изображений пары.
+SYMMETRIC = (MSE, RMSE, SSIM, UQI, UQI_box, SAM, stress_metric)
+
+def pairwise_metrics(images, metrics, band_block=None, workspace=None):
+    """
+    Матрицы N×N средних значений метрик для всех пар из N изображений.
+
+    Изображения оборачиваются в ImageFeatures, так что локальные средние,
+    вторые моменты, нормы и максимумы каждого изображения считаются один раз,
+    а для пары — только перекрестные члены. Для симметричных метрик
+    вычисляется одна половина матрицы, для остальных (PSNR) — обе.
+    Элемент [i, j] соответствует input=images[i], target=images[j];
+    диагональ равна NaN.
+
+    :return: {имя метрики: матрица (N, N)}.
+    """
+    features = [image if isinstance(image, ImageFeatures) else ImageFeatures(image, workspace, share_blocks=True)
+                for image in images]
+    N = len(features)
+    matrices = {metric.__name__: np.full((N, N), np.nan) for metric in metrics}
+    asymmetric = [metric for metric in metrics if metric not in SYMMETRIC]
+    for i in range(N):
+        for j in range(i + 1, N):
+            forward = PairEvaluator(features[i], features[j], workspace).means(metrics, band_block=band_block)
+            backward = (PairEvaluator(features[j], features[i], workspace).means(asymmetric, band_block=band_block)
+                        if asymmetric else {})
+            for metric in metrics:
+                name = metric.__name__
+                matrices[name][i, j] = forward[name]
+                matrices[name][j, i] = backward.get(name, forward[name])
+    return matrices
+
+# Оценка пикового объема памяти на одну пару при расчете полного набора
+# метрик (в объемах одного куба (H, W, C) float32) и на одно изображение
+# в батче вместе с его ImageFeatures.
+PAIR_WORKSPACE_CUBES = 20
+IMAGE_WORKSPACE_CUBES = 6
+DEFAULT_MEMORY_BUDGET = 2 * 1024**3
+
+def batch_size_for(shape, memory_budget=DEFAULT_MEMORY_BUDGET, cubes=PAIR_WORKSPACE_CUBES, itemsize=4):
+    """Сколько пар (или изображений при cubes=IMAGE_WORKSPACE_CUBES) формы shape помещается в memory_budget байт."""
+    cube_bytes = int(np.prod(shape)) * itemsize
+    return max(1, int(memory_budget // (cubes * cube_bytes)))
+
+def batched_evaluators(images, pairs, memory_budget=DEFAULT_MEMORY_BUDGET, workspace=None):
+    """
+    PairEvaluator для батчей пар (i, j) из списка изображений (H, W, C).
+
+    Пары одной формы группируются по batch_size_for(shape, memory_budget)
+    штук; изображения пар группы складываются в батч (N, H, W, C) с общими
+    ImageFeatures. Батч собирается только из изображений своих пар, так что
+    одновременно в памяти не больше одной группы: ее изображения и
+    промежуточные величины укладываются в memory_budget (PAIR_WORKSPACE_CUBES
+    на пару).
+
+    :return: генератор (позиции пар в pairs, PairEvaluator батча этих пар).
+    """
+    groups = {}
+    for position, (i, j) in enumerate(pairs):
+        if images[i].shape != images[j].shape:
+            raise ValueError(f"Image shapes don't match: {images[i].shape} vs {images[j].shape}")
+        groups.setdefault(images[i].shape, []).append(position)
+
+    for shape, positions in groups.items():
+        batch_size = batch_size_for(shape, memory_budget)
+        for start in range(0, len(positions), batch_size):
+            chunk = positions[start:start + batch_size]
+            members = sorted({k for position in chunk for k in pairs[position]})
+            index = {k: n for n, k in enumerate(members)}
+            features = ImageFeatures(np.stack([images[k] for k in members]), workspace)
+            yield chunk, PairEvaluator(features.take([index[pairs[p][0]] for p in chunk]),
+                                       features.take([index[pairs[p][1]] for p in chunk]), workspace)
+
+def batched_pair_means(images, pairs, metrics, band_block=None, memory_budget=DEFAULT_MEMORY_BUDGET, workspace=None):
+    """
+    Средние значения метрик для пар (i, j) из списка изображений (H, W, C),
+    посчитанные векторизованно батчами (см. batched_evaluators).
+
+    :return: список {имя метрики: значение} в порядке pairs.
+    """
+    results = [None] * len(pairs)
+    for chunk, evaluator in batched_evaluators(images, pairs, memory_budget, workspace):
+        means = evaluator.means(metrics, band_block=band_block)
+        for n, position in enumerate(chunk):
+            results[position] = {name: float(values[n]) for name, values in means.items()}
+    return results
@@ -1,56 +1,165 @@
+import argparse
+import hashlib
+import io
+import os
 import numpy as np
+from collections import OrderedDict
+from functools import partial
 from itertools import combinations
 from pathlib import Path
-from metrics import PSNR, SSIM, UQI, SAM, RMSE
+from metrics import (PSNR, SSIM, UQI, SAM, RMSE, ImageFeatures, PairEvaluator, Workspace, batched_pair_means,
+                     metric_parameters, DEFAULT_MEMORY_BUDGET, IMAGE_WORKSPACE_CUBES)
+from parallel import process_pool, default_workers
+from loader import load_float32, normalize_, prefetch
+from manifest import RunManifest
+from instrument import tracer, stage, add_trace_arguments
+from bands import HSI_BANDS, image_type
+from crop_store import StoredCrop, open_store
+
+# Предел по объему для кэша нормализованных изображений (байт)
+IMAGE_CACHE_BYTES = 1024**3
+
+
+class ImageCache:
+    """
+    LRU-кэш нормализованных изображений, ограниченный по суммарному объему.
+    Ключ - путь к файлу, значение - массив только для чтения.
+    """
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, load):
+        """Возвращает закэшированное значение key, при отсутствии - load() с вытеснением старых записей."""
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+        
+        self.misses += 1
+        value = load()
+        value.flags.writeable = False
+        if value.nbytes <= self.max_bytes:
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return value
+
+
+# Кэш процесса: общий для обеих фаз анализа и для всех калькуляторов без собственного кэша
+image_cache = ImageCache()
+
+
+class DatasetIndex:
+    """
+    Индекс датасета за один проход по каталогам: номер кропа -> пути clean/hazed/dehazed.
+    Повторяет отбор файлов analyze_real_data/analyze_dehazing_results без повторных glob.
+    Если в каталоге есть упакованное хранилище кропов (crop_store.CropStore), кропы берутся
+    из него (StoredCrop с именами файлов старой раскладки), иначе - отдельные .npy.
+    """
+    def __init__(self, data_dir, dehazed_dir=None):
+        self.data_dir = Path(data_dir)
+        self.dehazed_dir = Path(dehazed_dir) if dehazed_dir is not None else None
+        self.crops = {}
+        
+        store = open_store(self.data_dir)
+        if store is not None:
+            sources = [(crop.name, crop) for crop in store.crops()]
+        else:
+            sources = [(entry.name, self.data_dir / entry.name) for entry in os.scandir(self.data_dir)]
+        for name, path in sources:
+            if not (name.endswith(".npy") and "_crop" in name):
+                continue
+            crop_num = int(path.stem.split('_crop')[-1].split('_')[0])
+            crop = self._crop(crop_num)
+            # Файлы кропа - только вида *_crop{N}_*.npy
+            if f"_crop{crop_num}_" not in name:
+                continue
+            if "clean" in path.stem:
+                crop["clean"].append(path)
+            if "hazed" in path.stem:
+                crop["hazed"].append(path)
+        
+        for crop in self.crops.values():
+            crop["clean"].sort()
+        
+        dehazed_names = set()
+        if self.dehazed_dir is not None and self.dehazed_dir.exists():
+            dehazed_names = {entry.name for entry in os.scandir(self.dehazed_dir)}
+        for crop_num, crop in self.crops.items():
+            name = f"dehazed_crop{crop_num}.npy"
+            crop["dehazed"] = self.dehazed_dir / name if name in dehazed_names else None
+
+    def _crop(self, crop_num):
+        return self.crops.setdefault(crop_num, {"clean": [], "hazed": [], "dehazed": None})
+
+    def crop_nums(self):
+        return sorted(self.crops)
+
+    def clean_exact(self, crop_num):
+        """Чистые изображения вида *_crop{N}_clean.npy (как в analyze_dehazing_results)."""
+        return [path for path in self.crops[crop_num]["clean"] if path.stem.endswith(f"_crop{crop_num}_clean")]
+
 
 class ImageMetricCalculator:
-    def __init__(self, metrics=None):
+    def __init__(self, metrics=None, reduced=True, band_block=16, memory_budget=DEFAULT_MEMORY_BUDGET, cache=None):
         self.metrics = metrics or [PSNR, SSIM, UQI, SAM, RMSE]
-        self.hsi_wavelengths = [365.9298, 375.594, 385.2625, 394.9355, 404.6129, 414.2946, 
-                               423.9808, 433.6713, 443.3662, 453.0655, 462.7692, 472.4773, 
-                               482.1898, 491.9066, 501.6279, 511.3535, 521.0836, 530.818, 
-                               540.5568, 550.3, 560.0477, 569.7996, 579.556, 589.3168, 
-                               599.0819, 608.8515, 618.6254, 628.4037, 638.1865, 647.9736, 
-                               657.7651, 667.561, 654.7923, 664.5994, 674.4012, 684.1979, 
-                               693.9894, 703.7756, 713.5566, 723.3325, 733.1031, 742.8685, 
-                               752.6287, 762.3837, 772.1335, 781.8781, 791.6174, 801.3516, 
-                               811.0805, 820.8043, 830.5228, 840.2361, 849.9442, 859.6471, 
-                               869.3448, 879.0372, 888.7245, 898.4066, 908.0834, 917.7551, 
-                               927.4214, 937.0827, 946.7387, 956.3895, 966.0351, 975.6755, 
-                               985.3106, 994.9406, 1004.565, 1014.185, 1023.799, 1033.408, 
-                               1043.012, 1052.611, 1062.204, 1071.793, 1081.376, 1090.954, 
-                               1100.526, 1110.094, 1119.656, 1129.213, 1138.765, 1148.311, 
-                               1157.853, 1167.389, 1176.92, 1186.446, 1195.966, 1205.482, 
-                               1214.992, 1224.497, 1233.996, 1243.491, 1252.98, 1262.464, 
-                               1252.773, 1262.746, 1272.718, 1282.691, 1292.662, 1302.634, 
-                               1312.606, 1452.182, 1462.15, 1472.118, 1482.085, 1492.052, 
-                               1502.019, 1511.986, 1521.952, 1531.918, 1541.885, 1551.85, 
-                               1561.816, 1571.781, 1581.746, 1591.711, 1601.675, 1611.64, 
-                               1621.604, 1631.568]
+        # reduced=True: метрики усредняются по блокам каналов без построения полных карт
+        self.reduced = reduced
+        self.band_block = band_block
+        # Бюджет памяти (байт) на батч кропов, считаемых одним векторизованным вызовом
+        self.memory_budget = memory_budget
+        # Буферы временных массивов метрик, общие для всех кропов одной формы
+        self.workspace = Workspace()
+        # None - общий кэш процесса image_cache (не передается в процессы пула вместе с калькулятором)
+        self.cache = cache
+        # Длины волн каналов HSI - из общего реестра каналов (bands.py)
+        self.hsi_wavelengths = HSI_BANDS.wavelengths
 
     def determine_image_type(self, img_array):
-        if len(img_array.shape) != 3:
-            raise ValueError(f"Invalid image dimensions: {img_array.shape}. Expected 3D array (H,W,C)")
-            
-        num_channels = img_array.shape[2]
-        
-        if num_channels == 3:
-            return 'RGB'
-        elif num_channels == len(self.hsi_wavelengths):
-            return 'HSI'
-        else:
-            raise ValueError(f"Unknown image type with {num_channels} channel(s). Expected 3 (RGB) or {len(self.hsi_wavelengths)} (HSI)")
+        return image_type(img_array)
 
     def load_image(self, file_path):
-        data = np.load(file_path).astype(np.float32)
+        """Загружает и нормализует изображение; каждый файл читается один раз, пока он в кэше."""
+        cache = self.cache if self.cache is not None else image_cache
+        return cache.get(str(file_path), partial(self._read_image, file_path))
+
+    def _read_image(self, file_path):
+        with stage("load", dataset=Path(file_path).parent.name, file=Path(file_path).name) as record:
+            data = load_float32(file_path)
+            record["bytes"] = data.nbytes
         img_type = self.determine_image_type(data)
         
         if img_type == 'RGB':
-            return np.clip(data / 255.0, 0., 1.)
+            return normalize_(data, 255.0)
         elif img_type == 'HSI':
-            return np.clip(data / 4096.0, 0., 1.)
+            return normalize_(data, 4096.0)
+
+    def compute_metrics(self, img1, img2, metrics=None):
+        """
+        Средние значения набора метрик для пары с общими промежуточными величинами: {имя: значение}.
+        Изображения можно передать как ImageFeatures, чтобы их собственные величины считались один раз для всех пар.
+        """
+        features1, features2 = img1, img2
+        if isinstance(img1, ImageFeatures):
+            img1 = img1.image
+        if isinstance(img2, ImageFeatures):
+            img2 = img2.image
+        self.check_pair(img1, img2)
+        
+        evaluator = PairEvaluator(features1, features2, self.workspace)
+        band_block = self.band_block if self.reduced else None
+        return evaluator.means(metrics or self.metrics, band_block=band_block)
 
     def compute_metric(self, metric, img1, img2):
+        return self.compute_metrics(img1, img2, [metric])[metric.__name__]
+
+    def check_pair(self, img1, img2):
         if img1.shape != img2.shape:
             raise ValueError(f"Image shapes don't match: {img1.shape} vs {img2.shape}")
         
@@ -58,121 +167,361 @@ class ImageMetricCalculator:
         type2 = self.determine_image_type(img2)
         if type1 != type2:
             raise ValueError(f"Cannot compare different image types: {type1} vs {type2}")
-        
-        metric_map = metric(img1, img2)
-        return np.mean(metric_map)
 
+    def compute_pairs(self, images, pairs):
+        """
+        Средние значения метрик для пар (i, j, metrics) изображений из images.
+        Пары одной формы и с одним набором метрик считаются батчами (N, H, W, C).
+        
+        :return: список {имя: значение} в порядке pairs.
+        """
+        groups = {}
+        for position, (i, j, metrics) in enumerate(pairs):
+            self.check_pair(images[i], images[j])
+            groups.setdefault(tuple(metrics), []).append(position)
+        
+        band_block = self.band_block if self.reduced else None
+        results = [None] * len(pairs)
+        for metrics, positions in groups.items():
+            values = batched_pair_means(images, [pairs[p][:2] for p in positions], list(metrics),
+                                        band_block=band_block, memory_budget=self.memory_budget,
+                                        workspace=self.workspace)
+            for position, value in zip(positions, values):
+                results[position] = value
+        return results
 
-def analyze_real_data(data_dir, output_file):
-    calculator = ImageMetricCalculator()
-    
-    with open(output_file, 'a') as f:
-        f.write(f"\n=== Real Data Analysis for {data_dir.name} ===\n")
+    def run_batched(self, jobs, f):
+        """
+        Выполняет задания кропов батчами и пишет отчеты в исходном порядке.
         
-        crop_nums = set()
-        for file in data_dir.glob("*_crop*.npy"):
-            crop_num = int(file.stem.split('_crop')[-1].split('_')[0])
-            crop_nums.add(crop_num)
+        :param jobs: последовательность (номер кропа, job); job() загружает кроп и возвращает
+            (изображения, пары (i, j, metrics), report, prefix), report(f, результаты пар) пишет отчет,
+            prefix - начало отчета, которое пишется перед сообщением об ошибке расчета кропа.
+        :param f: файл отчета или функция номер кропа -> файл (отчет каждого кропа отдельно).
+        Кропы накапливаются, пока их изображения укладываются в memory_budget,
+        затем все их пары считаются одним вызовом compute_pairs.
+        Пары кропа проверяются при загрузке: кроп с ошибкой в батч не попадает, а если батч
+        все же не посчитался, его кропы пересчитываются по одному - ошибка одного кропа
+        не меняет отчеты соседей.
+        Загрузка следующего кропа идет в фоновом потоке параллельно с расчетом текущих.
+        """
+        out = f if callable(f) else (lambda crop_num: f)
+        pending = []
+        loaded_bytes = 0
         
-        for crop_num in sorted(crop_nums):
-            crop_files = list(data_dir.glob(f"*_crop{crop_num}_*.npy"))
-            clean_imgs = sorted([f for f in crop_files if "clean" in f.stem])
-            hazed_imgs = [f for f in crop_files if "hazed" in f.stem]
-            
-            if not clean_imgs or not hazed_imgs:
-                continue
-                
+        def evaluate(batch):
+            images, pairs, spans = [], [], []
+            for _, crop_images, crop_pairs, _, _, _ in batch:
+                offset, start = len(images), len(pairs)
+                images.extend(crop_images)
+                pairs.extend((i + offset, j + offset, metrics) for i, j, metrics in crop_pairs)
+                spans.append((start, len(pairs)))
+            with tracer.context(crops=[crop_num for crop_num, *_ in batch]):
+                results = self.compute_pairs(images, pairs)
+            return [results[start:stop] for start, stop in spans]
+        
+        def evaluate_one(item):
+            try:
+                return evaluate([item])[0]
+            except Exception as e:
+                return e
+        
+        def flush():
+            batch = [item for item in pending if item[-1] is None]
             try:
-                hazed = calculator.load_image(hazed_imgs[0])
-                cleans = [calculator.load_image(f) for f in clean_imgs]
-                
-                img_type = calculator.determine_image_type(hazed)
-                f.write(f"\nCrop {crop_num} ({img_type} images):\n")
-                f.write(f"Found {len(clean_imgs)} clean and {len(hazed_imgs)} hazed image(s)\n")
-                
-                if len(clean_imgs) == 1 and len(hazed_imgs) == 1:
-                    f.write("Metrics between hazed and clean:\n")
-                    for metric in calculator.metrics:
-                        value = calculator.compute_metric(metric, hazed, cleans[0])
-                        f.write(f"{metric.__name__}: {value:.4f}\n")
-                
-                elif len(clean_imgs) > 1 and len(hazed_imgs) == 1:
-                    hazed_clean_rmses = [calculator.compute_metric(RMSE, hazed, clean) for clean in cleans]
-                    clean_pairs = list(combinations(range(len(clean_imgs)), 2))
-                    clean_clean_rmses = []
-                    
-                    f.write("\nClean image comparisons:\n")
-                    for i, j in clean_pairs:
-                        rmse = calculator.compute_metric(RMSE, cleans[i], cleans[j])
-                        clean_clean_rmses.append(rmse)
-                        f.write(f"RMSE between {clean_imgs[i].stem} and {clean_imgs[j].stem}: {rmse:.4f}\n")
-                    
-                    R = np.mean(hazed_clean_rmses) / np.mean(clean_clean_rmses)
-                    f.write(f"\nR metric: {R:.4f}\n")
-                    
-                    for i, clean in enumerate(cleans, 1):
-                        f.write(f"\nHazed vs {clean_imgs[i-1].stem} metrics:\n")
-                        for metric in calculator.metrics:
-                            value = calculator.compute_metric(metric, hazed, clean)
-                            f.write(f"{metric.__name__}: {value:.4f}\n")
+                outcomes = evaluate(batch) if batch else []
+            except Exception as e:
+                outcomes = [e] if len(batch) == 1 else [evaluate_one(item) for item in batch]
+            outcomes = iter(outcomes)
+            for crop_num, _, _, report, prefix, error in pending:
+                results = next(outcomes) if error is None else error
+                if isinstance(results, Exception):
+                    out(crop_num).write(f"{prefix}\nError processing crop {crop_num}: {str(results)}\n")
+                    continue
+                try:
+                    report(out(crop_num), results)
+                except Exception as e:
+                    out(crop_num).write(f"\nError processing crop {crop_num}: {str(e)}\n")
+            pending.clear()
+        
+        jobs = list(jobs)
+        for (crop_num, _), (loaded, error) in zip(jobs, prefetch(job for _, job in jobs)):
+            if error is not None:
+                pending.append((crop_num, [], [], None, "", error))
+                continue
             
+            crop_images, crop_pairs, report, prefix = loaded
+            try:
+                for i, j, _ in crop_pairs:
+                    self.check_pair(crop_images[i], crop_images[j])
             except Exception as e:
-                f.write(f"\nError processing crop {crop_num}: {str(e)}\n")
+                pending.append((crop_num, [], [], report, prefix, e))
                 continue
+            
+            pending.append((crop_num, crop_images, crop_pairs, report, prefix, None))
+            loaded_bytes += sum(img.nbytes for img in crop_images)
+            if loaded_bytes * IMAGE_WORKSPACE_CUBES >= self.memory_budget:
+                flush()
+                loaded_bytes = 0
+        flush()
 
+    def parameters(self):
+        """Параметры расчета для манифеста инкрементального запуска."""
+        return {"metrics": metric_parameters(self.metrics), "reduced": self.reduced, "band_block": self.band_block}
 
-def analyze_dehazing_results(real_data_dir, dehazed_dir, output_file):
-    calculator = ImageMetricCalculator()
+def real_data_crop_job(calculator, crop_num, clean_imgs, hazed_imgs):
+    """Задание кропа для analyze_real_data: загружает изображения и возвращает (изображения, пары, report, prefix)."""
+    metrics = tuple(calculator.metrics)
+    pair_metrics = metrics if RMSE in metrics else metrics + (RMSE,)
     
-    with open(output_file, 'a') as f:
-        f.write(f"\n\n=== Dehazing Results Analysis for {real_data_dir.name} ===\n")
+    hazed = calculator.load_image(hazed_imgs[0])
+    cleans = [calculator.load_image(f) for f in clean_imgs]
+    images = [hazed] + cleans
+    
+    img_type = calculator.determine_image_type(hazed)
+    header = (f"\nCrop {crop_num} ({img_type} images):\n"
+              f"Found {len(clean_imgs)} clean and {len(hazed_imgs)} hazed image(s)\n")
+    
+    if len(clean_imgs) == 1 and len(hazed_imgs) == 1:
+        pairs = [(0, 1, metrics)]
         
-        crop_nums = set()
-        for file in real_data_dir.glob("*_crop*_clean.npy"):
-            crop_num = int(file.stem.split('_crop')[-1].split('_')[0])
-            crop_nums.add(crop_num)
+        prefix = header + "Metrics between hazed and clean:\n"
         
-        for crop_num in sorted(crop_nums):
-            clean_imgs = list(real_data_dir.glob(f"*_crop{crop_num}_clean.npy"))
-            dehazed_path = dehazed_dir / f"dehazed_crop{crop_num}.npy"
+        def report(f, results):
+            f.write(prefix)
+            for metric in calculator.metrics:
+                f.write(f"{metric.__name__}: {results[0][metric.__name__]:.4f}\n")
+    
+    elif len(clean_imgs) > 1 and len(hazed_imgs) == 1:
+        clean_pairs = list(combinations(range(len(clean_imgs)), 2))
+        pairs = [(0, k, pair_metrics) for k in range(1, len(cleans) + 1)]
+        pairs += [(i + 1, j + 1, (RMSE,)) for i, j in clean_pairs]
+        prefix = header
+        
+        def report(f, results):
+            hazed_clean_values = results[:len(cleans)]
+            hazed_clean_rmses = [values['RMSE'] for values in hazed_clean_values]
+            clean_clean_rmses = [values['RMSE'] for values in results[len(cleans):]]
             
-            if not dehazed_path.exists():
-                continue
-                
-            try:
-                dehazed = calculator.load_image(dehazed_path)
-                cleans = [calculator.load_image(f) for f in clean_imgs]
-                
-                img_type = calculator.determine_image_type(dehazed)
-                f.write(f"\nCrop {crop_num} ({img_type} images, found {len(clean_imgs)} clean image(s)):\n")
-                
-                results = {}
+            f.write(header)
+            f.write("\nClean image comparisons:\n")
+            for (i, j), rmse in zip(clean_pairs, clean_clean_rmses):
+                f.write(f"RMSE between {clean_imgs[i].stem} and {clean_imgs[j].stem}: {rmse:.4f}\n")
+            
+            R = np.mean(hazed_clean_rmses) / np.mean(clean_clean_rmses)
+            f.write(f"\nR metric: {R:.4f}\n")
+            
+            for i, values in enumerate(hazed_clean_values, 1):
+                f.write(f"\nHazed vs {clean_imgs[i-1].stem} metrics:\n")
                 for metric in calculator.metrics:
-                    metric_name = metric.__name__
-                    values = [calculator.compute_metric(metric, dehazed, clean) for clean in cleans]
-                    
-                    if metric_name in ['PSNR', 'SSIM', 'UQI']:
-                        best_value = max(values)
-                    else:
-                        best_value = min(values)
-                    
-                    results[metric_name] = best_value
-                
-                for metric_name, value in results.items():
-                    f.write(f"Best {metric_name}: {value:.4f}\n")
+                    f.write(f"{metric.__name__}: {values[metric.__name__]:.4f}\n")
+    
+    else:
+        pairs = []
+        prefix = header
+        
+        def report(f, results):
+            f.write(header)
+    
+    return images, pairs, report, prefix
+
+
+def real_data_jobs(calculator, index):
+    """Задания (номер кропа, job) для всех кропов датасета из DatasetIndex, в порядке номеров."""
+    jobs = []
+    for crop_num in index.crop_nums():
+        clean_imgs = index.crops[crop_num]["clean"]
+        hazed_imgs = index.crops[crop_num]["hazed"]
+        
+        if not clean_imgs or not hazed_imgs:
+            continue
+        
+        jobs.append((crop_num, partial(real_data_crop_job, calculator, crop_num, clean_imgs, hazed_imgs)))
+    return jobs
+
+
+def dehazing_crop_job(calculator, crop_num, clean_imgs, dehazed_path):
+    """Задание кропа для analyze_dehazing_results."""
+    metrics = tuple(calculator.metrics)
+    
+    dehazed = calculator.load_image(dehazed_path)
+    cleans = [calculator.load_image(f) for f in clean_imgs]
+    images = [dehazed] + cleans
+    pairs = [(0, k, metrics) for k in range(1, len(cleans) + 1)]
+    
+    img_type = calculator.determine_image_type(dehazed)
+    header = f"\nCrop {crop_num} ({img_type} images, found {len(clean_imgs)} clean image(s)):\n"
+    
+    def report(f, clean_values):
+        results = {}
+        for metric in calculator.metrics:
+            metric_name = metric.__name__
+            values = [clean_value[metric_name] for clean_value in clean_values]
             
-            except Exception as e:
-                f.write(f"\nError processing crop {crop_num}: {str(e)}\n")
-                continue
+            if metric_name in ['PSNR', 'SSIM', 'UQI']:
+                best_value = max(values)
+            else:
+                best_value = min(values)
+            
+            results[metric_name] = best_value
+        
+        f.write(header)
+        for metric_name, value in results.items():
+            f.write(f"Best {metric_name}: {value:.4f}\n")
+    
+    return images, pairs, report, header
+
+
+def dehazing_jobs(calculator, index):
+    """Задания (номер кропа, job) для кропов, у которых есть чистые изображения и результат дехейзинга."""
+    jobs = []
+    for crop_num in index.crop_nums():
+        clean_imgs = index.clean_exact(crop_num)
+        dehazed_path = index.crops[crop_num]["dehazed"]
+        
+        if not clean_imgs or dehazed_path is None:
+            continue
+        
+        jobs.append((crop_num, partial(dehazing_crop_job, calculator, crop_num, clean_imgs, dehazed_path)))
+    return jobs
+
+
+def run_jobs(calculator, jobs):
+    """Выполняет задания (в том числе в процессе пула) и возвращает тексты отчетов {номер кропа: текст}."""
+    buffers = {}
+    calculator.run_batched(jobs, lambda crop_num: buffers.setdefault(crop_num, io.StringIO()))
+    return {crop_num: buffer.getvalue() for crop_num, buffer in buffers.items()}
+
+
+def run_task(parts):
+    """Задание пула: [(калькулятор, задания раздела)] для одних и тех же кропов -> тексты разделов."""
+    return [run_jobs(calculator, jobs) for calculator, jobs in parts]
 
 
-def main():
+def job_inputs(job):
+    """Входные файлы задания кропа - все пути среди аргументов partial (для кропов хранилища - его файлы)."""
+    paths = []
+    for arg in job.args:
+        for item in (arg if isinstance(arg, (list, tuple)) else [arg]):
+            if isinstance(item, StoredCrop):
+                paths.extend(path for path in item.store.files() if path not in paths)
+            elif isinstance(item, Path):
+                paths.append(item)
+    return paths
+
+
+def write_report(sections, output_file, workers=1, crops_per_task=None, manifest=None):
+    """
+    Дописывает в output_file разделы отчета (датасет, заголовок, калькулятор, задания кропов).
+    Задания разделов одного датасета группируются по кропам, так что обе фазы анализа
+    кропа выполняются подряд в одном процессе и используют общий кэш изображений.
+    При workers > 1 группы кропов считаются в пуле процессов; порядок записи не меняется.
+    С manifest (RunManifest) отчеты кропов с неизменными входами и параметрами берутся
+    из кэша рядом с манифестом, новые отчеты туда сохраняются.
+    
+    :param crops_per_task: Число кропов в задании (по умолчанию 8 последовательно, 1 в пуле).
+        Отчет от него и от workers не зависит: ошибка кропа не затрагивает другие кропы задания
+        (см. ImageMetricCalculator.run_batched).
+    """
+    if crops_per_task is None:
+        crops_per_task = 8 if workers <= 1 else 1
+    
+    # Отчеты кропов, взятые из кэша, и задания, которые нужно выполнить
+    texts = {p: {} for p in range(len(sections))}
+    pending = {p: [] for p in range(len(sections))}
+    keys = {}
+    for p, (_, header, calculator, jobs) in enumerate(sections):
+        for crop_num, job in jobs:
+            keys[p, crop_num] = key = f"{header.strip()} | crop {crop_num}"
+            outputs = manifest.lookup(key, job_inputs(job), calculator.parameters()) if manifest else None
+            if outputs:
+                texts[p][crop_num] = Path(outputs[0]).read_text()
+            else:
+                pending[p].append((crop_num, job))
+    
+    datasets = OrderedDict()
+    for position, (dataset, _, _, _) in enumerate(sections):
+        datasets.setdefault(dataset, []).append(position)
+    
+    tasks = OrderedDict()
+    for dataset, positions in datasets.items():
+        crop_nums = sorted({crop_num for p in positions for crop_num, _ in pending[p]})
+        tasks[dataset] = []
+        for start in range(0, len(crop_nums), crops_per_task):
+            chunk = set(crop_nums[start:start + crops_per_task])
+            tasks[dataset].append([(sections[p][2], [(n, job) for n, job in pending[p] if n in chunk])
+                                   for p in positions])
+    
+    executor = process_pool(workers) if workers > 1 else None
+    try:
+        if executor is None:
+            results = (run_task(parts) for dataset_tasks in tasks.values() for parts in dataset_tasks)
+        else:
+            futures = [executor.submit(run_task, parts) for dataset_tasks in tasks.values() for parts in dataset_tasks]
+            results = (future.result() for future in futures)
+        
+        with open(output_file, 'a') as f:
+            for dataset, positions in datasets.items():
+                for _ in tasks[dataset]:
+                    for p, crop_texts in zip(positions, next(results)):
+                        texts[p].update(crop_texts)
+                        if manifest:
+                            cache_crop_texts(manifest, sections[p], crop_texts, keys, p)
+                # Разделы датасета пишутся, когда посчитаны все его кропы
+                with stage("save", dataset=Path(dataset).name, file=str(output_file)):
+                    for p in positions:
+                        f.write(sections[p][1])
+                        f.writelines(texts[p][crop_num] for crop_num, _ in sections[p][3])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if manifest:
+            manifest.evict(keep=set(keys.values()))
+            manifest.save()
+
+
+def cache_crop_texts(manifest, section, crop_texts, keys, p):
+    """Сохраняет отчеты кропов раздела рядом с манифестом (кропы с ошибками не кэшируются)."""
+    _, _, calculator, jobs = section
+    jobs = dict(jobs)
+    manifest.path.parent.mkdir(parents=True, exist_ok=True)
+    for crop_num, text in crop_texts.items():
+        if "Error processing crop" in text:
+            continue
+        key = keys[p, crop_num]
+        cache_path = manifest.path.parent / f"{hashlib.sha1(key.encode()).hexdigest()}.txt"
+        cache_path.write_text(text)
+        manifest.record(key, job_inputs(jobs[crop_num]), calculator.parameters(), [cache_path])
+
+
+def analyze_real_data(data_dir, output_file, index=None):
+    calculator = ImageMetricCalculator()
+    index = index or DatasetIndex(data_dir)
+    header = f"\n=== Real Data Analysis for {data_dir.name} ===\n"
+    write_report([(data_dir, header, calculator, real_data_jobs(calculator, index))], output_file)
+
+
+def analyze_dehazing_results(real_data_dir, dehazed_dir, output_file, index=None):
+    calculator = ImageMetricCalculator()
+    index = index or DatasetIndex(real_data_dir, dehazed_dir)
+    header = f"\n\n=== Dehazing Results Analysis for {real_data_dir.name} ===\n"
+    write_report([(real_data_dir, header, calculator, dehazing_jobs(calculator, index))], output_file)
+
+
+def main(workers=1, force=False, hash_contents=False, cache_limit=None, trace=None, trace_memory=False, trace_top=10):
+    if trace:
+        tracer.enable(trace, memory=trace_memory)
     base_dir = Path("Real")
     output_file = "metrics_results.txt"
+    calculator = ImageMetricCalculator()
+    # Отчеты кропов с неизменными входами берутся из кэша предыдущих запусков
+    manifest = RunManifest(Path(".metrics_cache") / "manifest.json", hash_contents=hash_contents,
+                           force=force, max_bytes=cache_limit)
     
     with open(output_file, 'w') as f:
         f.write("=== Metrics Analysis Results ===\n")
     
+    sections = []
     for data_num in range(1, 8):
         real_data_dir = base_dir / f"real_dataset_crops/crops_for_inference/data{data_num}"
         dehazed_dir = base_dir / f"results/data{data_num}"
@@ -180,16 +529,34 @@ def main():
         if not real_data_dir.exists():
             print(f"Directory {real_data_dir} not found, skipping...")
             continue
-            
-        analyze_real_data(real_data_dir, output_file)
+        
+        # Один проход по каталогам на датасет, общий для обеих фаз
+        index = DatasetIndex(real_data_dir, dehazed_dir)
+        sections.append((real_data_dir, f"\n=== Real Data Analysis for {real_data_dir.name} ===\n",
+                         calculator, real_data_jobs(calculator, index)))
         
         if not dehazed_dir.exists():
             print(f"Directory {dehazed_dir} not found, skipping dehazing analysis...")
             continue
             
-        analyze_dehazing_results(real_data_dir, dehazed_dir, output_file)
-        
+        sections.append((real_data_dir, f"\n\n=== Dehazing Results Analysis for {real_data_dir.name} ===\n",
+                         calculator, dehazing_jobs(calculator, index)))
+    
+    write_report(sections, output_file, workers, manifest=manifest)
     print(f"\nAll metrics saved to {output_file}")
+    tracer.summary(trace_top)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Метрики для кропов реальных данных и результатов дехейзинга")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Число процессов (1 - последовательно, 0 - по числу ядер)")
+    parser.add_argument("--force", action="store_true", help="Пересчитать все кропы, не используя кэш")
+    parser.add_argument("--hash", action="store_true",
+                        help="Сравнивать входные файлы по SHA-256 содержимого, а не по размеру и mtime")
+    parser.add_argument("--cache-limit", type=float, default=None,
+                        help="Предел объема кэша отчетов, МБ (LRU)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    cache_limit = int(args.cache_limit * 1024**2) if args.cache_limit is not None else None
+    main(workers=args.workers or default_workers(), force=args.force, hash_contents=args.hash, cache_limit=cache_limit,
+         trace=args.trace, trace_memory=args.trace_memory, trace_top=args.trace_top)
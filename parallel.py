@@ -0,0 +1,110 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.context import SpawnContext, SpawnProcess
+from instrument import tracer
+
+# Переменные окружения, ограничивающие потоки BLAS/OpenMP в дочерних процессах
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                   "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+
+def set_thread_env(threads=1):
+    """
+    Задает переменные окружения числа потоков BLAS/OpenMP. Действуют на библиотеки,
+    загружаемые после вызова, и наследуются процессами, запущенными через spawn.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+
+
+@contextmanager
+def thread_env(threads=1):
+    """Временно задает переменные окружения числа потоков (set_thread_env), затем восстанавливает прежние."""
+    saved = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    set_thread_env(threads)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class ThreadLimitedContext(SpawnContext):
+    """
+    Контекст spawn, процессы которого запускаются с ограничением потоков в окружении:
+    переменные задаются только на время запуска процесса (дочерний процесс получает их
+    до импорта numpy), окружение текущего процесса не меняется.
+    """
+    def __init__(self, threads=1):
+        super().__init__()
+        self.threads = threads
+
+    def Process(self, *args, **kwargs):
+        return _ThreadLimitedProcess(self.threads, *args, **kwargs)
+
+
+class _ThreadLimitedProcess(SpawnProcess):
+    def __init__(self, threads, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = threads
+
+    def start(self):
+        with thread_env(self.threads):
+            super().start()
+
+
+def limit_threads(threads=1):
+    """
+    Ограничивает число потоков BLAS/OpenMP/OpenCV в текущем процессе:
+    для уже загруженных библиотек используются cv2.setNumThreads и threadpoolctl, если он установлен.
+
+    :param threads: Число потоков на процесс.
+    """
+    set_thread_env(threads)
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+def init_worker(threads=1, trace=None):
+    """
+    Инициализатор процесса пула: ограничение потоков (limit_threads) и продолжение трассы
+    родителя (trace - tracer.config() родителя; None - без трассировки).
+    """
+    limit_threads(threads)
+    if trace is not None:
+        path, memory = trace
+        tracer.enable(path, memory=memory, append=True)
+
+
+def default_workers():
+    """Число рабочих процессов по умолчанию - число доступных ядер."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def process_pool(workers, threads_per_worker=1):
+    """
+    Пул процессов для фоновых заданий (кропы датасетов, запись карт).
+    Процессы запускаются через spawn с ограничением потоков в окружении (ThreadLimitedContext),
+    чтобы оно применялось до импорта numpy; окружение и потоки текущего процесса не меняются.
+    Если трассировка включена до создания пула, процессы дописывают ту же трассу (init_worker).
+
+    :param workers: Число процессов.
+    :param threads_per_worker: Число потоков BLAS/OpenCV в каждом процессе.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ThreadLimitedContext(threads_per_worker),
+                               initializer=init_worker, initargs=(threads_per_worker, tracer.config()))
@@ -0,0 +1,118 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+import numpy as np
+import cv2
+from matplotlib import colormaps
+from parallel import process_pool
+from map_store import MapStore
+
+# Сколько карт может ждать записи в пуле MapRenderer, прежде чем submit начнет ждать
+MAX_PENDING_MAPS = 64
+# Таблица inferno на 256 цветов в порядке BGR (для cv2.imwrite)
+INFERNO_LUT = np.ascontiguousarray(colormaps['inferno'](np.arange(256), bytes=True)[:, 2::-1])
+
+
+def colorize(values, vmin, vmax, lut=INFERNO_LUT):
+    """
+    Раскрашивает 2D карту через таблицу цветов: значения нормируются в [vmin, vmax]
+    с обрезкой, индекс цвета - floor(x * 256) как в matplotlib, NaN - черный.
+
+    :return: Изображение (H, W, 3) uint8, BGR.
+    """
+    x = (np.asarray(values, dtype=np.float32) - np.float32(vmin)) / np.float32(vmax - vmin)
+    index = np.clip(np.nan_to_num(x * 256, nan=-1), 0, 255).astype(np.uint8)
+    image = lut[index]
+    image[np.isnan(values)] = 0
+    return image
+
+
+def save_map(path, values, vmin, vmax):
+    """Сохраняет карту метрики в PNG без matplotlib-фигуры."""
+    cv2.imwrite(str(path), colorize(values, vmin, vmax))
+
+
+class MapRenderer:
+    """
+    Фоновая запись карт метрик: раскраска и кодирование PNG идут в пуле процессов,
+    расчет метрик их не ждет, пока в очереди меньше max_pending карт; дальше submit ждет
+    записи, так что память под переданные карты ограничена. При workers=0 карты пишутся
+    сразу в текущем процессе.
+    """
+    def __init__(self, workers=2, max_pending=MAX_PENDING_MAPS):
+        self.executor = process_pool(workers) if workers > 0 else None
+        self.max_pending = max_pending
+        self.futures = set()
+
+    def submit(self, path, values, vmin, vmax):
+        if self.executor is None:
+            save_map(path, values, vmin, vmax)
+            return
+        while len(self.futures) >= self.max_pending:
+            done, self.futures = wait(self.futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self.futures.add(self.executor.submit(save_map, path, np.ascontiguousarray(values), vmin, vmax))
+
+    def wait(self):
+        """Дожидается записанных карт (ошибки записи пробрасываются)."""
+        futures, self.futures = self.futures, set()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def render_store(store, output_dir, crops=None, metrics=None, pairs=None, bands=None, step=5):
+    """
+    Рисует в PNG выбранные карты из MapStore: имена файлов как у analyse.py
+    (crop_{N}_{пара}_ch{канал}.png для поканальных карт, crop_{N}_{пара}.png для 2D).
+
+    :param bands: Список каналов; None - каждый step-й канал.
+    :return: Число записанных файлов.
+    """
+    count = 0
+    for meta in store.entries():
+        if crops and meta["crop"] not in crops or metrics and meta["metric"] not in metrics:
+            continue
+        vmin, vmax = meta["range"] or (0, 1)
+        metric_dir = Path(output_dir) / meta["metric"]
+        metric_dir.mkdir(parents=True, exist_ok=True)
+        for index, pair_name in enumerate(meta["pairs"]):
+            if pairs and pair_name not in pairs:
+                continue
+            maps = store.load(meta["crop"], meta["metric"], pair=index)
+            if maps.ndim == 2:
+                save_map(metric_dir / f"crop_{meta['crop']}_{pair_name}.png", maps, vmin, vmax)
+                count += 1
+                continue
+            for channel in (bands if bands is not None else range(0, maps.shape[2], step)):
+                save_map(metric_dir / f"crop_{meta['crop']}_{pair_name}_ch{channel}.png", maps[:, :, channel], vmin, vmax)
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отрисовка карт метрик из хранилища (results/maps) в PNG")
+    parser.add_argument("maps_dir", help="Каталог MapStore, например 1/results/maps")
+    parser.add_argument("--out", default=None, help="Каталог для PNG (по умолчанию <maps_dir>/png)")
+    parser.add_argument("--crop", type=int, nargs="*", help="Номера кропов")
+    parser.add_argument("--metric", nargs="*", help="Имена метрик")
+    parser.add_argument("--pair", nargs="*", help="Имена пар")
+    parser.add_argument("--bands", type=int, nargs="*", help="Каналы (по умолчанию каждый --step-й)")
+    parser.add_argument("--step", type=int, default=5, help="Шаг по каналам")
+    args = parser.parse_args()
+    output_dir = args.out or Path(args.maps_dir) / "png"
+    count = render_store(MapStore(args.maps_dir), output_dir, args.crop, args.metric, args.pair, args.bands, args.step)
+    print(f"{count} map(s) saved to {output_dir}")
@@ -0,0 +1,141 @@
+import json
+from pathlib import Path
+import numpy as np
+
+# Форматы хранения кубов: исходный float32, uint16 с масштабом и смещением, float16
+STORAGE_FORMATS = ("float32", "uint16", "float16")
+# Описание квантования .npy лежит рядом: {файл}.npy -> {файл}.quant.json
+QUANT_SUFFIX = ".quant.json"
+UINT16_LEVELS = np.iinfo(np.uint16).max
+# Число строк куба, квантуемых за раз
+QUANT_ROWS = 256
+
+
+def quantize(array, storage="float32", lossless=False):
+    """
+    Переводит куб в компактный формат хранения.
+
+    uint16: x = q * scale + offset. Целочисленная радиометрия (кропы hazed, читаемые из ENVI
+    без пересчета) с диапазоном до 65535 хранится с scale=1 без потерь; нецелые значения
+    (например, после варпа) - с шагом (max - min) / 65535. float16 без потерь хранит
+    целые только до 2048, 12-битные данные округляются до четных.
+
+    :param storage: Формат из STORAGE_FORMATS.
+    :param lossless: Требовать точного восстановления (иначе ValueError).
+    :return: (данные для записи, описание квантования или None для float32). В описании -
+        scale, offset, исходный тип, exact (восстановление побитно точное) и max_error.
+    """
+    if storage not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown storage format: {storage}. Expected one of {STORAGE_FORMATS}")
+    if storage == "float32":
+        return np.asarray(array, dtype=np.float32), None
+    if not np.all(np.isfinite(array)):
+        raise ValueError(f"Can't store non-finite values as {storage}")
+
+    if storage == "float16":
+        data = np.asarray(array).astype(np.float16)
+        meta = {"storage": storage, "scale": 1.0, "offset": 0.0}
+    else:
+        low, high = float(np.min(array)), float(np.max(array))
+        integral = all(np.array_equal(array[rows], np.round(array[rows])) for rows in _row_chunks(array))
+        if integral and high - low <= UINT16_LEVELS:
+            scale, offset = 1.0, low
+        else:
+            scale, offset = ((high - low) / UINT16_LEVELS or 1.0), low
+        data = np.empty(array.shape, dtype=np.uint16)
+        for rows in _row_chunks(array):
+            levels = np.subtract(array[rows], offset, dtype=np.float64)
+            levels /= scale
+            np.rint(levels, out=levels)
+            np.clip(levels, 0, UINT16_LEVELS, out=levels)
+            data[rows] = levels
+        meta = {"storage": storage, "scale": scale, "offset": offset}
+
+    meta["dtype"] = np.dtype(np.float32).str
+    meta["max_error"] = max((float(np.max(np.abs(dequantize(data[rows], meta) - array[rows])))
+                             for rows in _row_chunks(array) if array[rows].size), default=0.0)
+    meta["exact"] = meta["max_error"] == 0
+    if lossless and not meta["exact"]:
+        raise ValueError(f"{storage} storage is lossy for these data (max error {meta['max_error']:.4g})")
+    return data, meta
+
+
+def _row_chunks(array, rows=QUANT_ROWS):
+    # Большие кубы (выровненные сцены) квантуются полосами строк: временные массивы - объема полосы
+    for start in range(0, array.shape[0], rows):
+        yield slice(start, start + rows)
+
+
+def dequantize(data, meta, out=None):
+    """
+    Значения float32 из хранимых данных: без промежуточных массивов, прямо в out
+    (например, в буфер, который потом нормализуется на месте).
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    out[...] = data
+    if meta is not None:
+        if meta["scale"] != 1:
+            out *= np.float32(meta["scale"])
+        if meta["offset"] != 0:
+            out += np.float32(meta["offset"])
+    return out
+
+
+def quant_path(path):
+    path = Path(path)
+    return path.with_name(path.stem + QUANT_SUFFIX)
+
+
+def read_quantization(path):
+    """Описание квантования .npy или None, если файл хранится как есть."""
+    meta_path = quant_path(path)
+    if not meta_path.exists():
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_npy(path, data, meta=None):
+    """Сохраняет .npy и, для квантованных данных, описание квантования рядом (старое удаляется)."""
+    path = Path(path)
+    np.save(path, data)
+    if meta is None:
+        quant_path(path).unlink(missing_ok=True)
+        return
+    with open(quant_path(path), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4)
+
+
+def save_array(path, array, storage="float32", lossless=False):
+    """Сохраняет куб в формате storage (см. quantize). :return: Описание квантования или None."""
+    data, meta = quantize(array, storage, lossless)
+    save_npy(path, data, meta)
+    return meta
+
+
+class QuantizedArray:
+    """
+    Квантованный .npy, открытый через memmap: срезы возвращаются сразу в float32
+    (читается и переводится только запрошенная часть, например фрагмент сцены в tiled.py).
+    """
+    def __init__(self, data, meta):
+        self.data = data
+        self.meta = meta
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        return dequantize(self.data[key], self.meta)
+
+    def __array__(self, dtype=None, copy=None):
+        values = dequantize(self.data, self.meta)
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+
+def open_array(path):
+    """Куб .npy через memmap: как есть или, если он квантован, QuantizedArray со значениями float32."""
+    data = np.load(path, mmap_mode='r')
+    meta = read_quantization(path)
+    return data if meta is None else QuantizedArray(data, meta)
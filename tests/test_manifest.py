@@ -0,0 +1,29 @@
+import metrics
+from manifest import RunManifest
+from metrics import SSIM, UQI, PSNR, metric_parameters
+
+def test_metric_parameters_keep_only_result_parameters():
+    params = metric_parameters([PSNR, SSIM, UQI])
+    assert params["SSIM"] == {"window_size": 11, "window": "gaussian"}
+    assert params["PSNR"] == {}
+    assert params["version"] == metrics.METRICS_VERSION
+
+def test_lookup_misses_after_metrics_version_change(tmp_path, monkeypatch):
+    source, output = tmp_path / "crop.npy", tmp_path / "crop_0_metrics.json"
+    source.write_bytes(b"crop")
+    output.write_text("{}")
+    manifest = RunManifest(tmp_path / "manifest.json")
+    manifest.record("crop_0", [source], metric_parameters([SSIM]), [output])
+    assert manifest.lookup("crop_0", [source], metric_parameters([SSIM])) == [str(output)]
+    monkeypatch.setattr(metrics, "METRICS_VERSION", metrics.METRICS_VERSION + 1)
+    assert manifest.lookup("crop_0", [source], metric_parameters([SSIM])) is None
+
+def test_lookup_misses_entries_of_old_manifest_format(tmp_path):
+    source, output = tmp_path / "crop.npy", tmp_path / "crop_0_metrics.json"
+    source.write_bytes(b"crop")
+    output.write_text("{}")
+    manifest = RunManifest(tmp_path / "manifest.json")
+    manifest.record("crop_0", [source], {}, [output])
+    del manifest.entries["crop_0"]["version"]
+    manifest.save()
+    assert RunManifest(tmp_path / "manifest.json").lookup("crop_0", [source], {}) is None
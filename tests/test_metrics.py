@@ -0,0 +1,93 @@
+import tracemalloc
+import numpy as np
+import pytest
+from scipy.ndimage import convolve
+from metrics import (PSNR, SSIM, UQI, SAM, RMSE, PAIR_WORKSPACE_CUBES, ImageFeatures, PairEvaluator,
+                     batched_evaluators, batched_pair_means, create_window, gaussian, local_moments, metric_mean)
+
+METRICS = [PSNR, SSIM, UQI, SAM, RMSE]
+
+@pytest.fixture
+def pair():
+    rng = np.random.default_rng(0)
+    return rng.random((48, 48, 64), dtype=np.float32), rng.random((48, 48, 64), dtype=np.float32)
+
+def per_band_moments(img1, img2, window_size):
+    """Моменты поканальной 2D-сверткой в float64, как в исходных SSIM/UQI."""
+    window = create_window(window_size)
+    def local_mean(cube):
+        return np.stack([convolve(cube[:, :, c], window, mode='constant', cval=0.0) for c in range(cube.shape[2])],
+                        axis=-1)
+    mu1, mu2 = local_mean(img1), local_mean(img2)
+    return (mu1, mu2, local_mean(img1 * img1) - mu1**2, local_mean(img2 * img2) - mu2**2,
+            local_mean(img1 * img2) - mu1 * mu2)
+
+def peak_bytes(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@pytest.mark.parametrize("window_size", [8, 11])
+def test_fused_moments_match_per_band_convolve(pair, window_size):
+    x, y = pair[0][..., :6], pair[1][..., :6]
+    expected = per_band_moments(x.astype(np.float64), y.astype(np.float64), window_size)
+    for moment, reference in zip(local_moments(x, y, gaussian(window_size, 1.5)), expected):
+        assert moment.dtype == np.float32
+        np.testing.assert_allclose(moment, reference, rtol=0, atol=1e-6)
+
+def test_ssim_and_uqi_maps_match_per_band_convolve(pair):
+    x, y = pair[0][..., :6], pair[1][..., :6]
+    mu1, mu2, sigma1_sq, sigma2_sq, sigma12 = per_band_moments(x.astype(np.float64), y.astype(np.float64), 11)
+    C1, C2 = 0.01**2, 0.03**2
+    ssim = ((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / ((mu1**2 + mu2**2 + C1) * (sigma1_sq + sigma2_sq + C2) + 1e-12)
+    np.testing.assert_allclose(SSIM(x, y), 1 - np.clip(ssim, 0., 1.), rtol=0, atol=1e-5)
+    mu1, mu2, sigma1_sq, sigma2_sq, sigma12 = per_band_moments(x.astype(np.float64), y.astype(np.float64), 8)
+    uqi = 4 * mu1 * mu2 * sigma12 / ((mu1**2 + mu2**2) * (sigma1_sq + sigma2_sq) + 1e-12)
+    np.testing.assert_allclose(UQI(x, y), uqi, rtol=0, atol=1e-5)
+
+def test_band_block_means_match_full_maps(pair):
+    full = PairEvaluator(*pair).means(METRICS)
+    for band_block in (4, 16, 40):
+        blocked = PairEvaluator(*pair).means(METRICS, band_block=band_block)
+        for name, value in full.items():
+            assert blocked[name] == pytest.approx(value, rel=1e-6)
+
+def test_metric_mean_peak_falls_with_band_block(pair):
+    cube = pair[0].nbytes
+    peaks = [peak_bytes(metric_mean, SSIM, *pair, band_block=band_block) for band_block in (None, 16, 4)]
+    assert peaks[0] > peaks[1] > peaks[2]
+    assert peaks[2] < cube
+
+def test_means_peak_falls_with_band_block(pair):
+    peaks = [peak_bytes(PairEvaluator(*pair).means, METRICS, band_block=band_block) for band_block in (None, 16, 4)]
+    assert peaks[0] > peaks[1] > peaks[2]
+
+def test_taken_features_are_cached_and_counted(pair):
+    features = ImageFeatures(np.stack(pair))
+    taken = features.take([1, 0])
+    first = taken.local_stats(11)
+    assert taken.local_stats(11) is first
+    assert taken.reused() == {'local_stats(gaussian, 11)': 1}
+    np.testing.assert_array_equal(first[0][0], features.local_stats(11)[0][1])
+
+def test_batched_evaluators_split_groups_by_memory_budget():
+    rng = np.random.default_rng(1)
+    images = [rng.random((16, 16, 8), dtype=np.float32) for _ in range(7)]
+    pairs = [(0, k) for k in range(1, 7)]
+    budget = 2 * pair_budget(images[0])
+    chunks = list(batched_evaluators(images, pairs, memory_budget=budget))
+    assert [chunk for chunk, _ in chunks] == [[0, 1], [2, 3], [4, 5]]
+    for chunk, evaluator in chunks:
+        assert evaluator.input_features._parent.shape[0] == 3
+    results = batched_pair_means(images, pairs, METRICS, memory_budget=budget)
+    for (i, j), result in zip(pairs, results):
+        single = PairEvaluator(images[i], images[j]).means(METRICS)
+        for name, value in single.items():
+            assert result[name] == pytest.approx(value, rel=1e-6)
+
+def pair_budget(image):
+    """Бюджет памяти на одну пару изображений формы image."""
+    return PAIR_WORKSPACE_CUBES * image.nbytes
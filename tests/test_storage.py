@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from storage import UINT16_LEVELS, dequantize, open_array, quantize, save_array
+
+@pytest.fixture
+def radiance():
+    return np.random.default_rng(0).integers(0, 4096, (40, 30, 6)).astype(np.float32)
+
+def test_uint16_is_exact_for_integer_radiance(radiance):
+    data, meta = quantize(radiance, "uint16", lossless=True)
+    assert data.dtype == np.uint16 and meta["scale"] == 1.0 and meta["exact"]
+    np.testing.assert_array_equal(dequantize(data, meta), radiance)
+
+def test_uint16_error_is_within_half_step():
+    values = (np.random.default_rng(1).random((40, 30, 6)) * 4000).astype(np.float32)
+    data, meta = quantize(values, "uint16")
+    error = np.abs(dequantize(data, meta) - values).max()
+    step = (values.max() - values.min()) / UINT16_LEVELS
+    assert error == meta["max_error"]
+    # Половина шага квантования плюс округление float32 при восстановлении
+    assert error <= step / 2 + np.spacing(np.float32(values.max()))
+    with pytest.raises(ValueError):
+        quantize(values, "uint16", lossless=True)
+
+def test_float16_error_bounds(radiance):
+    small = np.minimum(radiance, 2048)
+    data, meta = quantize(small, "float16", lossless=True)
+    np.testing.assert_array_equal(dequantize(data, meta), small)
+    # 12-битные значения выше 2048 округляются до четных
+    data, meta = quantize(radiance, "float16")
+    assert meta["max_error"] <= 1.0
+    np.testing.assert_array_equal(np.abs(dequantize(data, meta) - radiance) <= 1.0, True)
+
+def test_open_array_dequantizes_slices(tmp_path):
+    values = (np.random.default_rng(2).random((40, 30, 6)) * 4000).astype(np.float32)
+    meta = save_array(tmp_path / "cube.npy", values, "uint16")
+    cube = open_array(tmp_path / "cube.npy")
+    window = cube[5:20, 3:17]
+    assert window.dtype == np.float32
+    np.testing.assert_array_equal(window, dequantize(np.load(tmp_path / "cube.npy")[5:20, 3:17], meta))
+    assert np.abs(window - values[5:20, 3:17]).max() <= meta["max_error"]
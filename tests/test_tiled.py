@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from metrics import PairEvaluator, stress_metric
+from tiled import TILED_METRICS, TiledEvaluator, iter_tiles
+
+@pytest.fixture
+def scene_pair(tmp_path):
+    rng = np.random.default_rng(0)
+    input, target = rng.random((70, 90, 5), dtype=np.float32), rng.random((70, 90, 5), dtype=np.float32)
+    np.save(tmp_path / "input.npy", input)
+    np.save(tmp_path / "target.npy", target)
+    return np.load(tmp_path / "input.npy", mmap_mode='r'), np.load(tmp_path / "target.npy", mmap_mode='r')
+
+def test_tiles_cover_image_once():
+    covered = np.zeros((70, 90), dtype=int)
+    for core, padded in iter_tiles(70, 90, (32, 40), 5):
+        covered[core] += 1
+        assert all(p.start <= c.start and c.stop <= p.stop for c, p in zip(core, padded))
+    assert np.all(covered == 1)
+
+@pytest.mark.parametrize("tile", [(32, 40), (70, 33), (17, 90)])
+def test_tiled_maps_match_whole_image(tmp_path, scene_pair, tile):
+    evaluator = TiledEvaluator(tile=tile)
+    means = evaluator.evaluate(*scene_pair, per_band=True, maps_dir=tmp_path / "maps")
+    whole = PairEvaluator(np.asarray(scene_pair[0]), np.asarray(scene_pair[1]))
+    expected = whole.means(TILED_METRICS, per_band=True)
+    for metric in TILED_METRICS:
+        name = metric.__name__
+        assert means[name][0] == pytest.approx(expected[name][0], rel=1e-9)
+        if expected[name][1] is not None:
+            np.testing.assert_allclose(means[name][1], expected[name][1], rtol=1e-9)
+        if metric is not stress_metric:
+            np.testing.assert_array_equal(np.load(tmp_path / "maps" / f"{name}.npy"), whole.map(metric))
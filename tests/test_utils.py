@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from utils import open_envi_memmap, read_envi_bands
+
+@pytest.mark.parametrize("interleave", ["bsq", "bil", "bip"])
+@pytest.mark.parametrize("scale", [1.0, 3.3, 10000.0])
+def test_read_envi_bands_matches_envi_load(tmp_path, interleave, scale):
+    data = np.random.default_rng(0).integers(0, 4096, (20, 30, 6)).astype(np.uint16)
+    hdr_path, img_path = str(tmp_path / "scene.hdr"), str(tmp_path / "scene.img")
+    envi.save_image(hdr_path, data, dtype=np.uint16, interleave=interleave,
+                    metadata={"reflectance scale factor": scale})
+    expected = np.asarray(envi.open(hdr_path, img_path).load())[4:14, 3:28, [0, 2, 3, 5]]
+    cube, file_interleave, file_scale = open_envi_memmap(hdr_path, img_path)
+    result = read_envi_bands(cube, file_interleave, [0, 2, 3, 5], (3, 4, 25, 10), file_scale)
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, expected)
+    exact = data[4:14, 3:28, [0, 2, 3, 5]] / scale
+    np.testing.assert_allclose(result, exact, rtol=np.finfo(np.float32).eps)
@@ -0,0 +1,32 @@
+import numpy as np
+import cv2
+import pytest
+from warp import WARP_TOLERANCE, WarpEngine, warp_crops
+
+PROJECTIVE = np.array([[1.01, 0.02, 3.5], [-0.015, 0.99, -2.2], [1e-5, -2e-5, 1.0]])
+AFFINE = np.array([[0.98, 0.03, -4.25], [-0.02, 1.02, 6.5], [0.0, 0.0, 1.0]])
+
+@pytest.fixture
+def scene():
+    # Шум на весь диапазон - худший случай для ошибки интерполяции
+    return (np.random.default_rng(0).random((240, 300, 7)) * 4000).astype(np.float32)
+
+def test_warp_matches_per_band_warp_perspective(scene):
+    height, width = scene.shape[:2]
+    expected = np.stack([cv2.warpPerspective(scene[:, :, band], PROJECTIVE, (width, height))
+                         for band in range(scene.shape[2])], axis=-1)
+    warped = WarpEngine(workers=2).warp(scene, PROJECTIVE, (width, height))
+    tolerance = WARP_TOLERANCE * max(width, height) * float(scene.max() - scene.min())
+    assert np.abs(warped - expected).max() <= tolerance
+
+@pytest.mark.parametrize("H", [PROJECTIVE, AFFINE])
+@pytest.mark.parametrize("channels", [3, 7, 122])
+def test_crop_only_warp_equals_warp_then_crop(H, channels):
+    scene = (np.random.default_rng(1).random((150, 170, channels)) * 4000).astype(np.float32)
+    height, width = 160, 180
+    # Окна внутри сцены, у края и частично за краем выходной сцены
+    coordinates = [{'x': 0, 'y': 0}, {'x': 37, 'y': 21}, {'x': 120, 'y': 100}, {'x': 179, 'y': 159}]
+    warped = WarpEngine().warp(scene, H, (width, height))
+    crops = warp_crops(scene, H, coordinates, height, width, size=64)
+    for coords, crop in zip(coordinates, crops):
+        np.testing.assert_array_equal(crop, warped[coords['y']:coords['y'] + 64, coords['x']:coords['x'] + 64])
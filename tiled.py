@@ -0,0 +1,219 @@
+import argparse
+import inspect
+import math
+from pathlib import Path
+import numpy as np
+from instrument import stage, tracer, add_trace_arguments
+from loader import normalize_
+from storage import open_array
+from metrics import (MSE, PSNR, RMSE, SSIM, UQI, SAM, stress_metric, BAND_SEPARABLE, ACCUM_DTYPE, WORK_DTYPE,
+                     DEFAULT_MEMORY_BUDGET, PAIR_WORKSPACE_CUBES, ImageFeatures, PairEvaluator, Workspace,
+                     _stress)
+
+# Метрики, которые считаются по фрагментам: карта в пикселе зависит только от окрестности
+# не больше окна (UQI_box без дополнения краев меняет форму карты и не поддерживается)
+TILED_METRICS = (MSE, PSNR, RMSE, SSIM, UQI, SAM, stress_metric)
+# Наименьшая сторона фрагмента без перекрытия: на более мелких доля перекрытия слишком велика
+MIN_TILE = 32
+
+
+def metric_halo(metrics):
+    """
+    Ширина перекрытия фрагментов для набора метрик: половина наибольшего окна (window_size
+    по умолчанию). Окно в пикселе не выходит за эту окрестность, поэтому карта в пикселях
+    фрагмента без перекрытия такая же, как при расчете по всему изображению.
+    """
+    halo = 0
+    for metric in metrics:
+        window_size = inspect.signature(metric).parameters.get('window_size')
+        if window_size is not None:
+            halo = max(halo, window_size.default // 2)
+    return halo
+
+
+def tile_shape(height, width, channels, halo, memory_budget=DEFAULT_MEMORY_BUDGET, cubes=PAIR_WORKSPACE_CUBES):
+    """
+    Размер фрагмента (без перекрытия), при котором расчет метрик пары укладывается в memory_budget.
+    Если помещается полоса во всю ширину хотя бы из MIN_TILE строк, берутся полосы (строки .npy
+    лежат в файле подряд), иначе - квадраты.
+
+    :return: (высота, ширина) фрагмента.
+    """
+    pixels = memory_budget // (cubes * channels * np.dtype(WORK_DTYPE).itemsize)
+    rows = pixels // (width + 2 * halo) - 2 * halo
+    if rows >= min(MIN_TILE, height):
+        return min(rows, height), width
+    side = math.isqrt(pixels) - 2 * halo
+    if side < MIN_TILE:
+        raise ValueError(f"Memory budget {memory_budget / 1024**2:.0f} MB is too small for {channels} channel(s) "
+                         f"with halo {halo}")
+    return min(side, height), min(side, width)
+
+
+def iter_tiles(height, width, tile, halo):
+    """
+    Фрагменты изображения: (строки, столбцы) фрагмента без перекрытия и (строки, столбцы)
+    того же фрагмента с перекрытием halo, обрезанным по краям изображения.
+    """
+    tile_height, tile_width = tile
+    for y in range(0, height, tile_height):
+        for x in range(0, width, tile_width):
+            core = slice(y, min(y + tile_height, height)), slice(x, min(x + tile_width, width))
+            padded = (slice(max(core[0].start - halo, 0), min(core[0].stop + halo, height)),
+                      slice(max(core[1].start - halo, 0), min(core[1].stop + halo, width)))
+            yield core, padded
+
+
+class TiledEvaluator:
+    """
+    Метрики пары изображений (H, W, C), которые не помещаются в память целиком (сцены
+    пролета, memmap .npy): изображения читаются фрагментами с перекрытием под окно SSIM/UQI,
+    метрики каждого фрагмента считает PairEvaluator, от фрагмента остаются суммы по каналам
+    (float64), а при заданном maps_dir карты пишутся в memmap-файлы полного размера.
+
+    Карты совпадают с картами PairEvaluator по всему изображению побитно: за краями сцены
+    окно по-прежнему дополняется нулями, внутри - реальными пикселями перекрытия. Для PSNR
+    максимумы каналов входного изображения считаются отдельным проходом по сцене. Средние
+    собираются из сумм по фрагментам и отличаются от средних по целому изображению только
+    порядком суммирования.
+    """
+    def __init__(self, metrics=TILED_METRICS, memory_budget=DEFAULT_MEMORY_BUDGET, tile=None, scale=None,
+                 bands=None, workspace=None):
+        """
+        :param metrics: Метрики из TILED_METRICS.
+        :param memory_budget: Предел памяти на расчет фрагмента (байт), определяет размер фрагмента.
+        :param tile: (высота, ширина) фрагмента без перекрытия; None - по memory_budget.
+        :param scale: Нормализация фрагментов как при загрузке кропов (/ scale с обрезкой в [0, 1]).
+        :param bands: bands.BandSelection для кубов со всеми каналами сенсора (None - все каналы).
+        :param workspace: Workspace для временных массивов (буферы фрагментов одной формы переиспользуются).
+        """
+        unsupported = [metric.__name__ for metric in metrics if metric not in TILED_METRICS]
+        if unsupported:
+            raise ValueError(f"Metric(s) {unsupported} can't be computed tile by tile")
+        self.metrics = list(metrics)
+        self.memory_budget = memory_budget
+        self.tile = tile
+        self.scale = scale
+        self.bands = bands
+        self.workspace = workspace if workspace is not None else Workspace()
+        self.halo = metric_halo(self.metrics)
+
+    def _read(self, image, rows, cols):
+        """Фрагмент изображения в WORK_DTYPE: выбор каналов и нормализация без копии в исходном типе."""
+        channels = len(self.bands) if self.bands is not None else image.shape[2]
+        with stage("load") as record:
+            tile = np.empty((rows.stop - rows.start, cols.stop - cols.start, channels), dtype=WORK_DTYPE)
+            if self.bands is not None:
+                self.bands.take(image[rows, cols], out=tile)
+            else:
+                tile[...] = image[rows, cols]
+            if self.scale is not None:
+                normalize_(tile, self.scale)
+            record["bytes"] = tile.nbytes
+        return tile
+
+    def band_max(self, image, tile):
+        """Максимумы каналов всего изображения (1, 1, C) для PSNR - отдельный проход без перекрытия."""
+        band_max = None
+        for core, _ in iter_tiles(*image.shape[:2], tile, 0):
+            tile_max = np.max(self._read(image, *core), axis=(0, 1), keepdims=True)
+            band_max = tile_max if band_max is None else np.maximum(band_max, tile_max)
+        return band_max
+
+    def tiles(self, input, target):
+        """
+        Фрагменты пары изображений: генератор (номер, фрагмент без перекрытия, его положение
+        внутри прочитанного фрагмента, PairEvaluator прочитанного фрагмента). Карты
+        evaluator.map(metric)[inner] совпадают с картами всего изображения в пикселях core.
+
+        :param input: Массив или memmap (H, W, C), например np.load(path, mmap_mode='r').
+        :param target: Массив той же формы.
+        """
+        if input.shape != target.shape:
+            raise ValueError(f"Image shapes don't match: {input.shape} vs {target.shape}")
+        H, W = input.shape[:2]
+        C = len(self.bands) if self.bands is not None else input.shape[2]
+        tile = self.tile or tile_shape(H, W, C, self.halo, self.memory_budget)
+        band_max = self.band_max(input, tile) if PSNR in self.metrics else None
+        for index, (core, padded) in enumerate(iter_tiles(H, W, tile, self.halo)):
+            inner = tuple(slice(c.start - p.start, c.stop - p.start) for c, p in zip(core, padded))
+            yield index, core, inner, PairEvaluator(ImageFeatures(self._read(input, *padded), self.workspace, band_max),
+                                                    ImageFeatures(self._read(target, *padded), self.workspace),
+                                                    self.workspace)
+
+    def evaluate(self, input, target, per_band=False, maps_dir=None):
+        """
+        Средние значения метрик по всему изображению, как PairEvaluator.means.
+
+        :param input: Массив или memmap (H, W, C), например np.load(path, mmap_mode='r').
+        :param target: Массив той же формы.
+        :param per_band: Возвращать (среднее, средние по каналам); для SAM и stress_metric - (среднее, None).
+        :param maps_dir: Каталог для полных карт {метрика}.npy (memmap); stress_metric карты не имеет.
+        :return: {имя метрики: среднее или (среднее, средние по каналам)}.
+        """
+        H, W = input.shape[:2]
+        C = len(self.bands) if self.bands is not None else input.shape[2]
+        map_metrics = [metric for metric in self.metrics if metric is not stress_metric]
+        sums = {metric.__name__: np.zeros(C if metric in BAND_SEPARABLE else (), dtype=ACCUM_DTYPE)
+                for metric in map_metrics}
+        spectral_sums = np.zeros(3, dtype=ACCUM_DTYPE)
+        maps = {}
+        if maps_dir is not None:
+            Path(maps_dir).mkdir(parents=True, exist_ok=True)
+
+        for index, core, inner, evaluator in self.tiles(input, target):
+            for metric in map_metrics:
+                name = metric.__name__
+                with stage("metric", metric=name, tile=index, bytes=evaluator.input.nbytes):
+                    metric_map = evaluator.map(metric)[inner]
+                    sums[name] += np.sum(metric_map, axis=(0, 1), dtype=ACCUM_DTYPE)
+                    if maps_dir is not None:
+                        if name not in maps:
+                            maps[name] = np.lib.format.open_memmap(Path(maps_dir) / f"{name}.npy", mode='w+',
+                                                                   dtype=metric_map.dtype,
+                                                                   shape=(H, W) + metric_map.shape[2:])
+                        maps[name][core] = metric_map
+            if stress_metric in self.metrics:
+                with stage("metric", metric="stress_metric", tile=index, bytes=evaluator.input.nbytes):
+                    norm_x, norm_y = evaluator.spectral_norms()
+                    for n, values in enumerate((norm_x, norm_y, evaluator.dot_product())):
+                        spectral_sums[n] += np.sum(values[inner], dtype=ACCUM_DTYPE)
+
+        for metric_map in maps.values():
+            metric_map.flush()
+
+        results = {}
+        for metric in self.metrics:
+            name = metric.__name__
+            values = None
+            if metric is stress_metric:
+                mean = float(_stress(*spectral_sums))
+            elif metric in BAND_SEPARABLE:
+                values = sums[name] / (H * W)
+                mean = float(np.mean(values))
+            else:
+                mean = float(sums[name] / (H * W))
+            results[name] = (mean, values) if per_band else mean
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Метрики пары больших кубов (H, W, C) .npy по фрагментам")
+    parser.add_argument("input", help="Путь к .npy (например, выровненная чистая сцена; возможно квантованная, storage.py)")
+    parser.add_argument("target", help="Путь к .npy той же формы")
+    parser.add_argument("--scale", type=float, default=4096.0, help="Нормализация: / scale с обрезкой в [0, 1]")
+    parser.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_BUDGET // 1024**2,
+                        help="Предел памяти на фрагмент, МБ")
+    parser.add_argument("--tile", type=int, nargs=2, default=None, metavar=("H", "W"),
+                        help="Размер фрагмента без перекрытия (по умолчанию - по пределу памяти)")
+    parser.add_argument("--maps-dir", default=None, help="Каталог для полных карт метрик (.npy, memmap)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable(args.trace, memory=args.trace_memory)
+
+    evaluator = TiledEvaluator(memory_budget=args.memory_mb * 1024**2, tile=args.tile, scale=args.scale)
+    results = evaluator.evaluate(open_array(args.input), open_array(args.target), maps_dir=args.maps_dir)
+    for name, value in results.items():
+        print(f"{name}: {value:.4f}")
+    tracer.summary(args.trace_top)
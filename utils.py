@@ -1,6 +1,13 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import spectral.io.envi as envi
+from bands import BandSelection
+
+# Коды 'data type' из заголовка ENVI -> типы numpy (без порядка байт)
+ENVI_DTYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 6: 'c8', 9: 'c16',
+               12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'}
 
 def find_deepest_directory(directory):
     """
@@ -28,6 +35,97 @@ def load_labels(json_path):
 
 
 
+def open_envi_memmap(hdr_path, img_path):
+    """
+    Открывает ENVI-изображение как memmap, не читая данные в память.
+    Раскладка (bsq/bil/bip), смещение данных и порядок байт берутся из заголовка.
+
+    :param hdr_path: Путь к .hdr файлу.
+    :param img_path: Путь к файлу с данными.
+    :return: (cube, interleave, scale) - представление формы (lines, samples, bands),
+             раскладка в файле и делитель 'reflectance scale factor'.
+    """
+    header = envi.read_envi_header(hdr_path)
+    lines, samples, bands = int(header['lines']), int(header['samples']), int(header['bands'])
+    dtype = np.dtype(ENVI_DTYPES[int(header['data type'])])
+    dtype = dtype.newbyteorder('>' if int(header.get('byte order', 0)) == 1 else '<')
+    offset = int(header.get('header offset', 0))
+    interleave = header.get('interleave', 'bsq').lower()
+
+    shapes = {'bsq': (bands, lines, samples), 'bil': (lines, bands, samples), 'bip': (lines, samples, bands)}
+    axes = {'bsq': (1, 2, 0), 'bil': (0, 2, 1), 'bip': (0, 1, 2)}
+    if interleave not in shapes:
+        raise ValueError(f"Неизвестная раскладка ENVI: {interleave}")
+
+    raw = np.memmap(img_path, dtype=dtype, mode='r', offset=offset, shape=shapes[interleave])
+    scale = float(header.get('reflectance scale factor', 1.0))
+    return raw.transpose(axes[interleave]), interleave, scale
+
+def read_envi_bands(cube, interleave, bands=None, window=None, scale=1.0, rows_per_read=256):
+    """
+    Читает из memmap только нужные каналы и, при необходимости, только прямоугольник window.
+    Результат - float32 с учетом scale: деление на scale идет в float32, как в
+    envi.open(...).load()[y:y+h, x:x+w, bands] (float32-куб делится на число), поэтому
+    от деления в float64 с последующим приведением к float32 он может отличаться
+    в пределах округления float32 (при scale, не представимом в float32, например 3.3).
+
+    :param cube: Представление (lines, samples, bands) из open_envi_memmap.
+    :param interleave: Раскладка файла, определяет порядок чтения.
+    :param bands: Индексы каналов или bands.BandSelection (None - все каналы).
+    :param window: (x, y, width, height) или None для всего изображения.
+    :param scale: Делитель 'reflectance scale factor'.
+    :param rows_per_read: Число строк, читаемых за раз для bil/bip.
+    :return: Массив (height, width, len(bands)) float32.
+    """
+    if window is not None:
+        x, y, width, height = window
+        cube = cube[y:y+height, x:x+width]
+    if not isinstance(bands, BandSelection):
+        bands = BandSelection(range(cube.shape[2]) if bands is None else bands)
+    out = np.empty(cube.shape[:2] + (len(bands),), dtype=np.float32)
+
+    if interleave == 'bsq':
+        # Каналы лежат в файле подряд: читаем нужные отрезки каналов целиком
+        bands.take(cube, out=out)
+    else:
+        # bil/bip: каналы пикселя рядом, читаем блоками строк и отбираем отрезки каналов
+        for start in range(0, cube.shape[0], rows_per_read):
+            bands.take(cube[start:start+rows_per_read], out=out[start:start+rows_per_read])
+
+    if scale != 1:
+        out /= np.float32(scale)
+    return out
+
+class EnviScene:
+    """
+    Сцена ENVI через memmap в виде массива (lines, samples, len(bands)) float32 без чтения в память:
+    срез [строки, столбцы] читает только этот прямоугольник выбранных каналов (read_envi_bands),
+    поэтому сцену можно считать по фрагментам (tiled.TiledEvaluator, grid.DenseGrid).
+    """
+    def __init__(self, hdr_path, img_path, bands=None):
+        """
+        :param bands: Индексы каналов или bands.BandSelection (None - все каналы).
+        """
+        self.cube, self.interleave, self.scale = open_envi_memmap(hdr_path, img_path)
+        self.bands = bands
+        channels = len(bands) if bands is not None else self.cube.shape[2]
+        self.shape = self.cube.shape[:2] + (channels,)
+        self.ndim = 3
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        y, y_stop, y_step = rows.indices(self.shape[0])
+        x, x_stop, x_step = cols.indices(self.shape[1])
+        if y_step != 1 or x_step != 1:
+            raise IndexError("Only contiguous windows can be read from an ENVI scene")
+        return read_envi_bands(self.cube, self.interleave, self.bands,
+                               (x, y, max(x_stop - x, 0), max(y_stop - y, 0)), self.scale)
+
+    def __array__(self, dtype=None, copy=None):
+        values = read_envi_bands(self.cube, self.interleave, self.bands, scale=self.scale)
+        return values if dtype is None else values.astype(dtype, copy=False)
+
 def find_matching_files(file_list, pattern1, pattern2 = "sc01_ort"):
     """
     Функция для поиска файлов в списке, которые содержат в названии два заданных шаблона.
@@ -40,13 +138,14 @@ def find_matching_files(file_list, pattern1, pattern2 = "sc01_ort"):
     matching_files = [file for file in file_list if pattern1 in file and pattern2 in file]
     return matching_files
 
-def add_image_metadata(json_file, default_width, default_height):
+def add_image_metadata(json_file, default_width, default_height, metadata=None):
     """
     Функция добавляет в JSON-файл ширину и высоту изображения, если их нет.
 
     :param json_file: Путь к JSON-файлу.
     :param default_width: Ширина изображения по умолчанию.
     :param default_height: Высота изображения по умолчанию.
+    :param metadata: Дополнительные поля (геометрия сцен, длины волн), записываются поверх имеющихся.
     """
     # Открываем JSON-файл
     with open(json_file, 'r', encoding='utf-8') as f:
@@ -57,33 +156,64 @@ def add_image_metadata(json_file, default_width, default_height):
         raise ValueError("JSON-файл должен содержать словарь.")
 
     # Добавляем ширину и высоту, если их нет
-    if 'width' not in data:
+    if 'width' not in data and default_width is not None:
         data['width'] = default_width
-    if 'height' not in data:
+    if 'height' not in data and default_height is not None:
         data['height'] = default_height
+    if metadata:
+        data.update(metadata)
 
     # Сохраняем обновлённый JSON-файл
     with open(json_file, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
+
+def read_scene_geometry(hdr_path):
+    """
+    Читает геометрию сцены только из заголовка ENVI, без загрузки данных.
+
+    :param hdr_path: Путь к .hdr файлу.
+    :return: Словарь width, height, bands, interleave, data_type, wavelength.
+    """
+    header = envi.read_envi_header(hdr_path)
+    return {
+        'width': int(header['samples']),
+        'height': int(header['lines']),
+        'bands': int(header['bands']),
+        'interleave': header.get('interleave', 'bsq').lower(),
+        'data_type': int(header['data type']),
+        'wavelength': [float(w) for w in header.get('wavelength', [])],
+    }
+
+def scan_dataset_metadata(json_path):
+    """
+    Собирает геометрию всех сцен датасета по заголовкам и сохраняет её в labels.json:
+    width/height берутся у hazed-сцены, по каждому файлу пишется запись в 'scenes',
+    список длин волн - в 'wavelength'.
+
+    :param json_path: Путь к labels.json датасета.
+    """
+    labels = load_labels(json_path)
+    scenes, wavelength = {}, None
+    width = height = None
+
+    for file, classe in zip(labels["files"], labels["class"]):
+        find_way = find_deepest_directory(file)
+        finded_files = sorted(find_matching_files(os.listdir(find_way), file))
+        geometry = read_scene_geometry(os.path.join(find_way, finded_files[1]))
+
+        wavelength = wavelength or geometry['wavelength']
+        scenes[file] = {key: value for key, value in geometry.items() if key != 'wavelength'}
+        print(f"{sorted(finded_files)} - {classe}")
+        if classe == 'hazed':
+            width, height = geometry['width'], geometry['height']
+
+    metadata = {'scenes': scenes}
+    if wavelength:
+        metadata['wavelength'] = wavelength
+    add_image_metadata(json_path, width, height, metadata)
+
 if __name__ == '__main__':
-    for i in range(7):
-        json_path = f"Transform/{i+1}/labels.json"
-        labels = load_labels(json_path)
-        
-        files = labels["files"]
-        classes = labels["class"]
-
-        
-        for file, classe in zip(files, classes):
-            find_way  = find_deepest_directory(file)
-            files_lst = os.listdir(find_way)
-            finded_files = sorted(find_matching_files(files_lst, file))
-            
-            print(f"{sorted(finded_files)} - {classe}")
-            img_path = os.path.join(find_way, finded_files[0])
-            hdr_path = os.path.join(find_way, finded_files[1])
-            
-            if classe == 'hazed':
-                hsi_image = envi.open(hdr_path, img_path).load()
-                h, w, c = hsi_image.shape
-                add_image_metadata(json_path, w, h)
\ No newline at end of file
+    # Читаются только заголовки, поэтому датасеты обрабатываются параллельно в потоках
+    json_paths = [f"Transform/{i+1}/labels.json" for i in range(7)]
+    with ThreadPoolExecutor(max_workers=len(json_paths)) as executor:
+        list(executor.map(scan_dataset_metadata, json_paths))
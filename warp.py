@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+
+# Допуск warp() относительно поканального cv2.warpPerspective: доля диапазона данных на пиксель
+# большей стороны выхода (ошибка координат в картах float32 растет с их величиной)
+WARP_TOLERANCE = 2.0**-21
+
+
+def band_chunks(num_bands):
+    """
+    Разбивает каналы на группы по 4 (остаток - по 3 или 1 каналу).
+    Для 1, 3 и 4 каналов cv2.remap и cv2.warpPerspective используют то же ядро интерполяции,
+    что и для одного канала, поэтому результат совпадает с поканальным варпом.
+
+    :return: Список срезов по оси каналов.
+    """
+    sizes = [4] * (num_bands // 4)
+    rest = num_bands % 4
+    if rest == 2:
+        sizes = sizes[:-1] + [3, 3] if sizes else [1, 1]
+    elif rest:
+        sizes.append(rest)
+    bounds = np.cumsum([0] + sizes)
+    return [slice(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def remap_tables(H, dsize, origin=(0, 0)):
+    """
+    Карты remap (координаты источника) для окна выходного изображения размера dsize = (width, height)
+    с левым верхним углом origin. Координаты считаются от абсолютных координат пикселей сцены
+    теми же операциями, что и для всей сцены, поэтому карты окна побитно совпадают с вырезом
+    из карт всей сцены.
+
+    :return: (map_x, map_y) float32 формы (height, width).
+    """
+    _, M = cv2.invert(np.asarray(H, dtype=np.float64), flags=cv2.DECOMP_LU)
+    width, height = dsize
+    x0, y0 = origin
+    xs = np.arange(x0, x0 + width, dtype=np.float64)[None, :]
+    ys = np.arange(y0, y0 + height, dtype=np.float64)[:, None]
+    W = M[2, 0] * xs + M[2, 1] * ys + M[2, 2]
+    W = np.divide(1.0, W, out=np.zeros_like(W), where=W != 0)
+    map_x = ((M[0, 0] * xs + M[0, 1] * ys + M[0, 2]) * W).astype(np.float32)
+    map_y = ((M[1, 0] * xs + M[1, 1] * ys + M[1, 2]) * W).astype(np.float32)
+    return map_x, map_y
+
+
+def warp_crops(hsi_image, H, coordinates, height, width, size=256):
+    """Кропы окон выровненной сцены без варпа всей сцены (см. WarpEngine.warp_crops), в одном потоке."""
+    return WarpEngine().warp_crops(hsi_image, H, coordinates, height, width, size)
+
+
+class WarpEngine:
+    """
+    Варп всей сцены по гомографии: таблицы remap (float32 карты координат источника)
+    считаются один раз на пару (H, геометрия) и кэшируются, каналы обрабатываются
+    группами по 1/3/4 за вызов cv2.remap, при workers > 1 - в пуле потоков (OpenCV отпускает GIL).
+    """
+    def __init__(self, workers=1, cache_size=4):
+        """
+        :param workers: Число потоков для групп каналов (1 - без пула).
+        :param cache_size: Сколько наборов таблиц хранить (вытесняются давно не использованные).
+        """
+        self.workers = workers
+        self.cache_size = cache_size
+        self._tables = OrderedDict()
+
+    def tables(self, H, dsize, origin=(0, 0)):
+        """
+        Карты remap для выходного окна размера dsize = (width, height) с левым верхним углом origin.
+
+        :return: (map_x, map_y) float32 формы (height, width).
+        """
+        H = np.asarray(H, dtype=np.float64)
+        key = (H.tobytes(), tuple(dsize), tuple(origin))
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+
+        map_x, map_y = remap_tables(H, dsize, origin)
+        self._tables[key] = (map_x, map_y)
+        if len(self._tables) > self.cache_size:
+            self._tables.popitem(last=False)
+        return map_x, map_y
+
+    def warp(self, hsi_image, H, dsize, origin=(0, 0), out=None):
+        """
+        Аналог поканального cv2.warpPerspective(band, H, dsize) для всех каналов сразу.
+        Координаты источника берутся из карт float32, округленных до половины ulp координаты,
+        и интерполяция переносит эту ошибку в значения пропорционально перепаду между соседними
+        пикселями. Поэтому большинство пикселей отличается от warpPerspective, но не больше
+        чем на 2**-21 * max(width, height) от диапазона данных (WARP_TOLERANCE); на шуме 0..4000
+        (перепад на весь диапазон) измерено 0.17 при 256 px, 1.07 при 1024 px и 2.2 при 2048 px,
+        на гладких данных ошибка на порядок меньше.
+
+        :param hsi_image: Исходное изображение (H, W, C).
+        :param H: Матрица гомографии.
+        :param dsize: (width, height) выходного изображения.
+        :param origin: Левый верхний угол выходного окна в координатах сцены.
+        :param out: Необязательный массив (height, width, C) для результата.
+        :return: Выровненное изображение (height, width, C).
+        """
+        width, height = dsize
+        map_x, map_y = self.tables(H, dsize, origin)
+        if out is None:
+            out = np.empty((height, width, hsi_image.shape[2]), dtype=hsi_image.dtype)
+
+        def warp_chunk(bands):
+            chunk = np.ascontiguousarray(hsi_image[:, :, bands])
+            warped = cv2.remap(chunk, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            out[:, :, bands] = warped.reshape(height, width, -1)
+
+        self._run(warp_chunk, band_chunks(hsi_image.shape[2]))
+        return out
+
+    def warp_crops(self, hsi_image, H, coordinates, height, width, size=256):
+        """
+        Кропы size x size из результата warp(hsi_image, H, (width, height)) без варпа всей сцены:
+        для каждого окна строятся только его карты remap (вырез из карт всей сцены, remap_tables),
+        все каналы варпятся группами по 4 за вызов cv2.remap. Координаты выборки и интерполяция те же,
+        что при варпе всей сцены, поэтому кропы побитно совпадают со срезом transformed[y:y+size, x:x+size]
+        (окна у края сцены обрезаются так же).
+
+        :param hsi_image: Исходное изображение (H, W, C).
+        :param H: Матрица гомографии.
+        :param coordinates: Список словарей {'x': ..., 'y': ...} - левые верхние углы кропов.
+        :param height: Высота выходной сцены.
+        :param width: Ширина выходной сцены.
+        :param size: Размер кропа.
+        :return: Список кропов (h, w, C).
+        """
+        num_bands = hsi_image.shape[2]
+        windows = []
+        for coords in coordinates:
+            x, y = coords['x'], coords['y']
+            crop_h, crop_w = max(min(size, height - y), 0), max(min(size, width - x), 0)
+            tables = remap_tables(H, (crop_w, crop_h), (x, y)) if crop_h and crop_w else None
+            windows.append((tables, crop_h, crop_w))
+        crops = [np.zeros((crop_h, crop_w, num_bands), dtype=hsi_image.dtype) for _, crop_h, crop_w in windows]
+
+        # Каждая группа каналов копируется в непрерывный массив один раз и варпится во все окна
+        def warp_chunk(bands):
+            chunk = np.ascontiguousarray(hsi_image[:, :, bands])
+            for (tables, crop_h, crop_w), crop_img in zip(windows, crops):
+                if tables is not None:
+                    warped = cv2.remap(chunk, *tables, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+                    crop_img[:, :, bands] = warped.reshape(crop_h, crop_w, -1)
+
+        self._run(warp_chunk, band_chunks(num_bands))
+        return crops
+
+    def _run(self, warp_chunk, chunks):
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(warp_chunk, chunks))
+        else:
+            for bands in chunks:
+                warp_chunk(bands)